@@ -0,0 +1,68 @@
+# Gradient accumulation for large effective batch sizes
+# Gradients of K micro-batches are summed before each optimizer update, so
+# batch_size * K samples drive one step without the memory of a large batch.
+import tensorflow as tf
+
+
+class GradientAccumulationModel(tf.keras.Model):
+    '''
+    Functional model whose train_step applies the optimizer every accum_steps batches.
+        - each micro-batch loss (mean over its samples, plus the L2 penalties of
+          model.losses) is divided by accum_steps, so the summed gradient is that
+          of the mean loss over all accum_steps * batch_size samples with the
+          regularization counted once per update
+        - logs carry optimizer_steps, so CSVLogger records real updates
+        - BatchNormalization statistics still update on every micro-batch
+    save() writes the plain functional model, loadable without custom objects.
+    '''
+    def __init__(self, *args, accum_steps=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accum_steps = accum_steps
+        self.micro_step = tf.Variable(0, trainable=False, dtype=tf.int64, name='micro_step')
+        self.accum_gradients = [tf.Variable(tf.zeros_like(v), trainable=False, name='accum_' + v.name.split(':')[0])
+                                for v in self.trainable_variables]
+
+    def compile(self, *args, **kwargs):
+        super().compile(*args, **kwargs)
+        # create the optimizer slots eagerly: they cannot be created inside the
+        # tf.cond of train_step. A zero gradient leaves SGD and Adam unchanged.
+        variables = self.trainable_variables
+        self.optimizer.apply_gradients(zip([tf.zeros_like(v) for v in variables], variables))
+        self.optimizer.iterations.assign(0)
+
+    def train_step(self, data):
+        x, y = data[0], data[1]
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred, regularization_losses=self.losses)
+            scaled_loss = loss / self.accum_steps
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
+        for accum, gradient in zip(self.accum_gradients, gradients):
+            accum.assign_add(gradient)
+        self.micro_step.assign_add(1)
+        tf.cond(tf.equal(self.micro_step % self.accum_steps, 0), self.apply_accumulated, lambda: tf.constant(False))
+
+        self.compiled_metrics.update_state(y, y_pred)
+        logs = {m.name: m.result() for m in self.metrics}
+        logs['optimizer_steps'] = tf.identity(self.optimizer.iterations)
+        return logs
+
+    def apply_accumulated(self):
+        '''One optimizer update with the summed gradients, which are then zeroed.'''
+        self.optimizer.apply_gradients(zip(self.accum_gradients, self.trainable_variables))
+        for accum in self.accum_gradients:
+            accum.assign(tf.zeros_like(accum))
+        return tf.constant(True)
+
+    def save(self, *args, **kwargs):
+        return tf.keras.Model(inputs=self.inputs, outputs=self.outputs).save(*args, **kwargs)
+
+
+def with_gradient_accumulation(model, accum_steps):
+    '''Wrap a built model (sharing its layers and weights) to accumulate over accum_steps batches.'''
+    return GradientAccumulationModel(inputs=model.inputs, outputs=model.outputs, accum_steps=accum_steps)
+
+
+def scaled_steps_per_epoch(n_samples, batch_size, accum_steps):
+    '''Micro-batches per epoch rounded down to whole updates, so no partial update spills over.'''
+    return (n_samples // (batch_size * accum_steps)) * accum_steps
@@ -0,0 +1,199 @@
+# Intermediate-activation cache for partial fine-tuning
+# The backbone below a chosen layer (e.g. mixed7) is frozen: its activations are
+# computed once per image into compressed on-disk shards, and only the upper
+# Inception blocks plus the classifier head are trained from that cache.
+import os
+import glob
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.optimizers import SGD
+from tensorflow.keras.callbacks import CSVLogger
+from tensorflow.keras.utils import to_categorical
+from utils import IMG_SIZE, ManifestSequence, load_manifest
+
+
+def split_at_layer(model, layer_name):
+    '''
+    Split a functional model at layer_name into
+        lower: model.input -> activations of layer_name
+        upper: those activations -> model.output
+    The upper model reuses the layers (and weights) of model, so training it
+    trains model. Every layer above the cut may only depend on the cut or on
+    layers above it, which holds at the mixedN boundaries of InceptionV3.
+    '''
+    cut = model.get_layer(layer_name)
+    lower = Model(inputs=model.input, outputs=cut.output)
+
+    inputs = Input(shape=cut.output_shape[1:])
+    tensors = {layer_name: inputs}
+    config = model.get_config()
+    for layer_config in config['layers']:
+        name = layer_config['name']
+        if name in tensors or not layer_config['inbound_nodes']:
+            continue
+        inbound = [node[0] for node in layer_config['inbound_nodes'][0]]
+        if not any(i in tensors for i in inbound):
+            continue
+        missing = [i for i in inbound if i not in tensors]
+        if missing:
+            raise ValueError("Layer {} depends on {} below the cut at {}".format(name, missing, layer_name))
+        x = [tensors[i] for i in inbound]
+        tensors[name] = model.get_layer(name)(x[0] if len(x) == 1 else x)
+
+    return lower, Model(inputs=inputs, outputs=tensors[config['output_layers'][0][0]])
+
+
+def build_cache(lower, paths, labels, cache_dir, batch_size=32, shard_size=512,
+                target_size=IMG_SIZE, n_views=1, data_aug=False):
+    '''
+    Write the activations of lower as compressed float16 shards
+        <cache_dir>/shard_00000.npz with arrays x (activations) and y (labels)
+    n_views > 1 with data_aug=True stores that many pre-augmented views per image.
+    Returns the total size of the cache in bytes.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    images = ManifestSequence(np.repeat(paths, n_views), np.repeat(labels, n_views), batch_size,
+                              target_size=target_size, shuffle=data_aug, data_aug=data_aug)
+    x_shard, y_shard = [], []
+    shard = 0
+    start = time.time()
+    for i in range(len(images)):
+        x, _ = images[i]
+        x_shard.append(lower.predict_on_batch(x).astype(np.float16))
+        y_shard.append(images.labels[images.batch_indices(i)])
+        if sum(len(y) for y in y_shard) >= shard_size or i == len(images) - 1:
+            np.savez_compressed(os.path.join(cache_dir, 'shard_{:05d}.npz'.format(shard)),
+                                x=np.concatenate(x_shard), y=np.concatenate(y_shard).astype(np.int32))
+            x_shard, y_shard = [], []
+            shard += 1
+            print("Cached {}/{} batches into {} shards ({:.1f}s)".format(i + 1, len(images), shard,
+                                                                        time.time() - start))
+    return cache_size(cache_dir)
+
+
+def cache_size(cache_dir):
+    '''Bytes used on disk by the shards of cache_dir.'''
+    return sum(os.path.getsize(f) for f in glob.glob(os.path.join(cache_dir, 'shard_*.npz')))
+
+
+class ActivationSequence(tf.keras.utils.Sequence):
+    '''
+    Batches of (activations, one-hot labels) read from the shards of a cache.
+    Shards are visited in random order and shuffled internally, so each shard
+    is decompressed once per epoch.
+    '''
+    def __init__(self, cache_dir, batch_size, n_classes, shuffle=True):
+        self.files = sorted(glob.glob(os.path.join(cache_dir, 'shard_*.npz')))
+        self.batch_size = batch_size
+        self.n_classes = n_classes
+        self.shuffle = shuffle
+        self.batches = []
+        for f in self.files:
+            with np.load(f) as shard:
+                n = len(shard['y'])
+            self.batches.extend((f, b) for b in range(0, n, batch_size))
+        self._loaded = (None, None, None)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def _shard(self, f):
+        if self._loaded[0] != f:
+            with np.load(f) as shard:
+                x, y = shard['x'], shard['y']
+            if self.shuffle:
+                p = np.random.permutation(len(y))
+                x, y = x[p], y[p]
+            self._loaded = (f, x, y)
+        return self._loaded[1], self._loaded[2]
+
+    def __getitem__(self, idx):
+        f, b = self.batches[idx]
+        x, y = self._shard(f)
+        return (x[b:b + self.batch_size].astype(np.float32),
+                to_categorical(y[b:b + self.batch_size], self.n_classes))
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            # keep the batches of a shard together, shuffle the shard order
+            order = np.random.permutation(len(self.files))
+            rank = {self.files[j]: r for r, j in enumerate(order)}
+            self.batches.sort(key=lambda fb: (rank[fb[0]], fb[1]))
+
+
+def time_full_finetune(model, images, steps=10):
+    '''Seconds per step of fine-tuning the whole model on image batches, on a copy of model.'''
+    clone = tf.keras.models.clone_model(model)
+    clone.set_weights(model.get_weights())
+    clone.compile(optimizer=SGD(lr=0.0001, momentum=0.9), loss='categorical_crossentropy')
+    x, y = images[0]
+    clone.train_on_batch(x, y)  # build and warm up
+    start = time.time()
+    for i in range(steps):
+        x, y = images[i % len(images)]
+        clone.train_on_batch(x, y)
+    return (time.time() - start) / steps
+
+
+def train_from_cache(model, layer_name='mixed7', food_list=None, cache_dir='food-101/activations',
+                     epochs=10, batch_size=8, n_views=1, data_aug=False,
+                     train_meta='food-101/meta/train.txt', test_meta='food-101/meta/test.txt',
+                     image_dir='food-101/images'):
+    '''
+    Fine-tune the layers of model above layer_name from cached activations.
+    Caches are built on first use; the cache size and the per-epoch speedup
+    over fine-tuning the whole model are printed and returned.
+    '''
+    lower, upper = split_at_layer(model, layer_name)
+    n = model.output_shape[-1]
+
+    train_paths, train_labels, food_list = load_manifest(train_meta, image_dir, food_list)
+    test_paths, test_labels, _ = load_manifest(test_meta, image_dir, food_list)
+    train_dir = os.path.join(cache_dir, layer_name, 'train')
+    test_dir = os.path.join(cache_dir, layer_name, 'test')
+    if not glob.glob(os.path.join(train_dir, 'shard_*.npz')):
+        build_cache(lower, train_paths, train_labels, train_dir, n_views=n_views, data_aug=data_aug)
+    if not glob.glob(os.path.join(test_dir, 'shard_*.npz')):
+        build_cache(lower, test_paths, test_labels, test_dir)
+    size = cache_size(train_dir) + cache_size(test_dir)
+    print("Activation cache of {}: {:.2f} GB".format(layer_name, size / 1e9))
+
+    upper.compile(optimizer=SGD(lr=0.0001, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'])
+    train_cache = ActivationSequence(train_dir, batch_size, n)
+    epoch_times = []
+
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.time()
+
+        def on_epoch_end(self, epoch, logs=None):
+            epoch_times.append(time.time() - self.start)
+
+    history = upper.fit(train_cache,
+                        validation_data=ActivationSequence(test_dir, 64, n, shuffle=False),
+                        epochs=epochs,
+                        shuffle=False,  # ActivationSequence orders batches by shard itself
+                        verbose=1,
+                        callbacks=[CSVLogger('history_{}.log'.format(layer_name)), EpochTimer()])
+
+    full_step = time_full_finetune(model, ManifestSequence(train_paths, train_labels, batch_size, n,
+                                                           shuffle=True, data_aug=data_aug))
+    full_epoch = full_step * len(train_paths) / batch_size
+    cached_epoch = float(np.median(epoch_times))
+    print("Per epoch: full fine-tuning ~{:.0f}s, cached above {} {:.0f}s, speedup {:.1f}x".format(
+        full_epoch, layer_name, cached_epoch, full_epoch / cached_epoch))
+    return history, {'cache_bytes': size, 'full_epoch_s': full_epoch, 'cached_epoch_s': cached_epoch,
+                     'speedup': full_epoch / cached_epoch}
+
+
+if __name__ == "__main__":
+    from tensorflow.keras.models import load_model
+
+    model = load_model('best_model_101class.hdf5')
+    history, report = train_from_cache(model, 'mixed7')
+    model.save('best_model_101class_mixed7.hdf5')
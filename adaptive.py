@@ -0,0 +1,95 @@
+# Adaptive-resolution inference
+# The model is fully convolutional up to GlobalAveragePooling2D, so it accepts
+# smaller inputs. Images are first classified at a reduced resolution and only
+# those with a low confidence margin (top-1 minus top-2 probability) are
+# re-run at the full IMG_SIZE of the shared preprocessing spec.
+import json
+import time
+import numpy as np
+from utils import IMG_SIZE, apply_threading_config, load_image_batch, load_manifest
+
+
+def confidence_margin(probs):
+    '''Top-1 minus top-2 probability of each row.'''
+    top2 = np.sort(probs, axis=1)[:, -2:]
+    return top2[:, 1] - top2[:, 0]
+
+
+def adaptive_predict(model, paths, low_size=(224, 224), full_size=IMG_SIZE, margin=0.2, batch_size=32):
+    '''
+    Probabilities for the images at paths, and the mask of those re-run at full_size.
+    Both resolutions are loaded from the files with the same spec (load_image_batch).
+    '''
+    probs = []
+    escalated = []
+    for b in range(0, len(paths), batch_size):
+        batch = paths[b:b + batch_size]
+        p = np.array(model.predict_on_batch(load_image_batch(batch, low_size)))
+        escalate = confidence_margin(p) < margin
+        if escalate.any():
+            p[escalate] = model.predict_on_batch(load_image_batch(np.asarray(batch)[escalate], full_size))
+        probs.append(p)
+        escalated.append(escalate)
+    return np.concatenate(probs), np.concatenate(escalated)
+
+
+def predict_at(model, paths, size, batch_size=32):
+    '''Probabilities at one resolution, and the seconds spent in the model itself.'''
+    model.predict_on_batch(load_image_batch(paths[:1], size))
+    probs = []
+    seconds = 0.
+    for b in range(0, len(paths), batch_size):
+        x = load_image_batch(paths[b:b + batch_size], size)
+        start = time.time()
+        probs.append(model.predict_on_batch(x))
+        seconds += time.time() - start
+    return np.concatenate(probs), seconds
+
+
+def sweep_resolutions(model, paths, labels, sizes=(160, 192, 224, 256, 300), margins=(0.05, 0.1, 0.2, 0.3, 0.5),
+                      batch_size=32, report_file='resolution_report.json'):
+    '''
+    Accuracy and latency per resolution on the given split, plus the accuracy,
+    escalated fraction and mean latency of adaptive inference from each lower
+    resolution to the largest one for every margin.
+    '''
+    results = {}
+    print("size  accuracy  ms/image")
+    for size in sizes:
+        probs, seconds = predict_at(model, paths, (size, size), batch_size)
+        results[size] = (probs, seconds / len(paths))
+        print("{:4d}  {:8.4f}  {:8.2f}".format(size, np.mean(probs.argmax(axis=1) == labels),
+                                                1000 * seconds / len(paths)))
+
+    full = max(sizes)
+    full_probs, full_latency = results[full]
+    report = {'resolutions': [{'size': size, 'accuracy': float(np.mean(p.argmax(axis=1) == labels)),
+                               'latency_ms': 1000 * t} for size, (p, t) in sorted(results.items())],
+              'adaptive': []}
+    print("low  margin  accuracy  escalated  ms/image")
+    for size in sizes:
+        if size == full:
+            continue
+        low_probs, low_latency = results[size]
+        for margin in margins:
+            escalate = confidence_margin(low_probs) < margin
+            probs = np.where(escalate[:, None], full_probs, low_probs)
+            row = {'low_size': size, 'full_size': full, 'margin': margin,
+                   'accuracy': float(np.mean(probs.argmax(axis=1) == labels)),
+                   'escalated': float(escalate.mean()),
+                   'latency_ms': 1000 * (low_latency + escalate.mean() * full_latency)}
+            print("{low_size:3d}  {margin:6.2f}  {accuracy:8.4f}  {escalated:9.3f}  {latency_ms:8.2f}".format(**row))
+            report['adaptive'].append(row)
+
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    from tensorflow.keras.models import load_model
+
+    apply_threading_config()
+    model = load_model('best_model_101class.hdf5', compile=False)
+    paths, labels, food_list = load_manifest('food-101/meta/test.txt', 'food-101/images')
+    sweep_resolutions(model, paths, labels)
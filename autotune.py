@@ -0,0 +1,157 @@
+# CPU threading autotuner
+# Sweeps intra-op threads, inter-op threads, the number of concurrent
+# inference replicas and the batch size for a model on this machine. Every
+# trial runs in fresh processes (TensorFlow fixes its thread pools when it
+# starts), all replicas of a trial measure over the same window, and the
+# configuration with the best aggregate images/s is written to
+# threading_config.json, which utils.apply_threading_config applies at startup.
+#     python autotune.py [model.hdf5]
+import os
+import sys
+import json
+import time
+import shutil
+import itertools
+import subprocess
+import tempfile
+import numpy as np
+
+THREADING_CONFIG = 'threading_config.json'
+
+
+def powers_of_two(limit):
+    values = [1]
+    while values[-1] * 2 <= limit:
+        values.append(values[-1] * 2)
+    if values[-1] != limit:
+        values.append(limit)
+    return values
+
+
+def candidate_configs(cpus=None, intra=None, inter=(1, 2), replicas=None, batch_sizes=(1, 8, 32)):
+    '''Every (intra, inter, replicas, batch_size) whose intra-op threads fit on the cores.'''
+    cpus = cpus or os.cpu_count() or 1
+    for i, e, r, b in itertools.product(intra or powers_of_two(cpus), inter, replicas or powers_of_two(cpus),
+                                        batch_sizes):
+        if i * r <= cpus:
+            yield {'intra_op_threads': i, 'inter_op_threads': e, 'replicas': r, 'batch_size': b}
+
+
+def trial_worker(config, model_path, barrier_dir, seconds, barrier_timeout=300):
+    '''
+    One replica: set the thread pools, load the model, wait for the others,
+    then time batches. Exits with an error when the others are not ready
+    within barrier_timeout seconds.
+    '''
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(config['intra_op_threads'])
+    tf.config.threading.set_inter_op_parallelism_threads(config['inter_op_threads'])
+    tf.config.set_visible_devices([], 'GPU')
+    from utils import IMG_SIZE, build_tiny_model
+
+    if model_path and os.path.exists(model_path):
+        model = tf.keras.models.load_model(model_path, compile=False)
+    else:
+        model = build_tiny_model(101)
+    shape = tuple(d or s for d, s in zip(model.input_shape[1:], IMG_SIZE + (3,)))
+    x = np.random.rand(config['batch_size'], *shape).astype(np.float32)
+    for _ in range(3):
+        model.predict_on_batch(x)
+
+    open(os.path.join(barrier_dir, 'ready-{}'.format(os.getpid())), 'w').close()
+    deadline = time.time() + barrier_timeout
+    while len(os.listdir(barrier_dir)) < config['replicas']:
+        if time.time() > deadline:
+            sys.exit("Only {} of {} replicas ready after {}s".format(len(os.listdir(barrier_dir)), config['replicas'],
+                                                                   barrier_timeout))
+        time.sleep(0.01)
+
+    latencies = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        batch_start = time.perf_counter()
+        model.predict_on_batch(x)
+        latencies.append(time.perf_counter() - batch_start)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'images_per_s': len(latencies) * config['batch_size'] / elapsed,
+                      'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+                      'p99_ms': 1000 * float(np.percentile(latencies, 99))}))
+
+
+def run_trial(config, model_path=None, seconds=10, timeout=None):
+    '''
+    Aggregate images/s of config['replicas'] concurrent replicas, and their
+    worst latencies. The trial fails (the result carries 'failed') when a
+    replica exits with an error or the replicas run past timeout seconds
+    (default: seconds + 600); the remaining replicas are then killed.
+    '''
+    barrier_dir = tempfile.mkdtemp()
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1', OMP_NUM_THREADS=str(config['intra_op_threads']))
+    args = [sys.executable, os.path.abspath(__file__), 'trial', json.dumps(config), model_path or '',
+            barrier_dir, str(seconds)]
+    procs = [subprocess.Popen(args, env=env, stdout=subprocess.PIPE, universal_newlines=True)
+             for _ in range(config['replicas'])]
+    deadline = time.time() + (timeout or seconds + 600)
+    failed = None
+    try:
+        while failed is None and any(proc.poll() is None for proc in procs):
+            if any(proc.returncode for proc in procs):
+                failed = 'replica exited with status {}'.format([proc.returncode for proc in procs])
+            elif time.time() > deadline:
+                failed = 'timed out'
+            time.sleep(0.1)
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+        outputs = [proc.communicate()[0] for proc in procs]
+        if failed is None and any(proc.returncode for proc in procs):
+            failed = 'replica exited with status {}'.format([proc.returncode for proc in procs])
+        if failed is None:
+            results = [json.loads(out.strip().splitlines()[-1]) for out in outputs]
+    except (ValueError, IndexError):
+        failed = 'unreadable replica output'
+    finally:
+        shutil.rmtree(barrier_dir, ignore_errors=True)
+    if failed is not None:
+        return dict(config, failed=failed)
+    return dict(config,
+                images_per_s=sum(r['images_per_s'] for r in results),
+                p50_ms=max(r['p50_ms'] for r in results),
+                p99_ms=max(r['p99_ms'] for r in results))
+
+
+def tune(model_path='best_model_101class.hdf5', out_file=THREADING_CONFIG, max_p99_ms=None, seconds=10,
+         report_file='autotune_report.json', **grid):
+    '''
+    Run every candidate configuration and write the fastest one (within the
+    max_p99_ms latency bound, if given) to out_file. grid: candidate_configs kwargs.
+    '''
+    trials = []
+    for config in candidate_configs(**grid):
+        trial = run_trial(config, model_path, seconds)
+        trials.append(trial)
+        if 'failed' in trial:
+            print("Trial {} failed: {}".format(config, trial['failed']))
+            continue
+        print("intra {intra_op_threads:3d} inter {inter_op_threads} replicas {replicas:3d} batch {batch_size:3d}: "
+              "{images_per_s:8.1f} img/s  p50 {p50_ms:7.1f} ms  p99 {p99_ms:7.1f} ms".format(**trial))
+    with open(report_file, 'w') as f:
+        json.dump(trials, f, indent=1)
+
+    eligible = [t for t in trials if 'failed' not in t and (max_p99_ms is None or t['p99_ms'] <= max_p99_ms)]
+    if not eligible:
+        print("No configuration met the latency bound")
+        return None
+    best = max(eligible, key=lambda t: t['images_per_s'])
+    best.update(cpus=os.cpu_count(), model=model_path, tuned=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(out_file, 'w') as f:
+        json.dump(best, f, indent=1)
+    print("Best: {}".format(best))
+    return best
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'trial':
+        trial_worker(json.loads(sys.argv[2]), sys.argv[3], sys.argv[4], float(sys.argv[5]))
+    else:
+        tune(sys.argv[1] if len(sys.argv) > 1 else 'best_model_101class.hdf5')
@@ -0,0 +1,207 @@
+# Micro-benchmarks of the hot paths
+# CPU-only numbers for every Rand_Augment op, Rand_Augment at N=2/4,
+# utils.data_generator with and without augmentation, predict_class (one image
+# at a time) against one batched prediction call on a tiny stand-in model (no
+# trained weights needed), plus the memory.py stage peaks of load_data,
+# pseudo_labelling and data_generator. Inputs are the data/*.jpg
+# samples plus synthetic images. Each run is saved as benchmarks/<time>.json
+# and compared with the previous run.
+#     python benchmarks.py
+import os
+import glob
+import json
+import time
+import shutil
+import platform
+import tempfile
+import numpy as np
+from PIL import Image
+import tensorflow as tf
+import memory
+import utils
+from utils import IMG_SIZE, build_tiny_model, load_image_batch, predict_class
+from rand_augmentation import Rand_Augment
+from profiling import summarize
+
+RESULTS_DIR = 'benchmarks'
+
+
+def synthetic_images(n, size=IMG_SIZE, seed=0):
+    '''Smooth random uint8 images (noise would make PIL ops unusually cheap or dear).'''
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0, 256, size=(n, 8, 8, 3)).astype(np.uint8)
+    return np.stack([np.asarray(Image.fromarray(s).resize(size[::-1], Image.BILINEAR)) for s in small])
+
+
+def sample_images(n, size=IMG_SIZE, sample_dir='data'):
+    '''n uint8 images: the sample photos first, synthetic ones for the rest.'''
+    real = load_image_batch(sorted(glob.glob(os.path.join(sample_dir, '*.jpg'))), target_size=size)
+    real = (real[:n] * 255).round().astype(np.uint8)
+    return np.concatenate([real, synthetic_images(n - len(real), size)])
+
+
+def time_calls(fn, items, warmup=2):
+    '''Seconds per call of fn over items, after warm-up calls.'''
+    for item in items[:warmup]:
+        fn(item)
+    seconds = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def result(seconds, images_per_call=1):
+    summary = summarize(seconds)
+    return {'images_per_s': images_per_call * len(seconds) / summary['total'],
+            'latency_ms': {k: v * 1000 for k, v in summary.items() if k != 'total'}}
+
+
+def bench_augment_ops(images, magnitude=5):
+    '''Every entry of Rand_Augment.func at one magnitude, on PIL images.'''
+    aug = Rand_Augment(Numbers=2, max_Magnitude=10)
+    pil = [Image.fromarray(x) for x in images]
+    return {'augment_op/' + op: result(time_calls(lambda img: func(img, aug.ranges[op][magnitude]), pil))
+            for op, func in sorted(aug.func.items())}
+
+
+def bench_augment_call(images, numbers=(2, 4)):
+    '''Rand_Augment.__call__ on float arrays, as ImageDataGenerator hands them over.'''
+    arrays = [x.astype(np.float32) for x in images]
+    report = {}
+    for n in numbers:
+        aug = Rand_Augment(Numbers=n, max_Magnitude=10)
+        report['augment_call/N={}'.format(n)] = result(time_calls(aug, arrays))
+    return report
+
+
+def bench_data_generator(images, batch_size=32, steps=10):
+    labels = np.eye(101, dtype=np.float32)[np.arange(len(images)) % 101]
+    report = {}
+    for data_aug in [False, True]:
+        generator = utils.data_generator(images.astype(np.float32), labels, batch_size, data_aug)
+        seconds = time_calls(lambda _: next(generator), list(range(steps)))
+        report['data_generator/data_aug={}'.format(data_aug)] = result(seconds, batch_size)
+    return report
+
+
+def bench_predict_class(images, batch_sizes=(1, 4, 16), repeat=5):
+    '''
+    On build_tiny_model, for N image files: predict_class, which loads and
+    predicts them one at a time, and one batched load_image_batch +
+    predict_on_batch call.
+    '''
+    model = build_tiny_model(101)
+    food_list = ['class_{:03d}'.format(c) for c in range(101)]
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i, x in enumerate(images[:max(batch_sizes)]):
+            paths.append(os.path.join(tmp, '{}.jpg'.format(i)))
+            Image.fromarray(x).save(paths[-1], quality=95)
+        report = {}
+        for batch_size in batch_sizes:
+            batch = (paths * batch_size)[:batch_size]
+            seconds = time_calls(lambda _: predict_class(model, batch, food_list, show=False), list(range(repeat)), 1)
+            report['predict_class/sequential={}'.format(batch_size)] = result(seconds, batch_size)
+            seconds = time_calls(lambda _: model.predict_on_batch(load_image_batch(batch, target_size=IMG_SIZE)),
+                                 list(range(repeat)), 1)
+            report['predict_on_batch/batch={}'.format(batch_size)] = result(seconds, batch_size)
+    finally:
+        shutil.rmtree(tmp)
+    return report
+
+
+class CyclingPredictor(object):
+    '''Stand-in teacher for pseudo_labelling: confident one-hot predictions cycling through n classes.'''
+    def __init__(self, n=9):
+        self.n = n
+        self.i = 0
+
+    def predict(self, x):
+        classes = (self.i + np.arange(len(x))) % self.n
+        self.i += len(x)
+        return np.eye(self.n, dtype=np.float32)[classes]
+
+
+def bench_memory(images, batch_size=32, steps=5):
+    '''
+    memory.py stage peaks of load_data, pseudo_labelling (per phase) and
+    data_generator batches on the benchmark images, as MB above entry level.
+    '''
+    tmp = tempfile.mkdtemp()
+    memory.RECORDS.clear()
+    memory.enable(fail=False)
+    try:
+        half = len(images) // 2
+        np.save(os.path.join(tmp, 'xs.npy'), images[:half])
+        np.save(os.path.join(tmp, 'ys.npy'), np.arange(half) % 9)
+        (xs, ys), = utils.load_data(os.path.join(tmp, 'xs.npy'), os.path.join(tmp, 'ys.npy'))
+        x_train, y_train = utils.pseudo_labelling(CyclingPredictor(9), xs, ys, images[half:], threhold=0.5)
+        generator = utils.data_generator(x_train, y_train, batch_size, data_aug=False)
+        for _ in range(steps):
+            next(generator)
+    finally:
+        memory.disable()
+        shutil.rmtree(tmp)
+    return {'memory/' + name: {'peak_mb': record['peak_mb'], 'rss_growth_mb': record['rss_growth_mb']}
+            for name, record in memory.RECORDS.items()}
+
+
+def latest_results(results_dir=RESULTS_DIR):
+    files = sorted(glob.glob(os.path.join(results_dir, '*.json')))
+    return files[-1] if files else None
+
+
+def compare(current, previous, tolerance=0.1):
+    '''
+    Print images/s (memory stages: peak MB) of every benchmark against the
+    previous run, flagging changes beyond tolerance.
+    '''
+    for name, entry in sorted(current['results'].items()):
+        key, unit, up, down = (('images_per_s', 'img/s', 'FASTER', 'SLOWER') if 'images_per_s' in entry
+                                    else ('peak_mb', 'MB', 'MORE MEMORY', 'LESS MEMORY'))
+        old = previous['results'].get(name)
+        if old is None or not old[key]:
+            print("{:40s} {:10.1f} {:5s} (new)".format(name, entry[key], unit))
+            continue
+        ratio = entry[key] / old[key]
+        flag = up if ratio > 1 + tolerance else down if ratio < 1 - tolerance else ''
+        print("{:40s} {:10.1f} {:5s} x{:.2f} {}".format(name, entry[key], unit, ratio, flag))
+
+
+def run_all(n_images=32, results_dir=RESULTS_DIR):
+    tf.config.set_visible_devices([], 'GPU')
+    images = sample_images(n_images)
+    results = {}
+    results.update(bench_augment_ops(images))
+    results.update(bench_augment_call(images))
+    results.update(bench_data_generator(images))
+    results.update(bench_predict_class(images))
+    results.update(bench_memory(images))
+
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                       'cpus': os.cpu_count(), 'python': platform.python_version(),
+                       'tensorflow': tf.__version__},
+           'results': results}
+    previous = latest_results(results_dir)
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    out_file = os.path.join(results_dir, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(out_file, 'w') as f:
+        json.dump(run, f, indent=1)
+    print("Saved {}".format(out_file))
+
+    if previous is not None:
+        with open(previous) as f:
+            print("Compared with {}".format(previous))
+            compare(run, json.load(f))
+    else:
+        compare(run, {'results': {}})
+    return run
+
+
+if __name__ == "__main__":
+    run_all()
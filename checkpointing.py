@@ -0,0 +1,221 @@
+# Asynchronous checkpointing and resumable training state
+# A checkpoint holds the model weights, the optimizer slots, the epoch/step
+# position, the Python/NumPy/TF RNG states and the sample order of the input
+# Sequence. The arrays are copied on the training thread and written by a
+# background thread (temporary file + atomic rename), keeping the last N.
+# A resumed run sees the same samples in the same order, but not bit-identical
+# augmentation: fit's input workers draw from the global RNGs for batches they
+# prepare ahead of the model, so the saved RNG states are already past the
+# last trained batch.
+import os
+import csv
+import glob
+import pickle
+import random
+import threading
+import numpy as np
+import tensorflow as tf
+
+
+def latest_checkpoint(directory):
+    files = sorted(glob.glob(os.path.join(directory, 'ckpt-*.pkl')))
+    return files[-1] if files else None
+
+
+def write_atomic(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    '''
+    Snapshot the full training state every save_freq steps and at every epoch end.
+    sequence: the keras Sequence given to fit (ManifestSequence, flow_from_directory);
+    its index_array is saved so that an interrupted epoch usually resumes on the
+    same samples. What is exact is the model: weights, optimizer slots and the
+    (epoch, step) position of the last trained batch. The index_array and the
+    RNG states are taken as they stand at the snapshot, after the input
+    workers have prepared batches ahead of the model: the RNGs include the draws
+    of prefetched batches, and near the end of an epoch the Sequence may
+    already be reshuffled for the next one.
+    With monitor set, the weights of the best epoch are also kept (best.pkl) and
+    written once as best_filepath when training ends.
+    '''
+    def __init__(self, directory='checkpoints', save_freq=500, keep=3, sequence=None,
+                 monitor='val_loss', best_filepath=None):
+        super().__init__()
+        self.directory = directory
+        self.save_freq = save_freq
+        self.keep = keep
+        self.sequence = sequence
+        self.monitor = monitor
+        self.best_filepath = best_filepath
+        self.best = np.inf
+        self.offset = 0
+        self.epoch = 0
+        self.global_step = 0
+        self._writer = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.global_step += 1
+        if self.save_freq and self.global_step % self.save_freq == 0:
+            self.save(self.epoch, self.offset + batch + 1)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.save(epoch + 1, 0)
+        value = (logs or {}).get(self.monitor)
+        if value is not None and value < self.best:
+            self.best = value
+            self.write('best.pkl', {'weights': self.model.get_weights(), 'epoch': epoch, self.monitor: value})
+
+    def on_train_end(self, logs=None):
+        self.wait()
+        best = os.path.join(self.directory, 'best.pkl')
+        if self.best_filepath and os.path.exists(best):
+            with open(best, 'rb') as f:
+                state = pickle.load(f)
+            current = self.model.get_weights()
+            self.model.set_weights(state['weights'])
+            self.model.save(self.best_filepath)
+            self.model.set_weights(current)
+
+    def snapshot(self, epoch, step):
+        '''Copy of the training state, taken on the training thread.'''
+        index_array = getattr(self.sequence, 'index_array', None)
+        return {'weights': self.model.get_weights(),
+                'optimizer': [v.numpy() for v in self.model.optimizer.variables()],
+                'epoch': epoch,
+                'step': step,
+                'global_step': self.global_step,
+                'optimizer_steps': int(self.model.optimizer.iterations.numpy()),
+                'best': self.best,
+                'numpy_rng': np.random.get_state(),
+                'python_rng': random.getstate(),
+                'tf_rng': tf.random.get_global_generator().state.numpy(),
+                'index_array': None if step == 0 or index_array is None else np.array(index_array)}
+
+    def save(self, epoch, step):
+        self.write('ckpt-{:010d}.pkl'.format(self.global_step), self.snapshot(epoch, step))
+
+    def write(self, name, state):
+        # at most one write in flight, so at most one extra copy of the weights in memory
+        self.wait()
+        self._writer = threading.Thread(target=self._write, args=(os.path.join(self.directory, name), state))
+        self._writer.start()
+
+    def _write(self, path, state):
+        write_atomic(path, state)
+        for old in sorted(glob.glob(os.path.join(self.directory, 'ckpt-*.pkl')))[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+
+def restore(model, directory, sequence=None, checkpoint=None):
+    '''
+    Load the latest checkpoint of directory into model (compiled), the RNGs and sequence.
+    Returns the (epoch, step) to resume from, (0, 0) without checkpoint.
+    '''
+    path = latest_checkpoint(directory)
+    if path is None:
+        return 0, 0
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    print("Resuming from {} (epoch {}, step {})".format(path, state['epoch'], state['step']))
+
+    model.set_weights(state['weights'])
+    optimizer = model.optimizer
+    if len(optimizer.variables()) != len(state['optimizer']):
+        # create the optimizer slots with a zero update, then overwrite them
+        variables = model.trainable_variables
+        optimizer.apply_gradients(zip([tf.zeros_like(v) for v in variables], variables))
+    for variable, value in zip(optimizer.variables(), state['optimizer']):
+        variable.assign(value)
+
+    np.random.set_state(state['numpy_rng'])
+    random.setstate(state['python_rng'])
+    tf.random.get_global_generator().reset(state['tf_rng'])
+    if sequence is not None and state['index_array'] is not None:
+        sequence.index_array = state['index_array']
+    if checkpoint is not None:
+        checkpoint.global_step = state['global_step']
+        checkpoint.best = state['best']
+    return state['epoch'], state['step']
+
+
+class OffsetSequence(tf.keras.utils.Sequence):
+    '''The batches of sequence from offset on, to finish an interrupted epoch.'''
+    def __init__(self, sequence, offset):
+        self.sequence = sequence
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.sequence) - self.offset
+
+    def __getitem__(self, idx):
+        return self.sequence[idx + self.offset]
+
+
+def resumable_fit(model, sequence, epochs, directory='checkpoints', save_freq=500, keep=3,
+                  best_filepath=None, callbacks=None, **fit_kwargs):
+    '''
+    model.fit over a keras Sequence that resumes from the latest checkpoint in directory.
+    The Sequence shuffles itself (ManifestSequence(shuffle=True), flow_from_directory),
+    so fit runs with shuffle=False and one epoch is len(sequence) steps. Use
+    CSVLogger(..., append=True) so the history survives restarts; csv_history
+    reads it back. Returns a History of the epochs trained by this call (empty
+    when training was already complete).
+    '''
+    callbacks = list(callbacks or [])
+    checkpoint = AsyncCheckpoint(directory, save_freq, keep, sequence, best_filepath=best_filepath)
+    epoch, step = restore(model, directory, sequence, checkpoint)
+    history = {}
+
+    if step > 0:
+        checkpoint.offset = step
+        partial = model.fit(OffsetSequence(sequence, step), epochs=epoch + 1, initial_epoch=epoch,
+                            shuffle=False, callbacks=callbacks + [checkpoint], **fit_kwargs)
+        history = partial.history
+        sequence.on_epoch_end()
+        checkpoint.offset = 0
+        epoch += 1
+
+    if epoch < epochs:
+        fit = model.fit(sequence, epochs=epochs, initial_epoch=epoch, shuffle=False,
+                        callbacks=callbacks + [checkpoint], **fit_kwargs)
+        for key, values in fit.history.items():
+            history.setdefault(key, []).extend(values)
+        fit.history = history
+        return fit
+    if step > 0:
+        return partial
+    done = tf.keras.callbacks.History()
+    done.set_model(model)
+    done.history, done.epoch = {}, []
+    return done
+
+
+def csv_history(path='history.log'):
+    '''History whose history dict holds every column of a CSVLogger file, across restarts.'''
+    history = tf.keras.callbacks.History()
+    history.history = {}
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    history.epoch = [int(row['epoch']) for row in rows]
+    for row in rows:
+        for key, value in row.items():
+            if key != 'epoch':
+                history.history.setdefault(key, []).append(float(value) if value else float('nan'))
+    return history
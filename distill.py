@@ -0,0 +1,143 @@
+# Knowledge distillation from best_model_101class to a compact student
+# The InceptionV3 teacher scores the training manifest once; its logits are
+# cached as a float16 memmap and reused every epoch as temperature-scaled soft
+# labels for a much smaller student (the MobileNetV2 of cascade.py).
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.callbacks import CSVLogger
+from utils import IMG_SIZE, ManifestSequence, load_manifest, measure_throughput
+from cascade import build_small_model, collect_probabilities
+
+
+def probabilities_to_logits(probs):
+    '''log p equals the logits up to a per-row constant, which temperature softmax ignores.'''
+    return np.log(np.clip(probs, 1e-7, 1.))
+
+
+def cache_teacher_logits(teacher, paths, labels, out_file, batch_size=64, target_size=IMG_SIZE):
+    '''Teacher logits for every image of the manifest, computed once into a float16 memmap.'''
+    if os.path.exists(out_file):
+        print("Using cached teacher logits {}".format(out_file))
+        return np.load(out_file, mmap_mode='r')
+    images = ManifestSequence(paths, labels, batch_size, target_size=target_size)
+    logits = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float16,
+                                       shape=(len(paths), teacher.output_shape[-1]))
+    for i in range(len(images)):
+        index = images.batch_indices(i)
+        logits[index[0]:index[-1] + 1] = probabilities_to_logits(teacher.predict_on_batch(images[i][0]))
+    logits.flush()
+    del logits
+    return np.load(out_file, mmap_mode='r')
+
+
+class DistillSequence(ManifestSequence):
+    '''ManifestSequence whose targets are (one-hot labels, cached teacher logits).'''
+    def __init__(self, paths, labels, logits, batch_size, n_classes=None, target_size=(224, 224),
+                 shuffle=True, data_aug=False):
+        super().__init__(paths, labels, batch_size, n_classes, target_size, shuffle, data_aug)
+        self.logits = logits
+
+    def __getitem__(self, idx):
+        x, y = super().__getitem__(idx)
+        return x, (y, np.asarray(self.logits[self.batch_indices(idx)], dtype=np.float32))
+
+
+class Distiller(keras.Model):
+    '''
+    Trains student on
+        alpha * CE(labels, student) + (1 - alpha) * T^2 * KL(teacher_T || student_T)
+    where _T is the softmax of the logits divided by the temperature T.
+    Evaluation uses the hard labels only, so validation data is plain (x, one-hot).
+    '''
+    def __init__(self, student, temperature=4., alpha=0.1):
+        super().__init__()
+        self.student = student
+        self.temperature = temperature
+        self.alpha = alpha
+        self.cross_entropy = keras.losses.CategoricalCrossentropy()
+        self.kl = keras.losses.KLDivergence()
+        self.accuracy = keras.metrics.CategoricalAccuracy(name='accuracy')
+        self.loss_tracker = keras.metrics.Mean(name='loss')
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.accuracy]
+
+    def call(self, x, training=False):
+        return self.student(x, training=training)
+
+    def train_step(self, data):
+        x, (y, teacher_logits) = data
+        with tf.GradientTape() as tape:
+            probs = self.student(x, training=True)
+            student_logits = tf.math.log(tf.clip_by_value(probs, 1e-7, 1.))
+            soft_loss = self.kl(tf.nn.softmax(teacher_logits / self.temperature),
+                                tf.nn.softmax(student_logits / self.temperature))
+            loss = (self.alpha * self.cross_entropy(y, probs)
+                    + (1 - self.alpha) * self.temperature ** 2 * soft_loss
+                    + tf.add_n(self.student.losses or [0.]))
+        gradients = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.student.trainable_variables))
+        self.loss_tracker.update_state(loss)
+        self.accuracy.update_state(y, probs)
+        return {m.name: m.result() for m in self.metrics}
+
+    def test_step(self, data):
+        x, y = data
+        probs = self.student(x, training=False)
+        self.loss_tracker.update_state(self.cross_entropy(y, probs))
+        self.accuracy.update_state(y, probs)
+        return {m.name: m.result() for m in self.metrics}
+
+
+def distill(teacher, student=None, input_size=224, epochs=20, batch_size=32, temperature=4., alpha=0.1,
+            logits_file='food-101/teacher_logits.npy', food_list=None,
+            train_meta='food-101/meta/train.txt', test_meta='food-101/meta/test.txt',
+            image_dir='food-101/images'):
+    '''
+    Distill teacher into student (build_small_model at input_size by default).
+    Returns the trained student and a report of the accuracy gap and CPU throughput.
+    '''
+    train_paths, train_labels, food_list = load_manifest(train_meta, image_dir, food_list)
+    test_paths, test_labels, _ = load_manifest(test_meta, image_dir, food_list)
+    n = len(food_list)
+    logits = cache_teacher_logits(teacher, train_paths, train_labels, logits_file)
+
+    if student is None:
+        student = build_small_model(n, input_size)
+    size = tuple(student.input_shape[1:3])
+    distiller = Distiller(student, temperature, alpha)
+    distiller.compile(optimizer=Adam())
+    distiller.fit(DistillSequence(train_paths, train_labels, logits, batch_size, n, size),
+                  validation_data=ManifestSequence(test_paths, test_labels, 64, n, size),
+                  epochs=epochs,
+                  verbose=1,
+                  callbacks=[CSVLogger('history_distill.log')])
+
+    teacher_size = tuple(teacher.input_shape[1:3]) if teacher.input_shape[1] else IMG_SIZE
+    teacher_acc = float((collect_probabilities(teacher, test_paths, test_labels, teacher_size).argmax(axis=1)
+                         == test_labels).mean())
+    student_acc = float((collect_probabilities(student, test_paths, test_labels, size).argmax(axis=1)
+                         == test_labels).mean())
+    teacher_ips = measure_throughput(teacher, teacher_size + (3,))
+    student_ips = measure_throughput(student, size + (3,))
+    report = {'teacher_accuracy': teacher_acc, 'student_accuracy': student_acc,
+              'accuracy_gap': teacher_acc - student_acc,
+              'teacher_images_per_s': teacher_ips, 'student_images_per_s': student_ips,
+              'speedup': student_ips / teacher_ips,
+              'teacher_params': teacher.count_params(), 'student_params': student.count_params()}
+    print("Teacher {teacher_accuracy:.4f} @ {teacher_images_per_s:.1f} img/s, "
+          "student {student_accuracy:.4f} @ {student_images_per_s:.1f} img/s "
+          "({speedup:.1f}x faster, accuracy gap {accuracy_gap:.4f})".format(**report))
+    return student, report
+
+
+if __name__ == "__main__":
+    from tensorflow.keras.models import load_model
+
+    teacher = load_model('best_model_101class.hdf5', compile=False)
+    student, report = distill(teacher)
+    student.save('student_model_101class.hdf5')
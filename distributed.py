@@ -0,0 +1,195 @@
+# Local multi-process data-parallel training with tf.distribute
+# N worker processes on this machine train one model with
+# MultiWorkerMirroredStrategy. TF_CONFIG is generated for loopback ports, each
+# worker reads its own shard of the manifest, and only the chief keeps its
+# checkpoint (the best val_loss with val_meta set, else the best training
+# loss). Runs on CPU only, so a single Linux box without GPU is enough:
+#     python distributed.py 1 2 4      scaling report for 1, 2 and 4 workers
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import subprocess
+
+DEFAULT_CONFIG = {
+    'train_meta': 'food-101/meta/train.txt',
+    'val_meta': None,        # e.g. food-101/meta/test.txt: validate every epoch, keep the best val_loss
+    'validation_steps': 50,
+    'food_list': None,       # only these classes (utils.pick_n_random_classes), default all
+    'image_dir': 'food-101/images',
+    'synthetic': False,      # random images instead of the manifest, for smoke runs
+    'data_aug': True,        # the random transforms of run.py's training ImageDataGenerator
+    'tiny': False,           # utils.build_tiny_model instead of InceptionV3
+    'n_classes': 101,
+    'per_worker_batch_size': 8,
+    'epochs': 2,             # images/s is measured on the last epoch
+    'steps_per_epoch': 50,
+    'lr': 0.0001,
+    'checkpoint': 'best_model_101class_distributed.hdf5',
+}
+
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('127.0.0.1', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def make_tf_config(ports, index):
+    return json.dumps({'cluster': {'worker': ['127.0.0.1:{}'.format(p) for p in ports]},
+                       'task': {'type': 'worker', 'index': index}})
+
+
+def launch(n_workers, config=None, report_file=None):
+    '''
+    Start n_workers local processes running worker_main and wait for them.
+    Returns the chief's report (images/s, steps, seconds).
+    '''
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    if report_file is None:
+        report_file = os.path.join(tempfile.mkdtemp(), 'report.json')
+    config['report_file'] = report_file
+    ports = free_ports(n_workers)
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    workers = []
+    for index in range(n_workers):
+        env = dict(os.environ,
+                   TF_CONFIG=make_tf_config(ports, index),
+                   CUDA_VISIBLE_DEVICES='',
+                   FOOD101_DISTRIBUTED=json.dumps(config),
+                   OMP_NUM_THREADS=str(threads),
+                   TF_NUM_INTRAOP_THREADS=str(threads))
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker'], env=env))
+    codes = [w.wait() for w in workers]
+    if any(codes):
+        raise RuntimeError("Distributed workers exited with codes {}".format(codes))
+    with open(report_file) as f:
+        return json.load(f)
+
+
+def scaling_report(worker_counts=(1, 2, 4), config=None, report_file='scaling_report.json'):
+    '''Images/s and scaling efficiency (relative to the first count) per number of workers.'''
+    results = []
+    for n in worker_counts:
+        report = launch(n, config)
+        report['workers'] = n
+        results.append(report)
+    base = results[0]['images_per_s'] / results[0]['workers']
+    print("workers  images/s  efficiency")
+    for r in results:
+        r['efficiency'] = r['images_per_s'] / (base * r['workers'])
+        print("{workers:7d}  {images_per_s:8.1f}  {efficiency:10.2f}".format(**r))
+    with open(report_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+def worker_main():
+    import tensorflow as tf
+    from tensorflow.keras.optimizers import SGD
+    from tensorflow.keras.callbacks import ModelCheckpoint
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    from utils import IMG_SIZE, RESCALE, TRAIN_AUGMENTATION, load_manifest, build_model, build_tiny_model
+
+    config = json.loads(os.environ['FOOD101_DISTRIBUTED'])
+    threads = int(os.environ.get('TF_NUM_INTRAOP_THREADS', 0))
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    task = json.loads(os.environ['TF_CONFIG'])['task']
+    is_chief = task['index'] == 0
+    n = config['n_classes']
+    size = IMG_SIZE if not config['tiny'] else (64, 64)
+    global_batch_size = config['per_worker_batch_size'] * strategy.num_replicas_in_sync
+
+    if config['synthetic']:
+        paths = labels = None
+    else:
+        paths, labels, food_list = load_manifest(config['train_meta'], config['image_dir'], config['food_list'])
+        n = len(food_list)
+    validate = config['val_meta'] is not None and paths is not None
+    if validate:
+        val_paths, val_labels, _ = load_manifest(config['val_meta'], config['image_dir'], food_list)
+
+    augmenter = ImageDataGenerator(**TRAIN_AUGMENTATION)
+
+    def augment(image):
+        return augmenter.random_transform(image).astype('float32')
+
+    def load(path, label, data_aug=config['data_aug']):
+        # the steps of flow_from_directory: nearest resize, random transform, rescale
+        image = tf.image.decode_jpeg(tf.io.read_file(path), channels=3)
+        image = tf.cast(tf.image.resize(image, size, method='nearest'), tf.float32)
+        if data_aug:
+            image = tf.numpy_function(augment, [image], tf.float32)
+            image.set_shape(size + (3,))
+        return image * RESCALE, tf.one_hot(label, n)
+
+    def val_dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        dataset = tf.data.Dataset.from_tensor_slices((val_paths, val_labels))
+        dataset = dataset.shard(input_context.num_input_pipelines, input_context.input_pipeline_id).repeat()
+        dataset = dataset.map(lambda path, label: load(path, label, False),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.batch(batch_size, drop_remainder=True).prefetch(tf.data.experimental.AUTOTUNE)
+
+    def dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        if paths is None:
+            images = tf.random.uniform((batch_size,) + size + (3,))
+            one_hot = tf.one_hot(tf.random.uniform((batch_size,), 0, n, tf.int32), n)
+            return tf.data.Dataset.from_tensors((images, one_hot)).repeat()
+        dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+        # each worker reads only its shard of the manifest
+        dataset = dataset.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+        dataset = dataset.shuffle(10000).repeat()
+        dataset = dataset.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return dataset.batch(batch_size, drop_remainder=True).prefetch(tf.data.experimental.AUTOTUNE)
+
+    dataset = strategy.distribute_datasets_from_function(dataset_fn)
+    val_dataset = strategy.distribute_datasets_from_function(val_dataset_fn) if validate else None
+    with strategy.scope():
+        model = build_tiny_model(n) if config['tiny'] else build_model(n)
+        model.compile(optimizer=SGD(lr=config['lr'], momentum=0.9), loss='categorical_crossentropy',
+                      metrics=['accuracy'])
+
+    # every worker saves (the save may use collectives) but only the chief's file is kept
+    checkpoint_dir = os.path.dirname(os.path.abspath(config['checkpoint'])) if is_chief else tempfile.mkdtemp()
+    checkpoint = ModelCheckpoint(os.path.join(checkpoint_dir, os.path.basename(config['checkpoint'])),
+                                 monitor='val_loss' if validate else 'loss', save_best_only=True)
+
+    class Throughput(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.time()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.seconds = time.time() - self.start
+
+    throughput = Throughput()
+    model.fit(dataset, epochs=config['epochs'], steps_per_epoch=config['steps_per_epoch'],
+              validation_data=val_dataset, validation_steps=config['validation_steps'] if validate else None,
+              verbose=2 if is_chief else 0, callbacks=[checkpoint, throughput])
+
+    if is_chief:
+        steps = config['steps_per_epoch']
+        with open(config['report_file'], 'w') as f:
+            json.dump({'images_per_s': steps * global_batch_size / throughput.seconds,
+                       'steps': steps, 'seconds': throughput.seconds,
+                       'global_batch_size': global_batch_size}, f)
+    else:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['worker']:
+        worker_main()
+    else:
+        counts = [int(a) for a in sys.argv[1:]] or [1, 2, 4]
+        scaling_report(counts, {'synthetic': not os.path.exists(DEFAULT_CONFIG['train_meta'])})
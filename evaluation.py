@@ -0,0 +1,134 @@
+# Streaming, incrementally aggregated evaluation
+# Predictions are folded batch by batch into a confusion matrix and top-k /
+# loss counters, so memory does not depend on the size of the test set and
+# any batched source works: (x, t) arrays or memmaps, keras Sequences
+# (ManifestSequence, flow_from_directory, cached shards) or plain iterables.
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from metrics import PREDICT_BATCH_SIZE, PREDICT_SECONDS
+
+
+class StreamingEvaluator(object):
+    '''
+    Running confusion matrix (rows: true class, columns: predicted class),
+    top-1/top-k accuracy, mean cross-entropy and per-class precision/recall.
+    Evaluators of disjoint shards combine with merge().
+    '''
+    def __init__(self, n_classes=101, k=5):
+        self.n_classes = n_classes
+        self.k = k
+        self.confusion = np.zeros((n_classes, n_classes), dtype=np.int64)
+        self.top_k_correct = 0
+        self.loss_sum = 0.
+        self.count = 0
+
+    def update(self, probs, labels):
+        '''probs: (batch, n_classes); labels: class indices or one-hot rows.'''
+        probs = np.asarray(probs)
+        labels = np.asarray(labels)
+        if labels.ndim == 2:
+            labels = labels.argmax(axis=1)
+        labels = labels.astype(np.int64)
+        n = self.n_classes
+        self.confusion += np.bincount(labels * n + probs.argmax(axis=1), minlength=n * n).reshape(n, n)
+        k = min(self.k, n)
+        top_k = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+        self.top_k_correct += int((top_k == labels[:, None]).any(axis=1).sum())
+        self.loss_sum += float(-np.log(np.clip(probs[np.arange(len(labels)), labels], 1e-7, 1.)).sum())
+        self.count += len(labels)
+
+    def merge(self, other):
+        self.confusion += other.confusion
+        self.top_k_correct += other.top_k_correct
+        self.loss_sum += other.loss_sum
+        self.count += other.count
+        return self
+
+    def state(self):
+        '''Plain picklable counters, e.g. to send from a worker process.'''
+        return {'n_classes': self.n_classes, 'k': self.k, 'confusion': self.confusion,
+                'top_k_correct': self.top_k_correct, 'loss_sum': self.loss_sum, 'count': self.count}
+
+    @classmethod
+    def from_state(cls, state):
+        evaluator = cls(state['n_classes'], state['k'])
+        evaluator.confusion = np.asarray(state['confusion'], dtype=np.int64)
+        evaluator.top_k_correct = state['top_k_correct']
+        evaluator.loss_sum = state['loss_sum']
+        evaluator.count = state['count']
+        return evaluator
+
+    @property
+    def accuracy(self):
+        return np.trace(self.confusion) / float(max(self.count, 1))
+
+    @property
+    def top_k_accuracy(self):
+        return self.top_k_correct / float(max(self.count, 1))
+
+    @property
+    def loss(self):
+        return self.loss_sum / max(self.count, 1)
+
+    def report(self, food_list=None):
+        tp = np.diag(self.confusion).astype(np.float64)
+        predicted = self.confusion.sum(axis=0)
+        actual = self.confusion.sum(axis=1)
+        precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+        recall = np.divide(tp, actual, out=np.zeros_like(tp), where=actual > 0)
+        names = sorted(food_list) if food_list is not None else [str(c) for c in range(self.n_classes)]
+        return {'count': self.count,
+                'loss': self.loss,
+                'top1_accuracy': self.accuracy,
+                'top{}_accuracy'.format(self.k): self.top_k_accuracy,
+                'per_class': {name: {'precision': p, 'recall': r, 'support': int(s)}
+                              for name, p, r, s in zip(names, precision, recall, actual)},
+                'confusion_matrix': self.confusion.tolist()}
+
+    def save(self, path, food_list=None):
+        with open(path, 'w') as f:
+            json.dump(self.report(food_list), f)
+
+
+def iterate_batches(source, batch_size=64):
+    '''
+    (x, labels) batches of a source:
+        - a tuple (x, t) of arrays or memmaps, sliced batch_size rows at a time
+        - a keras Sequence, visited once by index (flow_from_directory needs shuffle=False)
+        - any other iterable of (x, labels, ...) tuples
+    '''
+    if isinstance(source, tuple) and len(source) == 2:
+        x, t = source
+        for b in range(0, len(x), batch_size):
+            yield np.asarray(x[b:b + batch_size], dtype=np.float32), np.asarray(t[b:b + batch_size])
+    elif isinstance(source, tf.keras.utils.Sequence):
+        for i in range(len(source)):
+            batch = source[i]
+            yield batch[0], batch[1]
+    else:
+        for batch in source:
+            yield batch[0], batch[1]
+
+
+def evaluate_stream(model, source, n_classes=None, k=5, batch_size=64, report_file=None, food_list=None):
+    '''
+    Fold the predictions of model (a keras model or any batch -> probabilities
+    function) over source into a StreamingEvaluator, optionally saved as JSON.
+    '''
+    predict = getattr(model, 'predict_on_batch', model)
+    evaluator = None
+    for x, labels in iterate_batches(source, batch_size):
+        start = time.perf_counter()
+        probs = np.asarray(predict(x))
+        PREDICT_SECONDS.observe(time.perf_counter() - start, path='evaluate')
+        PREDICT_BATCH_SIZE.observe(len(probs), path='evaluate')
+        if evaluator is None:
+            evaluator = StreamingEvaluator(n_classes or probs.shape[-1], k)
+        evaluator.update(probs, labels)
+    if evaluator is None:
+        evaluator = StreamingEvaluator(n_classes or 101, k)
+    if report_file is not None:
+        evaluator.save(report_file, food_list)
+    return evaluator
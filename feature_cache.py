@@ -0,0 +1,177 @@
+# Cached backbone embeddings for head-only training
+# The frozen InceptionV3 backbone is run once over a manifest and the pooled
+# 2048-d features are stored as a float16 memmap next to their labels. The
+# classifier head then trains on the cached features in seconds per epoch and
+# is put back on top of the original backbone as a full model.
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Input, GlobalAveragePooling2D
+from tensorflow.keras.models import Model
+from tensorflow.keras.optimizers import SGD
+from tensorflow.keras.callbacks import CSVLogger
+from tensorflow.keras.utils import to_categorical
+from utils import IMG_SIZE, ManifestSequence, load_manifest, build_model, classifier_head
+
+
+def pooled_encoder(model):
+    '''
+    Model mapping images to the pooled backbone features.
+    Accepts a bare backbone (InceptionV3 with include_top=False) or a full
+    classifier such as best_model_101class, which is cut at its pooling layer.
+    '''
+    for layer in model.layers:
+        if isinstance(layer, GlobalAveragePooling2D):
+            return Model(inputs=model.input, outputs=layer.output)
+    return Model(inputs=model.input, outputs=GlobalAveragePooling2D()(model.output))
+
+
+def extract_features(model, paths, labels, out_prefix, batch_size=64, target_size=IMG_SIZE):
+    '''
+    Run the backbone once over the images and write
+        <out_prefix>_features.npy: float16 (N, 2048) memmap
+        <out_prefix>_labels.npy: int32 (N,) class indices
+    '''
+    encoder = pooled_encoder(model)
+    images = ManifestSequence(paths, labels, batch_size, target_size=target_size)
+    features = np.lib.format.open_memmap(out_prefix + '_features.npy', mode='w+', dtype=np.float16,
+                                         shape=(len(paths), encoder.output_shape[-1]))
+    start = time.time()
+    for i in range(len(images)):
+        x, _ = images[i]
+        index = images.batch_indices(i)
+        features[index[0]:index[-1] + 1] = encoder.predict_on_batch(x)
+        if i % 100 == 0:
+            print("Extracted {}/{} batches ({:.1f}s)".format(i + 1, len(images), time.time() - start))
+    features.flush()
+    del features
+    np.save(out_prefix + '_labels.npy', np.asarray(labels, dtype=np.int32))
+    return load_features(out_prefix)
+
+
+def load_features(prefix):
+    '''Memory-map the cached features and load their labels.'''
+    features = np.load(prefix + '_features.npy', mmap_mode='r')
+    labels = np.load(prefix + '_labels.npy')
+    return features, labels
+
+
+def select_classes(features, labels, classes):
+    '''Keep the rows of the given class indices and relabel them 0..len(classes)-1.'''
+    classes = np.sort(np.asarray(classes))
+    if np.array_equal(classes, np.unique(labels)):
+        return features, labels
+    mask = np.isin(labels, classes)
+    return features[mask], np.searchsorted(classes, labels[mask]).astype(np.int32)
+
+
+class FeatureSequence(tf.keras.utils.Sequence):
+    '''
+    Shuffled (float32 features, one-hot labels) batches read from the memmap.
+    indices restricts the batches to those rows without copying the features.
+    '''
+    def __init__(self, features, labels, batch_size, n_classes, shuffle=True, indices=None):
+        self.features = features
+        self.labels = labels
+        self.batch_size = batch_size
+        self.n_classes = n_classes
+        self.shuffle = shuffle
+        self.index_array = np.arange(len(labels)) if indices is None else np.array(indices)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.index_array) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        # sorted indices keep the memmap reads sequential within a batch
+        index = np.sort(self.index_array[idx * self.batch_size:(idx + 1) * self.batch_size])
+        x = np.asarray(self.features[index], dtype=np.float32)
+        y = to_categorical(self.labels[index], self.n_classes)
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.index_array)
+
+
+def build_head(n, dim=2048, **head_kwargs):
+    '''The classifier head of build_model on its own, taking pooled features as input.'''
+    inputs = Input(shape=(dim,))
+    return Model(inputs=inputs, outputs=classifier_head(inputs, n, **head_kwargs))
+
+
+def train_head(features, labels, n, validation=None, epochs=40, batch_size=256, optimizer=None,
+               callbacks=None, **head_kwargs):
+    '''
+    Fit a fresh head on cached features.
+    validation: optional (features, labels) pair of the test split.
+    '''
+    head = build_head(n, features.shape[-1], **head_kwargs)
+    if optimizer is None:
+        optimizer = SGD(lr=0.01, momentum=0.9)
+    head.compile(optimizer=optimizer, loss='categorical_crossentropy', metrics=['accuracy'])
+    validation_data = None
+    if validation is not None:
+        validation_data = FeatureSequence(validation[0], validation[1], batch_size, n, shuffle=False)
+    history = head.fit(FeatureSequence(features, labels, batch_size, n),
+                       validation_data=validation_data,
+                       epochs=epochs,
+                       verbose=1,
+                       callbacks=callbacks)
+    return head, history
+
+
+def to_full_model(head, backbone):
+    '''
+    Put a head trained on cached features back on the original backbone.
+    The result has the same layers as build_model, so it saves and loads like best_model_101class.
+    '''
+    dense, dropout, output = head.layers[-3:]
+    full = build_model(output.units, backbone,
+                       width=dense.units,
+                       dropout=dropout.rate,
+                       l2_reg=float(output.kernel_regularizer.l2))
+    for src, dst in zip(head.layers[-3:], full.layers[-3:]):
+        dst.set_weights(src.get_weights())
+    return full
+
+
+def train_cached_head(backbone, food_list=None, cache_dir='food-101/features', epochs=40,
+                      train_meta='food-101/meta/train.txt', test_meta='food-101/meta/test.txt',
+                      image_dir='food-101/images', **head_kwargs):
+    '''
+    Extract (once) the train/test features of all classes into cache_dir,
+    train the head on the food_list subset and return the full model.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    splits = []
+    for split, meta_file in [('train', train_meta), ('test', test_meta)]:
+        prefix = os.path.join(cache_dir, split)
+        paths, labels, foods_sorted = load_manifest(meta_file, image_dir)
+        if os.path.exists(prefix + '_labels.npy'):
+            print("Using cached features {}".format(prefix))
+            splits.append(load_features(prefix))
+        else:
+            print("Caching backbone features of {} images into {}".format(len(paths), prefix))
+            splits.append(extract_features(backbone, paths, labels, prefix))
+
+    if food_list is None:
+        food_list = foods_sorted
+    classes = [foods_sorted.index(food) for food in sorted(food_list)]
+    x_train, y_train = select_classes(splits[0][0], splits[0][1], classes)
+    x_test, y_test = select_classes(splits[1][0], splits[1][1], classes)
+
+    head, history = train_head(x_train, y_train, len(classes), validation=(x_test, y_test), epochs=epochs,
+                               callbacks=[CSVLogger('history_head.log')], **head_kwargs)
+    return to_full_model(head, backbone)
+
+
+if __name__ == "__main__":
+    from tensorflow.keras.applications.inception_v3 import InceptionV3
+
+    inception = InceptionV3(weights='imagenet', include_top=False)
+    model = train_cached_head(inception)
+    model.save('head_model_101class.hdf5')
@@ -0,0 +1,207 @@
+# Loss-aware hard-example sampling for data_generator
+# Every training sample keeps a running loss. Batches are drawn with
+# probability floor / n + (1 - floor) * loss_i / sum(loss), so well learned
+# images are still seen now and then. The losses sit in an array-backed sum
+# tree: drawing a batch or updating its losses walks its log2(n) levels once,
+# vectorized over the batch, so it costs O(batch * log n) rather than the
+# O(n) of renormalizing every loss.
+# Per-sample losses come from the training step itself (a metric that keeps
+# the last batch's cross-entropy in a variable), not from an extra forward pass.
+import json
+import collections
+import numpy as np
+import tensorflow as tf
+from progressive import TimeToAccuracy
+
+
+class SumTree(object):
+    '''
+    Complete binary tree in one array: node i has children 2i and 2i+1, the
+    leaves start at capacity (the next power of two >= n) and every inner
+    node holds the sum of its children. set_all is O(n); update and sample
+    of k leaves are O(k log n), one NumPy pass over the k leaves per level.
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.capacity = 1 << max(int(np.ceil(np.log2(max(n, 1)))), 0)
+        self.depth = int(np.log2(self.capacity))
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def set_all(self, priorities):
+        self.tree[self.capacity:self.capacity + self.n] = priorities
+        for level in range(self.depth - 1, -1, -1):
+            start = 1 << level
+            self.tree[start:2 * start] = self.tree[2 * start:4 * start:2] + self.tree[2 * start + 1:4 * start:2]
+
+    def update(self, indices, priorities):
+        nodes = np.asarray(indices) + self.capacity
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, k, rng=np.random):
+        '''k leaf indices, each drawn with probability priority / total.'''
+        values = rng.uniform(0., self.total, size=k)
+        nodes = np.ones(k, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = np.where(go_right, left + 1, left)
+        # float rounding can step onto an empty padding leaf
+        return np.minimum(nodes - self.capacity, self.n - 1)
+
+
+class HardExampleSampler(object):
+    '''
+    Draws batches of sample indices from running per-sample losses.
+        floor     share of each batch's probability spread uniformly over all samples
+        momentum  running loss = momentum * old + (1 - momentum) * new
+        alpha     priority = running loss ** alpha (0 gives uniform sampling)
+    Every sample starts at init_loss (log(n_classes) is the loss of a uniform
+    guess), so unseen samples are not starved early on. Drawn batches wait in
+    a FIFO until their losses come back from the training step, however far
+    the input pipeline runs ahead. With tags (one int per sample, e.g. its
+    class) a trained batch is matched by the tags of its samples, and the
+    batches drawn before it that never reached the model (dropped with a
+    prefetch queue at the end of fit) are discarded; without tags, losses are
+    matched in drawing order.
+    '''
+    def __init__(self, n, floor=0.2, momentum=0.5, alpha=1., init_loss=np.log(101), seed=None, tags=None):
+        self.n = n
+        self.floor = floor
+        self.momentum = momentum
+        self.alpha = alpha
+        self.rng = np.random.RandomState(seed)
+        self.losses = np.full(n, init_loss, dtype=np.float32)
+        self.tree = SumTree(n)
+        self.tree.set_all(self.losses.astype(np.float64) ** alpha)
+        self.pending = collections.deque()
+        self.tags = None if tags is None else np.asarray(tags)
+
+    def draw(self, batch_size):
+        uniform = self.rng.uniform(size=batch_size) < self.floor
+        indices = self.tree.sample(batch_size, self.rng)
+        indices[uniform] = self.rng.randint(0, self.n, size=int(uniform.sum()))
+        self.pending.append(indices)
+        return indices
+
+    def match(self, batch_tags):
+        '''Position in the FIFO of the oldest drawn batch with these tags, or None.'''
+        batch_tags = np.asarray(batch_tags)
+        for position, indices in enumerate(self.pending):
+            if np.array_equal(self.tags[indices], batch_tags[:len(indices)]):
+                return position
+        return None
+
+    def update(self, batch_losses, batch_tags=None):
+        '''
+        Losses of a trained batch: the one with batch_tags (padded like the
+        losses), or the oldest drawn batch that has not been updated yet.
+        '''
+        position = 0 if batch_tags is None or self.tags is None else self.match(batch_tags)
+        if not self.pending or position is None:
+            return
+        for _ in range(position):
+            self.pending.popleft()
+        indices = self.pending.popleft()
+        batch_losses = np.asarray(batch_losses, dtype=np.float32)[:len(indices)]
+        # a sample drawn twice in one batch keeps its last loss
+        self.losses[indices] = self.momentum * self.losses[indices] + (1 - self.momentum) * batch_losses
+        unique = np.unique(indices)
+        self.tree.update(unique, self.losses[unique].astype(np.float64) ** self.alpha)
+
+    def probabilities(self):
+        return self.floor / self.n + (1 - self.floor) * self.tree.tree[self.tree.capacity:][:self.n] / self.tree.total
+
+
+class SampleLoss(tf.keras.metrics.Metric):
+    '''
+    Keeps the per-sample cross-entropy and the true class of the last training
+    batch in variables (padded with 0 and -1); its result is the batch mean.
+    batch_size must match the generator's batches.
+    '''
+    def __init__(self, batch_size, name='sample_loss', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.batch_size = batch_size
+        self.values = self.add_weight('values', shape=(batch_size,), initializer='zeros')
+        self.labels = self.add_weight('labels', shape=(batch_size,), dtype=tf.int32, initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        loss = tf.keras.losses.categorical_crossentropy(y_true, y_pred)
+        padding = [[0, self.batch_size - tf.shape(loss)[0]]]
+        self.values.assign(tf.pad(loss, padding))
+        self.labels.assign(tf.pad(tf.argmax(y_true, axis=-1, output_type=tf.int32), padding, constant_values=-1))
+
+    def result(self):
+        return tf.reduce_mean(self.values)
+
+    def reset_state(self):
+        self.values.assign(tf.zeros_like(self.values))
+
+
+class HardExampleCallback(tf.keras.callbacks.Callback):
+    '''
+    Feeds the SampleLoss values of every training step back to the sampler,
+    matched to their drawn batch by the true classes of its samples.
+    '''
+    def __init__(self, sampler, metric):
+        super().__init__()
+        self.sampler = sampler
+        self.metric = metric
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.sampler.update(self.metric.values.numpy(), self.metric.labels.numpy())
+
+
+def hard_example_generator(x_train, y_train, batch_size, data_aug=False, floor=0.2, **sampler_kwargs):
+    '''
+    data_generator driven by a HardExampleSampler. Compile with the returned
+    metric and fit with the returned callback:
+        generator, metric, callback = hard_example_generator(x_train, y_train, 32)
+        model.compile(optimizer, 'categorical_crossentropy', metrics=['accuracy', metric])
+        model.fit(generator, steps_per_epoch=len(x_train) // 32, callbacks=[callback])
+    Batches are tagged with the classes of y_train, so any input queue or
+    metrics.prefetch in between is fine.
+    '''
+    from utils import data_generator
+    sampler = HardExampleSampler(len(x_train), floor, tags=np.asarray(y_train).argmax(axis=1), **sampler_kwargs)
+    metric = SampleLoss(batch_size)
+    return data_generator(x_train, y_train, batch_size, data_aug, sampler), metric, HardExampleCallback(sampler, metric)
+
+
+def compare_time_to_accuracy(build_fn, x_train, y_train, validation_data, target, batch_size=32, epochs=20,
+                             data_aug=False, floor=0.2, optimizer_fn=None, report_file='hard_examples_report.json',
+                             **fit_kwargs):
+    '''
+    Train a fresh build_fn() model with uniform data_generator batches and
+    another with hard-example batches, each until val_accuracy reaches target,
+    and report the time-to-target of both.
+    '''
+    from utils import data_generator
+    optimizer_fn = optimizer_fn or (lambda: tf.keras.optimizers.SGD(lr=0.0001, momentum=0.9))
+    steps = len(x_train) // batch_size
+    report = {}
+    for name in ['uniform', 'hard_examples']:
+        timer = TimeToAccuracy(target, stop=True)
+        model = build_fn()
+        if name == 'uniform':
+            generator, metrics, callbacks = data_generator(x_train, y_train, batch_size, data_aug), ['accuracy'], [timer]
+        else:
+            generator, metric, callback = hard_example_generator(x_train, y_train, batch_size, data_aug, floor)
+            metrics, callbacks = ['accuracy', metric], [callback, timer]
+        model.compile(optimizer=optimizer_fn(), loss='categorical_crossentropy', metrics=metrics)
+        model.fit(generator, steps_per_epoch=steps, epochs=epochs, validation_data=validation_data,
+                  callbacks=callbacks, **fit_kwargs)
+        report[name] = {'seconds': timer.seconds, 'epochs': None if timer.epoch is None else timer.epoch + 1}
+    if report['uniform']['seconds'] and report['hard_examples']['seconds']:
+        report['speedup'] = report['uniform']['seconds'] / report['hard_examples']['seconds']
+    with open(report_file, 'w') as f:
+        json.dump(report, f)
+    print(report)
+    return report
@@ -0,0 +1,314 @@
+# Peak-memory accounting per pipeline stage
+# Stages (functions decorated with @track, or `with stage(name)`) record the
+# RSS and the tracemalloc peak (NumPy reports its array buffers to
+# tracemalloc) between entry and exit, the largest allocations alive at the
+# peak and still held at exit, and fail a per-stage budget. Allocations are
+# attributed to the innermost line of this repo in their traceback, so an
+# np.stack in load_data is reported at load_data's line rather than in NumPy.
+# The peak allocations come from a snapshot taken by a sampling thread when
+# traced memory reaches a new high, so arrays freed before the stage exits
+# still show up. phase(name) splits a long stage into consecutive parts
+# without re-indenting it. Off by default: enable() starts tracemalloc, which
+# slows allocation-heavy code down noticeably.
+#     memory.enable({'load_data': 4096, 'pseudo_labelling': 8192})   # MB
+#     ...
+#     memory.report()
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+MB = 1024. * 1024.
+ENABLED = False
+BUDGETS = {}
+FAIL = True
+RECORDS = {}
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_local = threading.local()
+_rss = None
+_peaks = None
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def rss_bytes():
+    '''Resident set size of this process.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        # ru_maxrss is the lifetime peak (KB on Linux, bytes on macOS): only an upper bound
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRSS(object):
+    '''Samples the RSS every interval seconds and keeps the peak since the last take().'''
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self.stop = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def take(self):
+        current = rss_bytes()
+        peak, self.peak = max(self.peak, current), current
+        return peak
+
+
+class PeakSnapshot(object):
+    '''
+    Samples the traced memory every interval seconds and takes a tracemalloc
+    snapshot at each new high since the last take(): once it has grown by
+    min_bytes, then by min_growth of the growth so far, so a stage allocating
+    gigabytes takes a few dozen snapshots. The last one holds the allocations
+    alive near the peak, even those freed before the stage exits.
+    '''
+    def __init__(self, interval=0.01, min_bytes=1024 * 1024, min_growth=0.1):
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.min_growth = min_growth
+        self.base = self.level = tracemalloc.get_traced_memory()[0]
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            if not tracemalloc.is_tracing():
+                continue
+            current = tracemalloc.get_traced_memory()[0]
+            if current > self.level + max(self.min_bytes, self.min_growth * (self.level - self.base)):
+                snapshot = _snapshot()
+                with self.lock:
+                    self.level, self.snapshot = current, snapshot
+
+    def take(self):
+        '''(level, snapshot) of the highest sample since the last take(), snapshot None if there was none.'''
+        with self.lock:
+            taken = self.level, self.snapshot
+            self.base = self.level = tracemalloc.get_traced_memory()[0]
+            self.snapshot = None
+        return taken
+
+
+def enable(budgets=None, fail=True, rss_interval=0.01, frames=25):
+    '''
+    Start accounting. budgets: {stage: MB} or the path of such a JSON file,
+    checked against the tracemalloc peak above the stage's entry level;
+    fail=False prints a warning instead of raising MemoryBudgetExceeded.
+    frames: traceback depth kept per allocation, deep enough to get from
+    NumPy/PIL/TF internals back to the calling line of this repo.
+    Needs Python 3.9+ (tracemalloc.reset_peak).
+    '''
+    global ENABLED, FAIL, _rss, _peaks
+    if isinstance(budgets, str):
+        with open(budgets) as f:
+            budgets = json.load(f)
+    BUDGETS.update(budgets or {})
+    FAIL = fail
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    if _rss is None:
+        _rss = PeakRSS(rss_interval)
+    if _peaks is None:
+        _peaks = PeakSnapshot(rss_interval)
+    ENABLED = True
+
+
+def disable():
+    global ENABLED, _rss, _peaks
+    ENABLED = False
+    if _rss is not None:
+        _rss.stop.set()
+        _rss = None
+    if _peaks is not None:
+        _peaks.stop.set()
+        _peaks = None
+    tracemalloc.stop()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _flush():
+    '''Fold the global peaks since the last event into every open frame, then reset them.'''
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    rss_peak = _rss.take()
+    peak_level, peak_snapshot = _peaks.take()
+    for frame in _stack():
+        frame['traced_peak'] = max(frame['traced_peak'], traced_peak)
+        frame['rss_peak'] = max(frame['rss_peak'], rss_peak)
+        if peak_snapshot is not None and peak_level > frame['peak_level']:
+            frame['peak_level'], frame['peak_snapshot'] = peak_level, peak_snapshot
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                      tracemalloc.Filter(False, __file__)])
+
+
+def _repo_line(traceback):
+    '''file:line of the innermost frame of traceback in this repo (but not this file), or None.'''
+    for frame in reversed(traceback):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(REPO_DIR + os.sep) and filename != os.path.abspath(__file__):
+            return '{}:{}'.format(os.path.relpath(filename, REPO_DIR), frame.lineno)
+    return None
+
+
+def _by_repo_line(snapshot):
+    sizes = {}
+    for statistic in snapshot.statistics('traceback'):
+        where = _repo_line(statistic.traceback)
+        if where is not None:
+            size, count = sizes.get(where, (0, 0))
+            sizes[where] = (size + statistic.size, count + statistic.count)
+    return sizes
+
+
+def _largest(snapshot, base, top):
+    '''The top repo lines by bytes allocated in snapshot beyond base.'''
+    before = _by_repo_line(base)
+    diff = []
+    for where, (size, count) in _by_repo_line(snapshot).items():
+        base_size, base_count = before.get(where, (0, 0))
+        if size > base_size:
+            diff.append({'where': where, 'mb': (size - base_size) / MB, 'blocks': count - base_count})
+    return sorted(diff, key=lambda d: -d['mb'])[:top]
+
+
+def _open(name, phase=False):
+    _flush()
+    traced = tracemalloc.get_traced_memory()[0]
+    rss = rss_bytes()
+    _stack().append({'name': name, 'phase': phase, 'start': time.time(),
+                     'traced_start': traced, 'traced_peak': traced,
+                     'rss_start': rss, 'rss_peak': rss,
+                     'snapshot': _snapshot(), 'peak_level': traced, 'peak_snapshot': None})
+
+
+def _close(top=5):
+    _flush()
+    frame = _stack().pop()
+    traced = tracemalloc.get_traced_memory()[0]
+    held = _largest(_snapshot(), frame['snapshot'], top)
+    at_peak = [] if frame['peak_snapshot'] is None else _largest(frame['peak_snapshot'], frame['snapshot'], top)
+    call = {'seconds': time.time() - frame['start'],
+            'peak_mb': (frame['traced_peak'] - frame['traced_start']) / MB,
+            'held_mb': (traced - frame['traced_start']) / MB,
+            'rss_peak_mb': frame['rss_peak'] / MB,
+            'rss_growth_mb': (frame['rss_peak'] - frame['rss_start']) / MB,
+            'largest_at_peak': at_peak,
+            'largest_held': held}
+
+    record = RECORDS.setdefault(frame['name'], {'calls': 0, 'seconds': 0., 'peak_mb': 0.})
+    record['calls'] += 1
+    record['seconds'] += call['seconds']
+    if record['calls'] == 1 or call['peak_mb'] >= record['peak_mb']:
+        # keep the details of the worst call
+        record.update(call, seconds=record['seconds'])
+
+    budget = BUDGETS.get(frame['name'])
+    if budget is not None and call['peak_mb'] > budget:
+        message = "Stage {} peaked at {:.0f} MB above its entry level, budget {:.0f} MB".format(
+            frame['name'], call['peak_mb'], budget)
+        if FAIL:
+            raise MemoryBudgetExceeded(message)
+        print("WARNING: " + message)
+
+
+def _current_stage():
+    stack = _stack()
+    if stack and stack[-1]['phase']:
+        return stack[-2]['name']
+    return stack[-1]['name'] if stack else None
+
+
+@contextmanager
+def stage(name):
+    if not ENABLED:
+        yield
+        return
+    _open(name)
+    try:
+        yield
+    finally:
+        try:
+            if _stack()[-1]['phase']:
+                _close()
+        finally:
+            _close()
+
+
+def phase(name):
+    '''Close the current phase of the enclosing stage (if any) and open <stage>/<name>.'''
+    if not ENABLED or not _stack():
+        return
+    parent = _current_stage()
+    if _stack()[-1]['phase']:
+        _close()
+    _open('{}/{}'.format(parent, name), phase=True)
+
+
+def track(fn=None, name=None):
+    '''
+    Decorator making every call of fn a stage named after it. For a generator
+    function every produced item is its own call (e.g. one batch of data_generator).
+    '''
+    if fn is None:
+        return lambda fn: track(fn, name)
+    name = name or fn.__name__
+
+    if inspect.isgeneratorfunction(fn):
+        def tracked(generator):
+            while True:
+                with stage(name):
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                yield item
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            generator = fn(*args, **kwargs)
+            return tracked(generator) if ENABLED else generator
+        return wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def report(path='memory_report.json'):
+    '''Print the stages by peak and save them to path.'''
+    for name, record in sorted(RECORDS.items(), key=lambda item: -item[1]['peak_mb']):
+        print("{:40s} calls {:6d}  peak +{:8.1f} MB  held +{:8.1f} MB  RSS peak {:8.1f} MB".format(
+            name, record['calls'], record['peak_mb'], record['held_mb'], record['rss_peak_mb']))
+        for label in ['largest_at_peak', 'largest_held']:
+            for allocation in record[label]:
+                print("    {} {where}: {mb:.1f} MB in {blocks} blocks".format(
+                    'peak' if label == 'largest_at_peak' else 'held', **allocation))
+    if path:
+        with open(path, 'w') as f:
+            json.dump(RECORDS, f, indent=1)
+    return RECORDS
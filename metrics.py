@@ -0,0 +1,239 @@
+# Live metrics for the input pipeline and the inference path
+# An in-process registry of counters, gauges and histograms, served in the
+# Prometheus text exposition format on a local port and dumped to a JSON file
+# at a fixed interval. An update is a dict lookup, a lock and an add, so the
+# instrumentation in rand_augmentation, utils and evaluation stays on.
+#     metrics.start_http_server(9100)       # curl localhost:9100/metrics
+#     metrics.start_json_dump('metrics.json', 30)
+import os
+import json
+import time
+import queue
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+class Metric(object):
+    '''One metric family: a value per combination of label values.'''
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def label_text(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + self.label_text(key), value) for key, value in sorted(self.values.items())]
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(zip(self.labelnames, key), value=value) for key, value in sorted(self.values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    '''Cumulative buckets plus sum and count, as Prometheus expects.'''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0., 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append((self.name + '_bucket' + self.label_text(key, ('le', le)), cumulative))
+                lines.append((self.name + '_sum' + self.label_text(key), total))
+                lines.append((self.name + '_count' + self.label_text(key), count))
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(zip(self.labelnames, key), count=count, sum=total,
+                         mean=total / count if count else 0., buckets=dict(zip(map(str, self.buckets + ('+Inf',)), counts)))
+                    for key, (counts, total, count) in sorted(self.values.items())]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, cls, name, documentation, labelnames=(), **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return self.metrics[name]
+
+    def exposition(self):
+        '''The Prometheus text format (version 0.0.4).'''
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda m: m.name):
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend('{} {}'.format(name, value) for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {'time': time.time(),
+                'metrics': {m.name: {'type': m.kind, 'help': m.documentation, 'values': m.snapshot()}
+                            for m in self.metrics.values()}}
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.get_or_create(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+# The metrics of the input pipeline and the inference path
+AUGMENT_OP_SECONDS = histogram('rand_augment_op_seconds', 'Latency of one Rand_Augment operation', ['op'])
+IMAGES_DECODED = counter('images_decoded_total', 'Images read from disk and decoded by utils.load_image_batch')
+DECODE_SECONDS = histogram('image_decode_seconds', 'Latency of reading and resizing one image')
+BATCH_SECONDS = histogram('batch_assembly_seconds', 'Time to assemble one training/evaluation batch', ['source'])
+QUEUE_DEPTH = gauge('generator_queue_depth', 'Batches waiting in a prefetch queue', ['source'])
+PREDICT_BATCH_SIZE = histogram('prediction_batch_size', 'Images per prediction call', ['path'], SIZE_BUCKETS)
+PREDICT_SECONDS = histogram('prediction_seconds', 'Latency of one prediction call', ['path'])
+
+
+def prefetch(generator, max_queue_size=10, source='train'):
+    '''
+    Batches of generator produced by a background thread into a bounded
+    queue whose depth is exported as generator_queue_depth: near 0 means the
+    consumer waits for input, near max_queue_size means input keeps up.
+    A Sequence (anything with __len__ and __getitem__) is cycled over
+    forever, calling its on_epoch_end between passes, as fit does. An
+    exception raised by the source is re-raised in the consumer.
+    '''
+    batches = queue.Queue(max_queue_size)
+    done = object()
+
+    class Failed(object):
+        def __init__(self, error):
+            self.error = error
+
+    def produce():
+        try:
+            if hasattr(generator, '__len__') and hasattr(generator, '__getitem__'):
+                while True:
+                    for i in range(len(generator)):
+                        batches.put(generator[i])
+                    if hasattr(generator, 'on_epoch_end'):
+                        generator.on_epoch_end()
+            for batch in generator:
+                batches.put(batch)
+        except Exception as e:
+            batches.put(Failed(e))
+            return
+        batches.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        QUEUE_DEPTH.set(batches.qsize(), source=source)
+        batch = batches.get()
+        if batch is done:
+            return
+        if isinstance(batch, Failed):
+            raise batch.error
+        yield batch
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port=9100, addr='127.0.0.1', registry=REGISTRY):
+    '''Serve registry.exposition() on http://addr:port/metrics from a daemon thread.'''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_json(path, registry=REGISTRY):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def start_json_dump(path='metrics.json', interval=30, registry=REGISTRY):
+    '''Rewrite path with a registry snapshot every interval seconds; set the returned event to stop.'''
+    stop = threading.Event()
+
+    def dump():
+        while not stop.wait(interval):
+            write_json(path, registry)
+        write_json(path, registry)
+
+    threading.Thread(target=dump, daemon=True).start()
+    return stop
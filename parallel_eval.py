@@ -0,0 +1,115 @@
+# Parallel sharded evaluation across model replicas
+# N worker processes each load the model once and score a disjoint shard of
+# the test manifest. Workers send back StreamingEvaluator counters (a partial
+# confusion matrix), never predictions, and the parent merges them into one
+# report with per-worker throughput and the scaling efficiency.
+#     python parallel_eval.py 8
+import os
+import sys
+import json
+import time
+import queue as queue_module
+import multiprocessing as mp
+
+
+def worker_main(index, model_path, paths, labels, n_classes, batch_size, threads, n_workers, queue):
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+    from utils import ManifestSequence, apply_threading_config
+    from evaluation import evaluate_stream
+
+    # the tuned thread counts only hold for as many replicas as they were tuned with
+    if apply_threading_config(replicas=n_workers) is None:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    start = time.time()
+    model = load_model(model_path, compile=False)
+    load_seconds = time.time() - start
+
+    start = time.time()
+    evaluator = evaluate_stream(model, ManifestSequence(paths, labels, batch_size, n_classes), n_classes)
+    seconds = time.time() - start
+    queue.put({'worker': index, 'state': evaluator.state(), 'images': len(paths),
+               'seconds': seconds, 'load_seconds': load_seconds, 'images_per_s': len(paths) / seconds})
+
+
+def run_workers(model_path, paths, labels, n_classes, n_workers, batch_size=32):
+    '''
+    Score paths split into n_workers strided shards, one spawned process per
+    shard. Raises RuntimeError naming the shard if a worker dies before reporting.
+    '''
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    workers = [ctx.Process(target=worker_main,
+                           args=(i, model_path, paths[i::n_workers], labels[i::n_workers], n_classes,
+                                 batch_size, threads, n_workers, queue))
+               for i in range(n_workers)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    results = {}
+    try:
+        while len(results) < len(workers):
+            try:
+                result = queue.get(timeout=1.)
+                results[result['worker']] = result
+            except queue_module.Empty:
+                for i, w in enumerate(workers):
+                    if i not in results and w.exitcode not in (None, 0):
+                        raise RuntimeError("Worker {} (shard {} of {}, {} images) exited with code {}".format(
+                            w.pid, i, n_workers, len(paths[i::n_workers]), w.exitcode))
+    finally:
+        for w in workers:
+            if len(results) < len(workers) and w.is_alive():
+                w.terminate()
+            w.join()
+    return [results[i] for i in sorted(results)], time.time() - start
+
+
+def parallel_evaluate(model_path='best_model_101class.hdf5', n_workers=4, test_meta='food-101/meta/test.txt',
+                      image_dir='food-101/images', batch_size=32, baseline_images=512,
+                      report_file='parallel_eval_report.json'):
+    '''
+    Evaluate model_path on the test manifest with n_workers replicas and write
+    the merged report. Scaling efficiency compares the aggregate images/s with
+    n_workers times the images/s of a single replica scoring baseline_images alone.
+    '''
+    from utils import load_manifest
+    from evaluation import StreamingEvaluator
+
+    paths, labels, food_list = load_manifest(test_meta, image_dir)
+    n_classes = len(food_list)
+
+    baseline, _ = run_workers(model_path, paths[:baseline_images], labels[:baseline_images], n_classes, 1, batch_size)
+    single_ips = baseline[0]['images_per_s']
+
+    results, wall_seconds = run_workers(model_path, paths, labels, n_classes, n_workers, batch_size)
+    evaluator = StreamingEvaluator.from_state(results[0]['state'])
+    for r in results[1:]:
+        evaluator.merge(StreamingEvaluator.from_state(r['state']))
+
+    # the slowest shard bounds the wall time of the scoring itself
+    aggregate_ips = len(paths) / max(r['seconds'] for r in results)
+    report = evaluator.report(food_list)
+    report['workers'] = [{k: r[k] for k in ['worker', 'images', 'seconds', 'load_seconds', 'images_per_s']}
+                         for r in results]
+    report['throughput'] = {'n_workers': n_workers,
+                            'single_replica_images_per_s': single_ips,
+                            'aggregate_images_per_s': aggregate_ips,
+                            'scaling_efficiency': aggregate_ips / (n_workers * single_ips),
+                            'wall_seconds': wall_seconds}
+    with open(report_file, 'w') as f:
+        json.dump(report, f)
+
+    for r in report['workers']:
+        print("worker {worker}: {images} images in {seconds:.0f}s ({images_per_s:.1f} img/s, "
+              "model loaded in {load_seconds:.1f}s)".format(**r))
+    print("top-1 {:.4f}  top-5 {:.4f}  {aggregate_images_per_s:.1f} img/s, "
+          "scaling efficiency {scaling_efficiency:.2f}".format(report['top1_accuracy'], report['top5_accuracy'],
+                                                              **report['throughput']))
+    return report
+
+
+if __name__ == "__main__":
+    parallel_evaluate(n_workers=int(sys.argv[1]) if len(sys.argv) > 1 else 4)
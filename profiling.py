@@ -0,0 +1,200 @@
+# Step-time breakdown: input vs compute vs callbacks
+# StepTimer wraps the usual callbacks (CSVLogger, ModelCheckpoint, ...) and
+# times them, while TimedSequence / timed_generator time the data source.
+# Every step is written to a JSON-lines log next to history.log, followed by
+# per-epoch percentiles; a tf.profiler trace can cover a chosen step range.
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+PERCENTILES = [50, 90, 99]
+
+
+class InputTimer(object):
+    '''Seconds spent producing batches since the last take().'''
+    def __init__(self):
+        self.seconds = 0.
+        self.batches = 0
+
+    def add(self, seconds):
+        self.seconds += seconds
+        self.batches += 1
+
+    def take(self):
+        seconds, self.seconds, self.batches = self.seconds, 0., 0
+        return seconds
+
+
+class TimedSequence(tf.keras.utils.Sequence):
+    '''A keras Sequence (ManifestSequence, flow_from_directory) whose __getitem__ is timed.'''
+    def __init__(self, sequence, timer):
+        self.sequence = sequence
+        self.timer = timer
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        start = time.perf_counter()
+        batch = self.sequence[idx]
+        self.timer.add(time.perf_counter() - start)
+        return batch
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+
+def timed_generator(generator, timer):
+    '''A python generator (utils.data_generator) whose next() is timed.'''
+    while True:
+        start = time.perf_counter()
+        batch = next(generator)
+        timer.add(time.perf_counter() - start)
+        yield batch
+
+
+def summarize(values):
+    values = np.asarray(values)
+    summary = {'mean': float(values.mean()), 'total': float(values.sum())}
+    for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary['p{}'.format(p)] = float(v)
+    return summary
+
+
+class StepTimer(tf.keras.callbacks.Callback):
+    '''
+    Per-step breakdown written to log_file as JSON lines:
+        step_s     from the end of the previous step to the end of this one
+        input_s    time the instrumented data source spent on this step's batch
+        compute_s  time inside the train step (forward/backward, plus any wait
+                   for a batch that was not prefetched yet)
+        callbacks  seconds per wrapped callback (ModelCheckpoint, CSVLogger, ...)
+    Fit with workers=0: the batch is then fetched synchronously, so input_s is
+    exactly the trainer's input wait and is not included in compute_s. With
+    fit's default workers=1 the source runs a batch ahead and input_s is the
+    producer time that overlapped compute. To time the wait on a prefetched
+    source (metrics.prefetch), instrument the prefetching generator.
+    Each epoch ends with a summary line of percentiles, including the
+    epoch-end callbacks (where ModelCheckpoint saves).
+    trace_steps=(first, last) records a tf.profiler trace of those global steps.
+    '''
+    def __init__(self, callbacks=None, input_timer=None, log_file='steps.log', trace_steps=None,
+                 trace_dir='logs/trace'):
+        super().__init__()
+        self.callbacks = list(callbacks or [])
+        self.input_timer = input_timer
+        self.log_file = log_file
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.global_step = 0
+        self._tracing = False
+        self._log = None
+
+    def set_model(self, model):
+        super().set_model(model)
+        for callback in self.callbacks:
+            callback.set_model(model)
+
+    def set_params(self, params):
+        super().set_params(params)
+        for callback in self.callbacks:
+            callback.set_params(params)
+
+    def _forward(self, hook, *args):
+        seconds = {}
+        for callback in self.callbacks:
+            start = time.perf_counter()
+            getattr(callback, hook)(*args)
+            name = callback.__class__.__name__
+            seconds[name] = seconds.get(name, 0.) + time.perf_counter() - start
+        return seconds
+
+    def _write(self, record):
+        self._log.write(json.dumps(record) + '\n')
+
+    def on_train_begin(self, logs=None):
+        self._log = open(self.log_file, 'a')
+        self._forward('on_train_begin', logs)
+        self._last_end = time.perf_counter()
+
+    def on_train_end(self, logs=None):
+        self._forward('on_train_end', logs)
+        if self._tracing:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+        self._log.close()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.steps = []
+        if self.input_timer is not None:
+            self.input_timer.take()
+        self._forward('on_epoch_begin', epoch, logs)
+        self._last_end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_callbacks = self._forward('on_epoch_end', epoch, logs)
+        if not self.steps:
+            return
+        summary = {'epoch': epoch, 'summary': True, 'steps': len(self.steps), 'epoch_callbacks': epoch_callbacks}
+        for key in ['step_s', 'input_s', 'compute_s', 'callbacks_s']:
+            summary[key] = summarize([s[key] for s in self.steps])
+        self._write(summary)
+        self._log.flush()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.trace_steps and self.global_step == self.trace_steps[0] and not self._tracing:
+            tf.profiler.experimental.start(self.trace_dir)
+            self._tracing = True
+        callbacks = self._forward('on_train_batch_begin', batch, logs)
+        self._callbacks = callbacks
+        self._compute_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        compute_end = time.perf_counter()
+        callbacks = self._forward('on_train_batch_end', batch, logs)
+        for name, seconds in self._callbacks.items():
+            callbacks[name] = callbacks.get(name, 0.) + seconds
+        end = time.perf_counter()
+
+        record = {'epoch': self.epoch, 'step': batch, 'global_step': self.global_step,
+                  'step_s': end - self._last_end,
+                  'input_s': self.input_timer.take() if self.input_timer is not None else 0.,
+                  'compute_s': compute_end - self._compute_start,
+                  'callbacks_s': sum(callbacks.values()),
+                  'callbacks': callbacks}
+        self.steps.append(record)
+        self._write(record)
+        self._last_end = end
+
+        if self._tracing and self.global_step >= self.trace_steps[1]:
+            tf.profiler.experimental.stop()
+            self._tracing = False
+        self.global_step += 1
+
+    def on_test_begin(self, logs=None):
+        self._forward('on_test_begin', logs)
+
+    def on_test_end(self, logs=None):
+        self._forward('on_test_end', logs)
+
+    def on_test_batch_begin(self, batch, logs=None):
+        self._forward('on_test_batch_begin', batch, logs)
+
+    def on_test_batch_end(self, batch, logs=None):
+        self._forward('on_test_batch_end', batch, logs)
+
+
+def instrument(generator, callbacks=None, **kwargs):
+    '''
+    Timed version of a training data source and a StepTimer wrapping callbacks:
+        generator, callbacks = instrument(train_generator, [csv_logger, checkpointer])
+        model.fit(generator, ..., callbacks=callbacks, workers=0)
+    '''
+    timer = InputTimer()
+    if isinstance(generator, tf.keras.utils.Sequence):
+        timed = TimedSequence(generator, timer)
+    else:
+        timed = timed_generator(generator, timer)
+    return timed, [StepTimer(callbacks, timer, **kwargs)]
@@ -0,0 +1,104 @@
+# Progressive-resizing training schedule
+# Early epochs train at a lower resolution with a larger batch and the schedule
+# steps up to the full IMG_SIZE for the final epochs. The generators are
+# rebuilt at each stage's size and the learning rate follows the batch size.
+import time
+import tensorflow as tf
+import tensorflow.keras.backend as K
+from utils import IMG_SIZE
+
+# (epochs, image size, batch size) per stage
+DEFAULT_SCHEDULE = [(10, 160, 32), (14, 224, 16), (16, IMG_SIZE[0], 8)]
+
+
+class TimeToAccuracy(tf.keras.callbacks.Callback):
+    '''Wall-clock seconds from the start of training until monitor first reaches target.'''
+    def __init__(self, target, monitor='val_accuracy', stop=False):
+        super().__init__()
+        self.target = target
+        self.monitor = monitor
+        self.stop = stop
+        self.start = None
+        self.seconds = None
+        self.epoch = None
+
+    def on_train_begin(self, logs=None):
+        if self.start is None:
+            self.start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.seconds is None and (logs or {}).get(self.monitor, -1) >= self.target:
+            self.seconds = time.time() - self.start
+            self.epoch = epoch
+            print("\n{} reached {} after {:.0f}s (epoch {})".format(self.monitor, self.target, self.seconds, epoch + 1))
+            if self.stop:
+                self.model.stop_training = True
+
+
+def scaled_lr(base_lr, base_batch_size, batch_size, scaling='linear'):
+    '''Learning rate for batch_size: linear scaling for SGD, sqrt scaling is gentler for Adam.'''
+    ratio = float(batch_size) / base_batch_size
+    return base_lr * (ratio if scaling == 'linear' else ratio ** 0.5)
+
+
+def progressive_fit(model, train_datagen, test_datagen, train_data_dir, validation_data_dir,
+                    schedule=DEFAULT_SCHEDULE, base_lr=0.0001, base_batch_size=8, lr_scaling='linear',
+                    callbacks=None, **fit_kwargs):
+    '''
+    Train model (compiled, variable input size) through the stages of schedule.
+    Each stage gets flow_from_directory generators at its size and batch size and
+    the learning rate scaled from base_lr at base_batch_size. Callbacks persist
+    across stages; the returned History holds all epochs.
+    '''
+    history = None
+    epoch = 0
+    for epochs, size, batch_size in schedule:
+        train_generator = train_datagen.flow_from_directory(
+            train_data_dir,
+            target_size=(size, size),
+            batch_size=batch_size,
+            class_mode='categorical')
+        validation_generator = test_datagen.flow_from_directory(
+            validation_data_dir,
+            target_size=(size, size),
+            batch_size=batch_size,
+            class_mode='categorical')
+        lr = scaled_lr(base_lr, base_batch_size, batch_size, lr_scaling)
+        K.set_value(model.optimizer.lr, lr)
+        print("Stage: {} epochs at {}x{}, batch size {}, learning rate {:g}".format(epochs, size, size, batch_size, lr))
+
+        stage = model.fit(train_generator,
+                          validation_data=validation_generator,
+                          initial_epoch=epoch,
+                          epochs=epoch + epochs,
+                          callbacks=callbacks,
+                          **fit_kwargs)
+        epoch += epochs
+        if history is None:
+            history = stage
+        else:
+            for key, values in stage.history.items():
+                history.history.setdefault(key, []).extend(values)
+        if model.stop_training:
+            break
+    return history
+
+
+def compare_time_to_accuracy(build_fn, train_datagen, test_datagen, train_data_dir, validation_data_dir,
+                             target, schedule=DEFAULT_SCHEDULE, base_lr=0.0001, base_batch_size=8, **fit_kwargs):
+    '''
+    Train a fresh build_fn() model with the fixed full-resolution schedule and
+    another with schedule, each until val_accuracy reaches target, and report
+    the time-to-target of both.
+    '''
+    total_epochs = sum(stage[0] for stage in schedule)
+    report = {}
+    for name, stages in [('fixed', [(total_epochs, IMG_SIZE[0], base_batch_size)]), ('progressive', schedule)]:
+        timer = TimeToAccuracy(target, stop=True)
+        progressive_fit(build_fn(), train_datagen, test_datagen, train_data_dir, validation_data_dir,
+                        stages, base_lr, base_batch_size, callbacks=[timer], **fit_kwargs)
+        report[name] = {'seconds': timer.seconds, 'epochs': None if timer.epoch is None else timer.epoch + 1}
+    if report['fixed']['seconds'] and report['progressive']['seconds']:
+        report['speedup'] = report['fixed']['seconds'] / report['progressive']['seconds']
+    print(report)
+    return report
@@ -0,0 +1,161 @@
+# Structured filter pruning of the InceptionV3 backbone
+# Only convolutions inside a chain are pruned (the stem and the inner convs of
+# each Inception branch): a Conv2D whose output, through its
+# BatchNormalization/Activation, feeds exactly one other Conv2D. Dropping
+# output filters there shrinks that conv, its BN and the input channels of
+# the next conv, while every concatenated block output keeps its width, so
+# the head and the prediction path are unchanged. The pruned model is rebuilt
+# from the edited config with dense, smaller kernels.
+#     python prune.py
+import os
+import json
+import numpy as np
+from tensorflow.keras.layers import Activation, BatchNormalization, Conv2D, Dense, ReLU
+from tensorflow.keras.models import Model, load_model
+from tensorflow.keras.optimizers import SGD
+from utils import IMG_SIZE, ManifestSequence, load_manifest, measure_throughput
+from evaluation import evaluate_stream
+from validation import stratified_indices
+
+PASS_THROUGH = (BatchNormalization, Activation, ReLU)
+
+
+def consumers(model):
+    '''Layer name -> names of the layers that take its output, from the functional config.'''
+    users = {layer.name: [] for layer in model.layers}
+    for layer_config in model.get_config()['layers']:
+        for node in layer_config['inbound_nodes']:
+            for inbound in node:
+                users[inbound[0]].append(layer_config['name'])
+    return users
+
+
+def prunable_pairs(model):
+    '''
+    (conv, [bn, ...], next_conv) for every Conv2D whose output reaches exactly
+    one Conv2D through single-consumer BatchNormalization/Activation layers.
+    '''
+    users = consumers(model)
+    pairs = []
+    for layer in model.layers:
+        if not isinstance(layer, Conv2D) or layer.groups != 1:
+            continue
+        chain = []
+        name = layer.name
+        while len(users[name]) == 1 and isinstance(model.get_layer(users[name][0]), PASS_THROUGH):
+            name = users[name][0]
+            chain.append(name)
+        if len(users[name]) == 1 and isinstance(model.get_layer(users[name][0]), Conv2D):
+            pairs.append((layer.name, [n for n in chain if isinstance(model.get_layer(n), BatchNormalization)],
+                          users[name][0]))
+    return pairs
+
+
+def filter_importance(model, conv, bns):
+    '''L1 norm of each output filter, scaled by what the following BatchNormalization multiplies it with.'''
+    importance = np.abs(model.get_layer(conv).get_weights()[0]).sum(axis=(0, 1, 2))
+    for name in bns:
+        bn = model.get_layer(name)
+        scale = np.abs(bn.gamma.numpy()) if bn.gamma is not None else 1.
+        importance = importance * scale / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+    return importance
+
+
+def prune_model(model, ratio, multiple=8, min_filters=8):
+    '''
+    Copy of model with the lowest-importance ratio of the filters of every
+    prunable conv removed, keeping a multiple of `multiple` filters (SIMD
+    friendly) and at least min_filters. Returns (pruned model, {conv: (before, after)}).
+    '''
+    config = model.get_config()
+    layer_configs = {c['name']: c for c in config['layers']}
+    weights = {layer.name: layer.get_weights() for layer in model.layers}
+    pruned = {}
+    for conv, bns, next_conv in prunable_pairs(model):
+        n = layer_configs[conv]['config']['filters']
+        n_keep = min(n, max(min_filters, int(np.ceil(n * (1 - ratio) / multiple)) * multiple))
+        if n_keep == n:
+            continue
+        keep = np.sort(np.argsort(-filter_importance(model, conv, bns))[:n_keep])
+        layer_configs[conv]['config']['filters'] = n_keep
+        weights[conv] = [weights[conv][0][..., keep]] + [b[keep] for b in weights[conv][1:]]
+        for name in bns:
+            weights[name] = [w[keep] for w in weights[name]]
+        weights[next_conv] = [weights[next_conv][0][:, :, keep, :]] + weights[next_conv][1:]
+        pruned[conv] = (n, n_keep)
+
+    new_model = Model.from_config(config)
+    for layer in new_model.layers:
+        layer.set_weights(weights[layer.name])
+    return new_model, pruned
+
+
+def count_flops(model, input_shape=IMG_SIZE + (3,)):
+    '''Multiply-adds x 2 of the Conv2D and Dense layers for one image of input_shape.'''
+    config = model.get_config()
+    config['layers'][0]['config']['batch_input_shape'] = (None,) + tuple(input_shape)
+    fixed = Model.from_config(config)
+    flops = 0
+    for layer in fixed.layers:
+        if isinstance(layer, Conv2D):
+            _, h, w, out = layer.output_shape
+            kh, kw, cin, _ = [int(d) for d in layer.kernel.shape]
+            flops += 2 * h * w * kh * kw * cin * out
+        elif isinstance(layer, Dense):
+            cin, out = [int(d) for d in layer.kernel.shape]
+            flops += 2 * cin * out
+    return int(flops)
+
+
+def measure(model, test_source, latency_steps=20):
+    evaluator = evaluate_stream(model, test_source)
+    return {'accuracy': evaluator.accuracy,
+            'top5_accuracy': evaluator.top_k_accuracy,
+            'params': int(model.count_params()),
+            'flops': count_flops(model),
+            'latency_ms': 1000. / measure_throughput(model, batch_size=1, steps=latency_steps),
+            'images_per_s_batch32': measure_throughput(model, batch_size=32, steps=5)}
+
+
+def prune_sweep(model_path='best_model_101class.hdf5', ratios=(0.25, 0.5, 0.75), finetune_steps=500, batch_size=8,
+                per_class=20, train_meta='food-101/meta/train.txt', test_meta='food-101/meta/test.txt',
+                image_dir='food-101/images', out_dir='pruned', report_file='pruning_report.json'):
+    '''
+    Prune the original model at each ratio, fine-tune it for finetune_steps
+    batches, save it as <out_dir>/best_model_101class_pruned<pct>.hdf5 (loads
+    like the original) and report accuracy on a stratified test subset, params,
+    FLOPs and CPU latency next to the original's.
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    original = load_model(model_path, compile=False)
+    train_paths, train_labels, food_list = load_manifest(train_meta, image_dir)
+    test_paths, test_labels, _ = load_manifest(test_meta, image_dir, food_list)
+    subset = stratified_indices(test_labels, per_class)
+    test_source = ManifestSequence(test_paths[subset], test_labels[subset], 32, len(food_list))
+
+    report = {'original': measure(original, test_source)}
+    print("original: {}".format(report['original']))
+    for ratio in ratios:
+        model, pruned = prune_model(original, ratio)
+        model.compile(optimizer=SGD(lr=0.0001, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'])
+        train = ManifestSequence(train_paths, train_labels, batch_size, len(food_list), shuffle=True, data_aug=True)
+        model.fit(train, steps_per_epoch=min(finetune_steps, len(train)), epochs=1, shuffle=False, verbose=1)
+        path = os.path.join(out_dir, 'best_model_101class_pruned{}.hdf5'.format(int(ratio * 100)))
+        model.save(path)
+
+        row = measure(model, test_source)
+        row.update(ratio=ratio, path=path, pruned_convs=len(pruned),
+                   params_ratio=row['params'] / float(report['original']['params']),
+                   flops_ratio=row['flops'] / float(report['original']['flops']),
+                   speedup=report['original']['latency_ms'] / row['latency_ms'])
+        report['pruned_{}'.format(int(ratio * 100))] = row
+        print("ratio {ratio}: accuracy {accuracy:.4f}, params x{params_ratio:.2f}, FLOPs x{flops_ratio:.2f}, "
+              "latency {latency_ms:.1f} ms (x{speedup:.2f} faster)".format(**row))
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == "__main__":
+    prune_sweep()
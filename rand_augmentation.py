@@ -6,6 +6,8 @@ import numpy as np
 from PIL import Image, ImageEnhance, ImageOps
 import numpy as np
 import random
+import time
+from metrics import AUGMENT_OP_SECONDS
 
 #==============
 import numpy as np
@@ -96,18 +98,19 @@ class Rand_Augment(ImageDataGenerator):
 
     def __call__(self, image):
         try:
-            operations = self.rand_augment()
-            for (op_name, M) in operations:
-                operation = self.func[op_name]
-                mag = self.ranges[op_name][M]
-                image = operation(image, mag)
+            image = self.apply_operations(image, self.rand_augment())
         except:
             image = tf.keras.preprocessing.image.array_to_img(image)
-            operations = self.rand_augment()
-            for (op_name, M) in operations:
-                operation = self.func[op_name]
-                mag = self.ranges[op_name][M]
-                image = operation(image, mag)
+            image = self.apply_operations(image, self.rand_augment())
+        return image
+
+    def apply_operations(self, image, operations):
+        for (op_name, M) in operations:
+            operation = self.func[op_name]
+            mag = self.ranges[op_name][M]
+            start = time.perf_counter()
+            image = operation(image, mag)
+            AUGMENT_OP_SECONDS.observe(time.perf_counter() - start, op=op_name)
         return image
 
     def rotate_with_fill(self, img, magnitude):
@@ -0,0 +1,226 @@
+# Similar-dish retrieval over the pooled InceptionV3 features
+# Training-set embeddings are stored as L2-normalized float16 vectors (optionally
+# product-quantized) and searched for the top-k cosine neighbours with blocked
+# matrix multiplication. utils.predict_class(..., index=index) queries it from
+# the same forward pass that produces the class.
+import os
+import time
+import numpy as np
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def merge_top_k(scores, ids, block_scores, block_ids, k):
+    '''Keep the k best of the running (scores, ids) and a new block, sorted by decreasing score.'''
+    scores = np.concatenate([scores, block_scores], axis=1)
+    ids = np.concatenate([ids, block_ids], axis=1)
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def kmeans(x, n_clusters, n_iter=20):
+    '''Plain Lloyd iterations, used to train the product-quantization codebooks.'''
+    centroids = x[np.random.choice(len(x), n_clusters, replace=len(x) < n_clusters)].copy()
+    for _ in range(n_iter):
+        assign = nearest_centroid(x, centroids)
+        counts = np.bincount(assign, minlength=n_clusters)
+        for d in range(x.shape[1]):
+            sums = np.bincount(assign, weights=x[:, d], minlength=n_clusters)
+            centroids[counts > 0, d] = sums[counts > 0] / counts[counts > 0]
+    return centroids
+
+
+def nearest_centroid(x, centroids):
+    distances = (centroids ** 2).sum(axis=1) - 2 * x.dot(centroids.T)
+    return np.argmin(distances, axis=1)
+
+
+def stored(name):
+    '''Attribute of EmbeddingIndex that first concatenates the chunks added since the last access.'''
+    def get(self):
+        self.flush()
+        return getattr(self, '_' + name)
+
+    def set(self, value):
+        self.flush()
+        setattr(self, '_' + name, value)
+    return property(get, set)
+
+
+class EmbeddingIndex(object):
+    '''
+    Cosine-similarity index of pooled backbone features.
+        vectors: normalized float16 (N, dim), searched exactly
+        codes: uint8 (N, pq_subspaces) when product quantization is enabled,
+               searched through per-query lookup tables (approximate)
+    paths and labels of the indexed images are kept for display.
+    add() only appends to a list of chunks; they are concatenated once, on
+    the next access to these arrays (search, save, ...), so building an
+    index from many small adds stays linear in its size.
+    '''
+    vectors = stored('vectors')
+    codes = stored('codes')
+    paths = stored('paths')
+    labels = stored('labels')
+
+    def __init__(self, dim=2048, pq_subspaces=None, block_size=8192):
+        self.dim = dim
+        self.pq_subspaces = pq_subspaces
+        self.block_size = block_size
+        self.codebooks = None
+        self.chunks = []
+        self.pending = 0
+        self._vectors = np.empty((0, dim), dtype=np.float16)
+        self._codes = np.empty((0, pq_subspaces or 0), dtype=np.uint8)
+        self._paths = np.empty((0,), dtype=object)
+        self._labels = np.empty((0,), dtype=np.int32)
+
+    def __len__(self):
+        return len(self._codes if self.pq_subspaces else self._vectors) + self.pending
+
+    def flush(self):
+        '''Concatenate the (data, paths, labels) chunks of add() onto the stored arrays.'''
+        if not self.chunks:
+            return
+        data, paths, labels = zip(*self.chunks)
+        self.chunks, self.pending = [], 0
+        if self.pq_subspaces:
+            self._codes = np.concatenate((self._codes,) + data)
+        else:
+            self._vectors = np.concatenate((self._vectors,) + data)
+        self._paths = np.concatenate((self._paths,) + paths)
+        self._labels = np.concatenate((self._labels,) + labels)
+
+    def train_pq(self, sample, n_iter=20):
+        '''Fit 256 centroids per subspace on a sample of (normalized) features.'''
+        sample = normalize(sample)
+        sub = self.dim // self.pq_subspaces
+        self.codebooks = np.stack([kmeans(sample[:, m * sub:(m + 1) * sub], 256, n_iter)
+                                   for m in range(self.pq_subspaces)]).astype(np.float32)
+
+    def encode(self, x):
+        sub = self.dim // self.pq_subspaces
+        codes = np.empty((len(x), self.pq_subspaces), dtype=np.uint8)
+        for m in range(self.pq_subspaces):
+            codes[:, m] = nearest_centroid(x[:, m * sub:(m + 1) * sub], self.codebooks[m])
+        return codes
+
+    def add(self, features, paths=None, labels=None):
+        '''Append features (N, dim), converted block by block to keep the float32 copy small.'''
+        n = len(features)
+        paths = np.asarray(paths if paths is not None else [None] * n, dtype=object)
+        labels = np.asarray(labels if labels is not None else [-1] * n, dtype=np.int32)
+        for b in range(0, n, self.block_size):
+            x = normalize(features[b:b + self.block_size])
+            self.chunks.append((self.encode(x) if self.pq_subspaces else x.astype(np.float16),
+                                paths[b:b + self.block_size], labels[b:b + self.block_size]))
+            self.pending += len(x)
+
+    def search(self, queries, k=5):
+        '''Top-k cosine neighbours of each query: returns (scores, ids), both (n_queries, k).'''
+        q = normalize(queries)
+        scores = np.empty((len(q), 0), dtype=np.float32)
+        ids = np.empty((len(q), 0), dtype=np.int64)
+        if self.pq_subspaces:
+            sub = self.dim // self.pq_subspaces
+            # lookup tables (n_queries, subspaces, 256) of partial inner products
+            tables = np.einsum('qmd,mcd->qmc', q.reshape(len(q), self.pq_subspaces, sub), self.codebooks)
+        for b in range(0, len(self), self.block_size):
+            if self.pq_subspaces:
+                codes = self.codes[b:b + self.block_size]
+                block_scores = np.zeros((len(q), len(codes)), dtype=np.float32)
+                for m in range(self.pq_subspaces):
+                    block_scores += tables[:, m, codes[:, m]]
+            else:
+                block_scores = q.dot(self.vectors[b:b + self.block_size].astype(np.float32).T)
+            kb = min(k, block_scores.shape[1])
+            part = np.argpartition(-block_scores, kb - 1, axis=1)[:, :kb]
+            scores, ids = merge_top_k(scores, ids, np.take_along_axis(block_scores, part, axis=1), part + b, k)
+        return scores, ids
+
+    def memory_bytes(self):
+        total = self.vectors.nbytes + self.codes.nbytes + self.labels.nbytes
+        if self.codebooks is not None:
+            total += self.codebooks.nbytes
+        return total
+
+    def save(self, prefix):
+        np.savez(prefix + '_index.npz', dim=self.dim, pq_subspaces=self.pq_subspaces or 0,
+                 codebooks=self.codebooks if self.codebooks is not None else np.empty(0),
+                 paths=self.paths.astype(str), labels=self.labels)
+        np.save(prefix + '_vectors.npy', self.codes if self.pq_subspaces else self.vectors)
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        with np.load(prefix + '_index.npz') as meta:
+            index = cls(int(meta['dim']), int(meta['pq_subspaces']) or None)
+            if index.pq_subspaces:
+                index.codebooks = meta['codebooks']
+            index.paths = meta['paths'].astype(object)
+            index.labels = meta['labels']
+        data = np.load(prefix + '_vectors.npy', mmap_mode='r' if mmap else None)
+        if index.pq_subspaces:
+            index.codes = data
+        else:
+            index.vectors = data
+        return index
+
+
+def build_index(model, paths, labels, prefix, pq_subspaces=None, pq_sample=20000):
+    '''
+    Index the pooled features of model over the given images (usually the train manifest).
+    The features are extracted once with feature_cache and reused when already cached.
+    '''
+    import feature_cache
+
+    if os.path.exists(prefix + '_labels.npy'):
+        features, labels = feature_cache.load_features(prefix)
+    else:
+        features, labels = feature_cache.extract_features(model, paths, labels, prefix)
+    index = EmbeddingIndex(features.shape[1], pq_subspaces)
+    if pq_subspaces:
+        sample = np.sort(np.random.choice(len(features), min(pq_sample, len(features)), replace=False))
+        index.train_pq(features[sample])
+    index.add(features, paths, labels)
+    index.save(prefix)
+    return index
+
+
+def benchmark(sizes=(10 ** 4, 10 ** 5, 10 ** 6), dim=2048, n_queries=32, k=5, pq_subspaces=None, repeats=3):
+    '''
+    Query latency and index memory for growing random indexes.
+    Returns one dict per size; memory is that of the stored vectors/codes.
+    '''
+    results = []
+    index = EmbeddingIndex(dim, pq_subspaces)
+    if pq_subspaces:
+        index.train_pq(np.random.randn(20000, dim).astype(np.float32), n_iter=5)
+    for size in sizes:
+        while len(index) < size:
+            index.add(np.random.randn(min(index.block_size * 8, size - len(index)), dim).astype(np.float32))
+        queries = np.random.randn(n_queries, dim).astype(np.float32)
+        index.search(queries[:1], k)
+        start = time.time()
+        for _ in range(repeats):
+            index.search(queries, k)
+        batch_latency = (time.time() - start) / repeats
+        result = {'size': size, 'pq_subspaces': pq_subspaces, 'memory_mb': index.memory_bytes() / 2 ** 20,
+                  'batch_latency_ms': 1000 * batch_latency, 'query_latency_ms': 1000 * batch_latency / n_queries}
+        print("{size:>9} vectors  {memory_mb:9.1f} MB  {batch_latency_ms:9.1f} ms per batch  "
+              "{query_latency_ms:7.2f} ms per query".format(**result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    print("Exact float16 index")
+    benchmark()
+    print("Product-quantized index (64 subspaces)")
+    benchmark(pq_subspaces=64)
@@ -12,11 +12,22 @@
 # Check flags that fits your purpose of running the code
 load_model_flag = True
 train_model_flag = False
+cached_head_flag = False # train only the classifier head on cached backbone features
+jit_compile_flag = False # compile the train and predict steps with XLA
+resumable_flag = False # checkpoint asynchronously and resume interrupted training
+progressive_flag = False # train early epochs at lower resolution (progressive.DEFAULT_SCHEDULE)
+distributed_workers = 0 # > 1 trains with that many local MultiWorkerMirroredStrategy workers
+accum_steps = 1 # > 1 accumulates gradients over that many batches per optimizer update
+validation_mode = 'full' # 'full', 'subsample' (stratified, per epoch) or 'sidecar' (separate evaluator process)
+step_timing_flag = False # log input/compute/callback time per step to steps.log
+metrics_port = 0 # > 0 serves live pipeline/prediction metrics on that port and dumps them to metrics.json
 
 # Check if GPU is enabled
 import tensorflow as tf
 config = tf.compat.v1.ConfigProto()
 config.gpu_options.allow_growth = True
+from utils import apply_threading_config
+apply_threading_config(session_config=config) # written by autotune.py
 sess = tf.compat.v1.Session(config=config)
 print(tf.__version__)
 print(tf.test.gpu_device_name())
@@ -24,6 +35,11 @@ print(tf.test.gpu_device_name())
 from rand_augmentation import *
 from utils import *
 
+if metrics_port > 0:
+	import metrics
+	metrics.start_http_server(metrics_port)
+	metrics.start_json_dump('metrics.json', 30)
+
 
 # In[3]:
 
@@ -274,22 +290,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 
-def predict_class(model, images, show = True):
-  for img in images:
-    img = image.load_img(img, target_size=(299, 299))
-    img = image.img_to_array(img)                    
-    img = np.expand_dims(img, axis=0)         
-    img /= 255.                                      
-
-    pred = model.predict(img)
-    index = np.argmax(pred)
-    food_list.sort()
-    pred_value = food_list[index]
-    if show:
-        plt.imshow(img[0])                           
-        plt.axis('off')
-        plt.title(pred_value)
-        plt.show()
+# predict_class(model, images, food_list, show) is defined in utils.py
 
 
 # In[ ]:
@@ -314,7 +315,7 @@ def predict_class(model, images, show = True):
 # images.append('samosa.jpg')
 # images.append('pizza.jpg')
 # images.append('omelette.jpg')
-# predict_class(model_best, images, True)
+# predict_class(model_best, images, food_list, True)
 
 
 # # * **Yes!!! The model got them all right!!**
@@ -420,7 +421,7 @@ K.clear_session()
 
 n_classes = n
 # img_width, img_height = 299, 299
-img_width, img_height = 300, 300
+img_width, img_height = IMG_SIZE
 
 train_data_dir = 'food-101/train'
 validation_data_dir = 'food-101/test'
@@ -435,19 +436,13 @@ batch_size = 8
 #     horizontal_flip=True)
 
 train_datagen = ImageDataGenerator(
-  rescale=1. / 255,
-  rotation_range=30,
-	zoom_range=0.2,
-	width_shift_range=0.2,
-	height_shift_range=0.2,
-	shear_range=0.2,
-	horizontal_flip=True,
-	fill_mode="nearest")
+  rescale=RESCALE,
+	**TRAIN_AUGMENTATION)
 
 # train_datagen = ImageDataGenerator(
 #   rescale=1. / 255)
 
-test_datagen = ImageDataGenerator(rescale=1. / 255)
+test_datagen = ImageDataGenerator(rescale=RESCALE)
 
 train_generator = train_datagen.flow_from_directory(
     train_data_dir,
@@ -478,36 +473,121 @@ validation_generator = test_datagen.flow_from_directory(
 inception = InceptionV3(weights='imagenet', include_top=False)
 # efficient = keras.applications.EfficientNetB3(include_top=False,
 #                                                 weights='imagenet', drop_connect_rate=0.4)
-# x = efficient.output
-x = inception.output
-x = GlobalAveragePooling2D()(x)
-x = Dense(128,activation='relu')(x)
-x = Dropout(0.2)(x)
-
-predictions = Dense(n,kernel_regularizer=regularizers.l2(0.005), activation='softmax')(x)
-
-model = Model(inputs=inception.input, outputs=predictions)
+# model = build_model(n, efficient)
+model = build_model(n, inception)
 
 
 
 if load_model_flag==True:
 	model = keras.models.load_model('best_model_101class.hdf5')
+elif load_model_flag==False and accum_steps > 1:
+	import accumulation
+	jit_compile = False
+	if jit_compile_flag==True:
+		import xla
+		# tried on a copy of the plain model: accumulating only adds variable updates to its step
+		jit_compile = xla.compile_with_xla(model, SGD(lr=0.0001, momentum=0.9), sample=train_generator[0])
+	model = accumulation.with_gradient_accumulation(model, accum_steps)
+	model.compile(optimizer=SGD(lr=0.0001 * accum_steps, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'],
+		jit_compile=jit_compile)
+elif load_model_flag==False and jit_compile_flag==True:
+	import xla
+	xla.compile_with_xla(model, SGD(lr=0.0001, momentum=0.9), sample=train_generator[0])
 elif load_model_flag==False:
 	model.compile(optimizer=SGD(lr=0.0001, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'])
 	# model.compile(optimizer=Adam  (), loss='categorical_crossentropy', metrics=['accuracy'])
 
-if train_model_flag== True:
-	checkpointer = ModelCheckpoint(filepath='best_model_101class.hdf5', verbose=1, save_best_only=True)
-	csv_logger = CSVLogger('history.log')
+if cached_head_flag == True:
+	import feature_cache
+	model = feature_cache.train_cached_head(inception, food_list, epochs=40)
+	model.save('head_model_101class.hdf5')
+
+if train_model_flag== True and resumable_flag==True:
+	import checkpointing
+	csv_logger = CSVLogger('history.log', append=True)
 
-	history_101class = model.fit(train_generator,
-			    steps_per_epoch = nb_train_samples // batch_size,
+	checkpointing.resumable_fit(model, train_generator, epochs=40,
+			    directory='checkpoints',
+			    best_filepath='best_model_101class.hdf5',
 			    validation_data=validation_generator,
 			    validation_steps=nb_validation_samples // batch_size,
-			    epochs=40,
+			    verbose=1,
+			    callbacks=[csv_logger])
+	# every epoch of the run, including those of interrupted earlier processes
+	history_101class = checkpointing.csv_history('history.log')
+elif train_model_flag== True and distributed_workers > 1:
+	import distributed
+	distributed.launch(distributed_workers, {'epochs': 40,
+			    'steps_per_epoch': nb_train_samples // (batch_size * distributed_workers),
+			    'val_meta': 'food-101/meta/test.txt',
+			    'validation_steps': nb_validation_samples // (batch_size * distributed_workers),
+			    'food_list': food_list,
+			    'per_worker_batch_size': batch_size,
+			    'checkpoint': 'best_model_101class.hdf5'})
+	model = keras.models.load_model('best_model_101class.hdf5')
+	train_model_flag = False
+elif train_model_flag== True and progressive_flag==True:
+	import progressive
+	checkpointer = ModelCheckpoint(filepath='best_model_101class.hdf5', verbose=1, save_best_only=True)
+	csv_logger = CSVLogger('history.log')
+
+	history_101class = progressive.progressive_fit(model, train_datagen, test_datagen,
+			    train_data_dir, validation_data_dir,
+			    base_lr=0.0001, base_batch_size=batch_size,
 			    verbose=1,
 			    callbacks=[csv_logger, checkpointer])
+elif train_model_flag== True:
+	checkpointer = ModelCheckpoint(filepath='best_model_101class.hdf5', verbose=1, save_best_only=True)
+	csv_logger = CSVLogger('history.log')
+	callbacks = [csv_logger, checkpointer]
+	validation_steps = nb_validation_samples // batch_size
+
+	if validation_mode == 'subsample':
+		import validation
+		validation_generator = validation.stratified_subset(validation_generator, per_class=20)
+		validation_steps = None
+	elif validation_mode == 'sidecar':
+		import validation
+		sidecar = validation.launch_sidecar('checkpoints', validation_data_dir)
+		validation_generator = validation_steps = None
+		sidecar_checkpoint = validation.SidecarCheckpoint('checkpoints')
+		callbacks = [csv_logger, sidecar_checkpoint]
+
+	if metrics_port > 0:
+		train_generator = metrics.prefetch(train_generator, source='train')
+	workers = 1
+	if step_timing_flag == True:
+		import profiling
+		# timed last and fetched by fit without its own prefetch, so input_s is the trainer's wait for each batch
+		train_generator, callbacks = profiling.instrument(train_generator, callbacks, log_file='steps.log')
+		workers = 0
+
+	steps_per_epoch = nb_train_samples // batch_size
+	if accum_steps > 1 and load_model_flag == False:
+		steps_per_epoch = accumulation.scaled_steps_per_epoch(nb_train_samples, batch_size, accum_steps)
+
+	try:
+		history_101class = model.fit(train_generator,
+				    steps_per_epoch = steps_per_epoch,
+				    validation_data=validation_generator,
+				    validation_steps=validation_steps,
+				    epochs=40,
+				    verbose=1,
+				    callbacks=callbacks,
+				    workers=workers)
+	finally:
+		# lets the sidecar finish even when training fails
+		if validation_mode == 'sidecar':
+			sidecar_checkpoint.finish()
+
+	if validation_mode == 'sidecar':
+		sidecar.wait()
+		merged = validation.merge_history('history.log', 'history_val.log', 'history.log')
+		# epochs the sidecar did not evaluate stay NaN
+		history_101class.history['val_loss'] = [float(row['val_loss'] or 'nan') for row in merged]
+		history_101class.history['val_accuracy'] = [float(row['val_accuracy'] or 'nan') for row in merged]
 
+if train_model_flag== True:
 	model.save('model_trained_101class.hdf5')
 
 	plot_accuracy(history_101class,'FOOD101-InceptionV3')
@@ -521,7 +601,10 @@ if train_model_flag== True:
 # %%time
 from tensorflow.keras.models import load_model
 K.clear_session()
-model_best = load_model('best_model_101class.hdf5',compile = False)
+if cached_head_flag == True:
+	model_best = load_model('head_model_101class.hdf5',compile = False)
+else:
+	model_best = load_model('best_model_101class.hdf5',compile = False)
 
 
 # In[ ]:
@@ -542,4 +625,4 @@ images.append('data/frenchfries.jpg')
 images.append('data/chocolatecake.jpg')
 images.append('data/applepie.jpg')
 images.append('data/waffles.jpg')
-predict_class(model_best, images, True)
+predict_class(model_best, images, food_list, True)
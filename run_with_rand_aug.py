@@ -9,11 +9,15 @@
 
 # In[1]:
 
+# Check flags that fits your purpose of running the code
+progressive_flag = False # train early epochs at lower resolution (progressive.DEFAULT_SCHEDULE)
 
 # Check if GPU is enabled
 import tensorflow as tf
 config = tf.compat.v1.ConfigProto()
 config.gpu_options.allow_growth = True
+from utils import apply_threading_config
+apply_threading_config(session_config=config) # written by autotune.py
 sess = tf.compat.v1.Session(config=config)
 print(tf.__version__)
 print(tf.test.gpu_device_name())
@@ -269,22 +273,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 
-def predict_class(model, images, show = True):
-  for img in images:
-    img = image.load_img(img, target_size=(299, 299))
-    img = image.img_to_array(img)                    
-    img = np.expand_dims(img, axis=0)         
-    img /= 255.                                      
-
-    pred = model.predict(img)
-    index = np.argmax(pred)
-    food_list.sort()
-    pred_value = food_list[index]
-    if show:
-        plt.imshow(img[0])                           
-        plt.axis('off')
-        plt.title(pred_value)
-        plt.show()
+# predict_class(model, images, food_list, show) is defined in utils.py
 
 
 # In[ ]:
@@ -309,7 +298,7 @@ def predict_class(model, images, show = True):
 # images.append('samosa.jpg')
 # images.append('pizza.jpg')
 # images.append('omelette.jpg')
-# predict_class(model_best, images, True)
+# predict_class(model_best, images, food_list, True)
 
 
 # # * **Yes!!! The model got them all right!!**
@@ -415,7 +404,7 @@ K.clear_session()
 
 n_classes = n
 # img_width, img_height = 299, 299
-img_width, img_height = 300, 300
+img_width, img_height = IMG_SIZE
 
 train_data_dir = 'food-101/train'
 validation_data_dir = 'food-101/test'
@@ -498,13 +487,21 @@ model.compile(optimizer=Adam  (), loss='categorical_crossentropy', metrics=['acc
 checkpointer = ModelCheckpoint(filepath='best_model_101class.hdf5', verbose=1, save_best_only=True)
 csv_logger = CSVLogger('history.log')
 
-history_11class = model.fit(train_generator,
-                    steps_per_epoch = nb_train_samples // batch_size,
-                    validation_data=validation_generator,
-                    validation_steps=nb_validation_samples // batch_size,
-                    epochs=40,
-                    verbose=1,
-                    callbacks=[csv_logger, checkpointer])
+if progressive_flag == True:
+    import progressive
+    history_11class = progressive.progressive_fit(model, train_datagen, test_datagen,
+                        train_data_dir, validation_data_dir,
+                        base_lr=0.001, base_batch_size=batch_size, lr_scaling='sqrt',
+                        verbose=1,
+                        callbacks=[csv_logger, checkpointer])
+else:
+    history_11class = model.fit(train_generator,
+                        steps_per_epoch = nb_train_samples // batch_size,
+                        validation_data=validation_generator,
+                        validation_steps=nb_validation_samples // batch_size,
+                        epochs=40,
+                        verbose=1,
+                        callbacks=[csv_logger, checkpointer])
 
 model.save('model_trained_101class.hdf5')
 
@@ -545,4 +542,4 @@ images.append('data/frenchfries.jpg')
 images.append('data/chocolatecake.jpg')
 images.append('data/applepie.jpg')
 images.append('data/waffles.jpg')
-predict_class(model_best, images, True)
\ No newline at end of file
+predict_class(model_best, images, food_list, True)
\ No newline at end of file
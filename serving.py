@@ -0,0 +1,241 @@
+# Pre-fork inference workers
+# The parent reads best_model_101class.hdf5 once with h5py into a flat,
+# page-aligned weight file plus a JSON index, opens the listening socket and
+# forks N workers that accept on it, so the kernel spreads connections across
+# them. Each worker maps the weight file read-only, builds the model from its
+# config with zero initializers (cheap, and thrown away) and rebinds every
+# layer weight to a constant over the mapping: TF wraps an aligned NumPy
+# buffer without copying it, so the weights sit once in the page cache,
+# shared by all workers, instead of once per worker. A worker that dies is
+# re-forked from the parent, which already has TensorFlow imported, so a
+# restart costs a model build instead of an HDF5 load. The parent never runs
+# a TensorFlow op: TF is not fork-safe once its runtime has started.
+# Without a worker count, serve() uses the replicas autotune.py found fastest.
+#     python serving.py [workers] [port]
+#     curl --data-binary @data/waffles.jpg localhost:8080/predict
+import io
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import numpy as np
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+PAGE = 4096
+
+
+def export_weights(model_path='best_model_101class.hdf5', prefix=None):
+    '''
+    Write <prefix>.weights (every weight array at a page-aligned offset) and
+    <prefix>.json (model config and the offset/shape/dtype of each layer's
+    weights, in layer.get_weights() order), using h5py only. Reuses the files
+    when they are newer than model_path.
+    '''
+    import h5py
+
+    prefix = prefix or os.path.splitext(model_path)[0]
+    if os.path.exists(prefix + '.json') and os.path.getmtime(prefix + '.json') >= os.path.getmtime(model_path):
+        return prefix
+    index = {'layers': {}}
+    offset = 0
+    with h5py.File(model_path, 'r') as f, open(prefix + '.weights.tmp', 'wb') as out:
+        config = f.attrs['model_config']
+        index['model_config'] = config.decode('utf-8') if isinstance(config, bytes) else config
+        weights = f['model_weights'] if 'model_weights' in f else f
+        for layer in weights.attrs['layer_names']:
+            layer = layer.decode('utf-8') if isinstance(layer, bytes) else layer
+            entries = []
+            for name in weights[layer].attrs['weight_names']:
+                name = name.decode('utf-8') if isinstance(name, bytes) else name
+                array = np.ascontiguousarray(weights[layer][name][()])
+                out.seek(offset)
+                out.write(array.tobytes())
+                entries.append([offset, list(array.shape), array.dtype.str])
+                offset += -(-array.nbytes // PAGE) * PAGE
+            index['layers'][layer] = entries
+        out.truncate(offset)
+    os.replace(prefix + '.weights.tmp', prefix + '.weights')
+    with open(prefix + '.json', 'w') as f:
+        json.dump(index, f)
+    return prefix
+
+
+def zero_initializers(config):
+    '''Copy of a model config (parsed JSON) with every *_initializer set to Zeros.'''
+    if isinstance(config, dict):
+        return {key: {'class_name': 'Zeros', 'config': {}} if key.endswith('_initializer') and value is not None
+                else zero_initializers(value) for key, value in config.items()}
+    if isinstance(config, list):
+        return [zero_initializers(value) for value in config]
+    return config
+
+
+def load_shared_model(prefix):
+    '''
+    Build the model from the index and bind each layer weight to a read-only
+    tensor over the mapped weight file in place of its variable. The model
+    can predict but not train.
+    '''
+    import tensorflow as tf
+
+    with open(prefix + '.json') as f:
+        index = json.load(f)
+    model = tf.keras.models.model_from_json(json.dumps(zero_initializers(json.loads(index['model_config']))))
+    mapped = np.memmap(prefix + '.weights', dtype=np.uint8, mode='r')
+    for layer in model.layers:
+        entries = index['layers'].get(layer.name)
+        if not entries:
+            continue
+        attributes = {id(value): name for name, value in vars(layer).items() if isinstance(value, tf.Variable)}
+        for variable, (offset, shape, dtype) in zip(layer.weights, entries):
+            array = np.frombuffer(mapped, dtype=np.dtype(dtype), count=int(np.prod(shape)), offset=offset)
+            # setattr also drops the variable from the layer's weight lists
+            setattr(layer, attributes[id(variable)], tf.convert_to_tensor(array.reshape(shape)))
+    return model
+
+
+def default_workers(path='threading_config.json', fallback=4):
+    '''The replica count autotune.py wrote to path, else fallback.'''
+    if not os.path.exists(path):
+        return fallback
+    with open(path) as f:
+        return json.load(f)['replicas']
+
+
+def make_handler(model, food_list, k=5):
+    from memory import rss_bytes
+    from utils import load_image_batch
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.reply(200, {'pid': os.getpid(), 'rss_mb': rss_bytes() / 1024. / 1024.})
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.reply(404, {'error': 'not found'})
+                return
+            try:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                probs = model.predict_on_batch(load_image_batch([io.BytesIO(body)]))[0]
+            except Exception as e:
+                self.reply(400, {'error': str(e)})
+                return
+            top = np.argsort(-probs)[:k]
+            self.reply(200, {'class': food_list[top[0]], 'pid': os.getpid(),
+                             'top': [[food_list[i], float(probs[i])] for i in top]})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class SharedSocketServer(HTTPServer):
+    '''HTTPServer on an already bound and listening socket inherited from the parent.'''
+    def __init__(self, sock, handler):
+        HTTPServer.__init__(self, sock.getsockname(), handler, bind_and_activate=False)
+        self.socket = sock
+
+
+def worker_main(sock, prefix, food_list, threads, n_workers):
+    import tensorflow as tf
+    from utils import IMG_SIZE, apply_threading_config
+
+    # the tuned thread counts only hold for as many replicas as they were tuned with
+    if apply_threading_config(replicas=n_workers) is None:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    model = load_shared_model(prefix)
+    model.predict_on_batch(np.zeros((1,) + IMG_SIZE + (3,), dtype=np.float32))
+    print("Worker {} ready".format(os.getpid()))
+    SharedSocketServer(sock, make_handler(model, food_list)).serve_forever()
+
+
+def serve(n_workers=None, port=8080, model_path='best_model_101class.hdf5', classes_file='food-101/meta/classes.txt',
+          host='0.0.0.0', max_restarts=5, restart_window=60., max_backoff=30.):
+    '''
+    Pre-fork n_workers (default: the tuned replica count) on one socket and
+    re-fork any worker that exits, until SIGINT/SIGTERM. Each restart within
+    restart_window seconds of the previous ones waits twice as long (up to
+    max_backoff seconds); more than max_restarts of them stop the server with
+    exit status 1, as a worker that fails at startup would never recover.
+    '''
+    n_workers = n_workers or default_workers()
+    prefix = export_weights(model_path)
+    with open(classes_file) as f:
+        food_list = sorted(line.strip() for line in f if line.strip())
+    # imported (not started) here so that a re-forked worker skips the imports
+    import tensorflow
+    import utils
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+    def fork():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                worker_main(sock, prefix, food_list, threads, n_workers)
+            finally:
+                os._exit(1)
+        return pid
+
+    workers = {fork(): i for i in range(n_workers)}
+    stopping = []
+    restarts = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(workers):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print("Serving {} on port {} with {} workers".format(model_path, port, n_workers))
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot = workers.pop(pid, None)
+        if slot is None or stopping:
+            continue
+        now = time.time()
+        restarts = [t for t in restarts if now - t < restart_window] + [now]
+        if len(restarts) > max_restarts:
+            print("Worker {} exited with status {}; {} restarts in {:.0f}s, giving up".format(
+                pid, status, len(restarts) - 1, restart_window))
+            stop(None, None)
+            for pid in list(workers):
+                os.waitpid(pid, 0)
+            sock.close()
+            sys.exit(1)
+        backoff = min(max_backoff, 0.1 * 2 ** (len(restarts) - 1))
+        print("Worker {} exited with status {}, restarting in {:.1f}s".format(pid, status, backoff))
+        time.sleep(backoff)
+        workers[fork()] = slot
+    sock.close()
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else None, int(sys.argv[2]) if len(sys.argv) > 2 else 8080)
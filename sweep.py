@@ -0,0 +1,155 @@
+# Parallel hyperparameter sweep of the classifier head on cached features
+# Head configurations (Dense width, dropout, l2, optimizer and learning rate)
+# are trained by a pool of worker processes on the backbone features cached by
+# feature_cache.py, memory-mapped once per worker. Successive halving gives
+# every trial a few epochs, keeps the best 1/eta on a held-out stratified part
+# of the train split, trains those eta times longer (resuming from their
+# saved state) and so on. The result is a leaderboard of all trials.
+#     python sweep.py 8
+import os
+import sys
+import csv
+import json
+import time
+import multiprocessing as mp
+import numpy as np
+
+SEARCH_SPACE = {
+    'width': [64, 128, 256, 512],
+    'dropout': [0., 0.2, 0.4],
+    'l2_reg': [0., 0.001, 0.005, 0.01],
+    'optimizer': [('sgd', 0.003), ('sgd', 0.01), ('sgd', 0.03), ('adam', 0.0001), ('adam', 0.0003), ('adam', 0.001)],
+}
+# the head of run.py with feature_cache.train_head's optimizer
+BASELINE = {'width': 128, 'dropout': 0.2, 'l2_reg': 0.005, 'optimizer': ('sgd', 0.01)}
+
+_worker = {}
+
+
+def sample_configs(n_trials, space=SEARCH_SPACE, seed=0):
+    '''The baseline plus n_trials - 1 distinct random configurations of space.'''
+    rng = np.random.RandomState(seed)
+    configs = [dict(BASELINE)]
+    seen = {json.dumps(BASELINE, sort_keys=True)}
+    n_total = int(np.prod([len(v) for v in space.values()]))
+    while len(configs) < min(n_trials, n_total):
+        config = {key: values[rng.randint(len(values))] for key, values in space.items()}
+        if json.dumps(config, sort_keys=True) not in seen:
+            seen.add(json.dumps(config, sort_keys=True))
+            configs.append(config)
+    return configs
+
+
+def init_worker(cache_dir, per_class, threads):
+    import tensorflow as tf
+    from feature_cache import load_features
+    from validation import stratified_indices
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    features, labels = load_features(os.path.join(cache_dir, 'train'))
+    holdout = stratified_indices(labels, per_class)
+    _worker.update(features=features, labels=labels, n=int(labels.max()) + 1, holdout=holdout,
+                   train_indices=np.setdiff1d(np.arange(len(labels)), holdout))
+
+
+def make_optimizer(name, lr):
+    from tensorflow.keras.optimizers import SGD, Adam
+    return SGD(lr=lr, momentum=0.9) if name == 'sgd' else Adam(lr=lr)
+
+
+def run_job(job):
+    '''Train trial job['trial'] from job['initial_epoch'] to job['epochs'] and score it on the holdout.'''
+    from tensorflow.keras.models import load_model
+    from feature_cache import FeatureSequence, build_head
+
+    features, labels, n = _worker['features'], _worker['labels'], _worker['n']
+    config = job['config']
+    path = os.path.join(job['trial_dir'], 'trial-{:03d}.h5'.format(job['trial']))
+    if job['initial_epoch'] > 0:
+        head = load_model(path)
+    else:
+        head = build_head(n, features.shape[-1], width=config['width'], dropout=config['dropout'],
+                          l2_reg=config['l2_reg'])
+        head.compile(optimizer=make_optimizer(*config['optimizer']), loss='categorical_crossentropy',
+                     metrics=['accuracy'])
+    holdout = FeatureSequence(features, labels, 1024, n, shuffle=False, indices=_worker['holdout'])
+    start = time.time()
+    history = head.fit(FeatureSequence(features, labels, job['batch_size'], n, indices=_worker['train_indices']),
+                       validation_data=holdout, initial_epoch=job['initial_epoch'], epochs=job['epochs'],
+                       verbose=0)
+    head.save(path)
+    return {'trial': job['trial'], 'epochs': job['epochs'], 'seconds': time.time() - start,
+            'val_accuracy': float(history.history['val_accuracy'][-1]),
+            'val_loss': float(history.history['val_loss'][-1])}
+
+
+def successive_halving(configs, n_workers=4, cache_dir='food-101/features', min_epochs=2, max_epochs=40, eta=3,
+                       batch_size=256, per_class=20, trial_dir='sweep'):
+    '''
+    Run configs through successive-halving rungs of min_epochs, min_epochs * eta, ...
+    up to max_epochs total epochs. Returns the per-trial results.
+    '''
+    if not os.path.exists(trial_dir):
+        os.makedirs(trial_dir)
+    trials = {i: {'trial': i, 'config': config, 'epochs': 0, 'rung': -1, 'history': []}
+              for i, config in enumerate(configs)}
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    pool = mp.get_context('spawn').Pool(n_workers, init_worker, (cache_dir, per_class, threads))
+
+    alive = list(trials)
+    epochs = min_epochs
+    rung = 0
+    try:
+        while alive:
+            start = time.time()
+            jobs = [{'trial': i, 'config': trials[i]['config'], 'initial_epoch': trials[i]['epochs'],
+                     'epochs': epochs, 'batch_size': batch_size, 'trial_dir': trial_dir} for i in alive]
+            for result in pool.imap_unordered(run_job, jobs):
+                trial = trials[result['trial']]
+                trial.update(epochs=result['epochs'], rung=rung, val_accuracy=result['val_accuracy'],
+                             val_loss=result['val_loss'])
+                trial['history'].append(result)
+            print("Rung {}: {} trials to {} epochs in {:.0f}s, best val_accuracy {:.4f}".format(
+                rung, len(alive), epochs, time.time() - start, max(trials[i]['val_accuracy'] for i in alive)))
+            if epochs >= max_epochs or len(alive) == 1:
+                break
+            alive = sorted(alive, key=lambda i: -trials[i]['val_accuracy'])[:max(1, len(alive) // eta)]
+            epochs = min(epochs * eta, max_epochs)
+            rung += 1
+    finally:
+        pool.close()
+        pool.join()
+    return list(trials.values())
+
+
+def write_leaderboard(trials, out_prefix='leaderboard'):
+    '''Trials ranked by the rung they reached, then holdout accuracy; written as CSV and JSON.'''
+    ranked = sorted(trials, key=lambda t: (-t['rung'], -t.get('val_accuracy', 0.)))
+    with open(out_prefix + '.json', 'w') as f:
+        json.dump(ranked, f, indent=1)
+    with open(out_prefix + '.csv', 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial', 'width', 'dropout', 'l2_reg', 'optimizer', 'lr', 'epochs', 'val_accuracy',
+                         'val_loss', 'seconds'])
+        for rank, t in enumerate(ranked, 1):
+            c = t['config']
+            writer.writerow([rank, t['trial'], c['width'], c['dropout'], c['l2_reg'], c['optimizer'][0],
+                             c['optimizer'][1], t['epochs'], t.get('val_accuracy'), t.get('val_loss'),
+                             sum(h['seconds'] for h in t['history'])])
+    for rank, t in enumerate(ranked[:10], 1):
+        print("{:2d}. {} epochs {:2d} val_accuracy {:.4f}".format(rank, t['config'], t['epochs'], t['val_accuracy']))
+    return ranked
+
+
+def sweep(n_workers=4, n_trials=54, cache_dir='food-101/features', **kwargs):
+    if not os.path.exists(os.path.join(cache_dir, 'train_features.npy')):
+        raise IOError("No cached features in {}; run feature_cache.py first".format(cache_dir))
+    start = time.time()
+    trials = successive_halving(sample_configs(n_trials), n_workers, cache_dir, **kwargs)
+    print("Sweep of {} trials took {:.0f}s".format(len(trials), time.time() - start))
+    return write_leaderboard(trials)
+
+
+if __name__ == "__main__":
+    sweep(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
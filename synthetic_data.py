@@ -0,0 +1,158 @@
+# Synthetic Food-101-shaped dataset and end-to-end training benchmark
+# make_dataset writes the same layout as the real download (images/<class>/*.jpg,
+# meta/classes.txt, meta/train.txt, meta/test.txt) plus the train/ and test/
+# folders that prepare_data in run.py builds, at any class and image count.
+# benchmark_fit then runs a short fit on it for each input mode and reports
+# steps/s and the share of step time spent waiting for input.
+#     python synthetic_data.py tiny
+#     python synthetic_data.py inception
+import os
+import sys
+import json
+import shutil
+import numpy as np
+from PIL import Image
+
+INPUT_MODES = ['image_data_generator', 'rand_augment', 'data_generator']
+
+
+def class_names(n_classes):
+    return ['food_{:03d}'.format(c) for c in range(n_classes)]
+
+
+def synthetic_image(rng, tint, size):
+    '''A smooth random picture pulled towards the class tint, so the classes are learnable.'''
+    small = rng.randint(0, 256, size=(6, 6, 3)) * 0.5 + np.asarray(tint) * 0.5
+    return Image.fromarray(small.astype(np.uint8)).resize(size, Image.BICUBIC)
+
+
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy(src, dest)
+
+
+def make_dataset(root='food-101-synthetic', n_classes=101, train_per_class=750, test_per_class=250,
+                 size=(512, 384), split=True, seed=0):
+    '''
+    Write a dataset shaped like food-101/ under root. Image ids are numbers as in
+    the real manifests; split=True also fills root/train and root/test (hard
+    links where the file system allows, so the images are stored once).
+    '''
+    rng = np.random.RandomState(seed)
+    foods = class_names(n_classes)
+    os.makedirs(os.path.join(root, 'meta'), exist_ok=True)
+    manifests = {'train': [], 'test': []}
+    image_id = 0
+    for food in foods:
+        os.makedirs(os.path.join(root, 'images', food), exist_ok=True)
+        tint = rng.randint(0, 256, size=3)
+        for i in range(train_per_class + test_per_class):
+            image_id += 1
+            synthetic_image(rng, tint, size).save(os.path.join(root, 'images', food, '{}.jpg'.format(image_id)),
+                                                  quality=90)
+            manifests['train' if i < train_per_class else 'test'].append('{}/{}'.format(food, image_id))
+
+    with open(os.path.join(root, 'meta', 'classes.txt'), 'w') as f:
+        f.write('\n'.join(foods) + '\n')
+    with open(os.path.join(root, 'meta', 'labels.txt'), 'w') as f:
+        f.write('\n'.join(food.replace('_', ' ').title() for food in foods) + '\n')
+    for split_name, entries in manifests.items():
+        with open(os.path.join(root, 'meta', split_name + '.txt'), 'w') as f:
+            f.write('\n'.join(entries) + '\n')
+        if split:
+            for entry in entries:
+                food = entry.split('/')[0]
+                os.makedirs(os.path.join(root, split_name, food), exist_ok=True)
+                link_or_copy(os.path.join(root, 'images', entry + '.jpg'),
+                             os.path.join(root, split_name, entry + '.jpg'))
+    print("Wrote {} classes, {} train and {} test images to {}".format(
+        n_classes, len(manifests['train']), len(manifests['test']), root))
+    return root
+
+
+def build_benchmark_model(n, backbone='tiny'):
+    '''The run.py model (InceptionV3 + classifier head, random weights) or build_tiny_model.'''
+    from tensorflow.keras.optimizers import SGD
+    from utils import build_model, build_tiny_model
+
+    if backbone == 'inception':
+        from tensorflow.keras.applications.inception_v3 import InceptionV3
+        model = build_model(n, InceptionV3(weights=None, include_top=False))
+    else:
+        model = build_tiny_model(n)
+    model.compile(optimizer=SGD(lr=0.0001, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def train_source(root, mode, batch_size, target_size, n_images=None):
+    '''
+    The training data source of run.py (ImageDataGenerator), run_with_rand_aug.py
+    or utils.data_generator. data_generator holds its images in memory, so it
+    gets a random n_images of the train split (all of them if None).
+    '''
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    from tensorflow.keras.utils import to_categorical
+    from rand_augmentation import Rand_Augment
+    from utils import RESCALE, TRAIN_AUGMENTATION, data_generator, load_image_batch, load_manifest
+
+    if mode == 'image_data_generator':
+        datagen = ImageDataGenerator(rescale=RESCALE, **TRAIN_AUGMENTATION)
+    elif mode == 'rand_augment':
+        datagen = Rand_Augment(Numbers=4, max_Magnitude=10)
+    elif mode == 'data_generator':
+        paths, labels, food_list = load_manifest(os.path.join(root, 'meta', 'train.txt'),
+                                                 os.path.join(root, 'images'))
+        if n_images is not None and n_images < len(paths):
+            keep = np.sort(np.random.RandomState(0).choice(len(paths), n_images, replace=False))
+            paths, labels = paths[keep], labels[keep]
+        x = load_image_batch(paths, target_size=target_size) / RESCALE
+        return data_generator(x, to_categorical(labels, len(food_list)), batch_size, data_aug=True)
+    else:
+        raise ValueError('Unknown input mode {}'.format(mode))
+    return datagen.flow_from_directory(os.path.join(root, 'train'), target_size=target_size,
+                                       batch_size=batch_size, class_mode='categorical')
+
+
+def benchmark_fit(root='food-101-synthetic', modes=INPUT_MODES, backbone='tiny', batch_size=8, steps=50, warmup=5,
+                  target_size=None, report_file='e2e_benchmark.json'):
+    '''
+    Short fit per input mode, with the input produced synchronously (workers=0)
+    so that profiling.StepTimer sees the exact input wait of every step.
+    Reports steps/s, images/s and input-bound % = input time / step time,
+    leaving out the first warmup steps (graph tracing).
+    '''
+    import tensorflow as tf
+    from profiling import instrument, summarize
+    from utils import IMG_SIZE
+
+    target_size = target_size or IMG_SIZE
+    n = len(os.listdir(os.path.join(root, 'train')))
+    report = {'backbone': backbone, 'batch_size': batch_size, 'target_size': list(target_size), 'modes': {}}
+    for mode in modes:
+        tf.keras.backend.clear_session()
+        model = build_benchmark_model(n, backbone)
+        source, callbacks = instrument(train_source(root, mode, batch_size, target_size, batch_size * (warmup + steps)),
+                                       log_file='e2e_steps_{}.log'.format(mode))
+        model.fit(source, steps_per_epoch=warmup + steps, epochs=1, verbose=0, workers=0, callbacks=callbacks)
+        records = callbacks[0].steps[warmup:]
+        step_s = sum(r['step_s'] for r in records)
+        input_s = sum(r['input_s'] for r in records)
+        report['modes'][mode] = {'steps_per_s': len(records) / step_s,
+                                 'images_per_s': len(records) * batch_size / step_s,
+                                 'input_bound_pct': 100. * input_s / step_s,
+                                 'step_s': summarize([r['step_s'] for r in records]),
+                                 'input_s': summarize([r['input_s'] for r in records])}
+        print("{:22s} {steps_per_s:6.2f} steps/s  {images_per_s:7.1f} img/s  "
+              "input-bound {input_bound_pct:5.1f}%".format(mode, **report['modes'][mode]))
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == "__main__":
+    root = 'food-101-synthetic'
+    if not os.path.exists(root):
+        make_dataset(root, n_classes=10, train_per_class=80, test_per_class=20)
+    benchmark_fit(root, backbone=sys.argv[1] if len(sys.argv) > 1 else 'tiny')
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import accumulation
+
+
+def tiny_model(seed=0):
+    tf.random.set_seed(seed)
+    inputs = tf.keras.Input((6,))
+    x = tf.keras.layers.Dense(8, activation='relu', kernel_regularizer=tf.keras.regularizers.l2(0.01))(inputs)
+    return tf.keras.Model(inputs, tf.keras.layers.Dense(3, activation='softmax')(x))
+
+
+def random_data(n=32, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.rand(n, 6).astype(np.float32), np.eye(3, dtype=np.float32)[rng.randint(3, size=n)]
+
+
+def fit_pair(accum_steps, micro_batch, n, jit_compile=False):
+    x, y = random_data(n)
+    plain = tiny_model()
+    plain.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.5), loss='categorical_crossentropy')
+    accumulated = accumulation.with_gradient_accumulation(tiny_model(), accum_steps)
+    accumulated.set_weights(plain.get_weights())
+    accumulated.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.5), loss='categorical_crossentropy',
+                        jit_compile=jit_compile)
+    initial = plain.get_weights()
+    assert not accumulated.run_eagerly
+    history = accumulated.fit(x, y, batch_size=micro_batch, epochs=1, shuffle=False, verbose=0)
+    plain.fit(x, y, batch_size=n, epochs=1, shuffle=False, verbose=0)
+    return initial, plain, accumulated, history
+
+
+@pytest.mark.parametrize('jit_compile', [False, True])
+def test_micro_batches_match_one_large_batch(jit_compile):
+    _, plain, accumulated, history = fit_pair(accum_steps=4, micro_batch=8, n=32, jit_compile=jit_compile)
+    for expected, actual in zip(plain.get_weights(), accumulated.get_weights()):
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+    assert history.history['optimizer_steps'][-1] == 1
+
+
+def test_no_update_before_accum_steps_micro_batches():
+    initial, _, accumulated, history = fit_pair(accum_steps=4, micro_batch=8, n=24)
+    for expected, actual in zip(initial, accumulated.get_weights()):
+        np.testing.assert_array_equal(actual, expected)
+    assert history.history['optimizer_steps'][-1] == 0
+
+
+def test_save_writes_plain_model(tmp_path):
+    model = accumulation.with_gradient_accumulation(tiny_model(), 2)
+    model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.1), loss='categorical_crossentropy')
+    model.save(str(tmp_path / 'model.h5'))
+    loaded = tf.keras.models.load_model(str(tmp_path / 'model.h5'), compile=False)
+    x, _ = random_data(4)
+    np.testing.assert_allclose(loaded.predict(x, verbose=0), model.predict(x, verbose=0), rtol=1e-6)
+
+
+def test_scaled_steps_per_epoch_drops_partial_update():
+    assert accumulation.scaled_steps_per_epoch(1000, 8, 4) == 124
+    assert accumulation.scaled_steps_per_epoch(64, 8, 4) == 8
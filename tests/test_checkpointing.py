@@ -0,0 +1,135 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import checkpointing
+
+
+class ShuffledSequence(tf.keras.utils.Sequence):
+    '''Shuffles itself like ManifestSequence(shuffle=True).'''
+    def __init__(self, n=48, batch_size=8, seed=0):
+        rng = np.random.RandomState(seed)
+        self.x = rng.rand(n, 5).astype(np.float32)
+        self.y = np.eye(3, dtype=np.float32)[rng.randint(3, size=n)]
+        self.batch_size = batch_size
+        self.index_array = np.random.permutation(n)
+
+    def __len__(self):
+        return len(self.x) // self.batch_size
+
+    def __getitem__(self, i):
+        index = self.index_array[i * self.batch_size:(i + 1) * self.batch_size]
+        return self.x[index], self.y[index]
+
+    def on_epoch_end(self):
+        np.random.shuffle(self.index_array)
+
+
+def tiny_model():
+    model = tf.keras.Sequential([tf.keras.Input((5,)), tf.keras.layers.Dense(8, activation='relu'),
+                                 tf.keras.layers.Dense(3, activation='softmax')])
+    model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.1, momentum=0.9),
+                  loss='categorical_crossentropy')
+    return model
+
+
+def test_write_atomic_and_latest_checkpoint(tmp_path):
+    assert checkpointing.latest_checkpoint(str(tmp_path)) is None
+    for step in [5, 40, 12]:
+        checkpointing.write_atomic(str(tmp_path / 'ckpt-{:010d}.pkl'.format(step)), {'step': step})
+    assert checkpointing.latest_checkpoint(str(tmp_path)).endswith('ckpt-0000000040.pkl')
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
+
+
+def test_offset_sequence_skips_consumed_batches():
+    sequence = ShuffledSequence()
+    offset = checkpointing.OffsetSequence(sequence, 4)
+    assert len(offset) == 2
+    np.testing.assert_array_equal(offset[0][0], sequence[4][0])
+
+
+class StopAfter(tf.keras.callbacks.Callback):
+    '''Records the training state after the given optimizer step, then interrupts fit.'''
+    def __init__(self, steps, sequence=None):
+        super().__init__()
+        self.steps = steps
+        self.sequence = sequence
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.model.optimizer.iterations.numpy() == self.steps:
+            self.weights = self.model.get_weights()
+            self.optimizer = [v.numpy() for v in self.model.optimizer.variables()]
+            self.order = np.array(self.sequence.index_array) if self.sequence is not None else None
+            self.numpy_rng = np.random.get_state()[1].copy()
+            self.python_rng = random.getstate()
+            raise KeyboardInterrupt
+
+
+def test_restore_recovers_weights_optimizer_position_and_order(tmp_path):
+    directory = str(tmp_path / 'checkpoints')
+    sequence = ShuffledSequence()
+    model = tiny_model()
+    checkpoint = checkpointing.AsyncCheckpoint(directory, save_freq=3, sequence=sequence)
+    stop = StopAfter(3, sequence)
+    with pytest.raises(KeyboardInterrupt):
+        model.fit(sequence, epochs=2, shuffle=False, verbose=0, callbacks=[checkpoint, stop])
+    checkpoint.wait()
+
+    np.random.seed(123)
+    random.seed(123)
+    sequence.on_epoch_end()
+    restored = tiny_model()
+    epoch, step = checkpointing.restore(restored, directory, sequence)
+    assert (epoch, step) == (0, 3)
+    for expected, actual in zip(stop.weights, restored.get_weights()):
+        np.testing.assert_array_equal(actual, expected)
+    for expected, variable in zip(stop.optimizer, restored.optimizer.variables()):
+        np.testing.assert_array_equal(variable.numpy(), expected)
+    np.testing.assert_array_equal(sequence.index_array, stop.order)
+    np.testing.assert_array_equal(np.random.get_state()[1], stop.numpy_rng)
+    assert random.getstate() == stop.python_rng
+
+
+def test_only_the_last_checkpoints_are_kept(tmp_path):
+    directory = str(tmp_path)
+    model = tiny_model()
+    checkpoint = checkpointing.AsyncCheckpoint(directory, save_freq=1, keep=2, sequence=ShuffledSequence())
+    model.fit(ShuffledSequence(), epochs=1, shuffle=False, verbose=0, callbacks=[checkpoint])
+    checkpoint.wait()
+    assert len([name for name in os.listdir(directory) if name.startswith('ckpt-')]) == 2
+
+
+def test_resumable_fit_continues_an_interrupted_run(tmp_path):
+    directory = str(tmp_path / 'checkpoints')
+    best = str(tmp_path / 'best.h5')
+
+    model = tiny_model()
+    with pytest.raises(KeyboardInterrupt):
+        # the checkpoint callback runs after StopAfter, so the last one is after step 9
+        checkpointing.resumable_fit(model, ShuffledSequence(), epochs=3, directory=directory, save_freq=3,
+                                    validation_data=ShuffledSequence(seed=1), verbose=0, callbacks=[StopAfter(10)])
+
+    # epoch 0 (6 steps) done, epoch 1 checkpointed after its 3rd step: 3 + 6 steps left
+    resumed = tiny_model()
+    history = checkpointing.resumable_fit(resumed, ShuffledSequence(), epochs=3, directory=directory, save_freq=3,
+                                          best_filepath=best, validation_data=ShuffledSequence(seed=1), verbose=0)
+    assert len(history.history['loss']) == 2
+    assert int(resumed.optimizer.iterations.numpy()) == 18
+    assert os.path.exists(best)
+
+
+def test_rerunning_a_finished_job_returns_an_empty_history(tmp_path):
+    directory = str(tmp_path / 'checkpoints')
+    log = str(tmp_path / 'history.log')
+    model = tiny_model()
+    checkpointing.resumable_fit(model, ShuffledSequence(), epochs=2, directory=directory, verbose=0,
+                                callbacks=[tf.keras.callbacks.CSVLogger(log, append=True)])
+    again = checkpointing.resumable_fit(tiny_model(), ShuffledSequence(), epochs=2, directory=directory, verbose=0,
+                                        callbacks=[tf.keras.callbacks.CSVLogger(log, append=True)])
+    assert again.history == {}
+    history = checkpointing.csv_history(log)
+    assert history.epoch == [0, 1]
+    assert len(history.history['loss']) == 2
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import evaluation
+
+
+def random_predictions(n=200, n_classes=7, seed=0):
+    rng = np.random.RandomState(seed)
+    logits = rng.randn(n, n_classes)
+    probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    return probs.astype(np.float32), rng.randint(n_classes, size=n)
+
+
+def test_update_matches_direct_computation():
+    probs, labels = random_predictions()
+    evaluator = evaluation.StreamingEvaluator(7, k=3)
+    for b in range(0, len(labels), 64):
+        evaluator.update(probs[b:b + 64], labels[b:b + 64])
+    assert evaluator.count == 200
+    assert evaluator.accuracy == pytest.approx((probs.argmax(axis=1) == labels).mean())
+    top3 = np.argsort(-probs, axis=1)[:, :3]
+    assert evaluator.top_k_accuracy == pytest.approx((top3 == labels[:, None]).any(axis=1).mean())
+    assert evaluator.loss == pytest.approx(-np.log(probs[np.arange(200), labels]).mean(), rel=1e-5)
+    assert evaluator.confusion.sum() == 200
+    np.testing.assert_array_equal(evaluator.confusion.sum(axis=1), np.bincount(labels, minlength=7))
+
+
+def test_one_hot_labels_equal_class_indices():
+    probs, labels = random_predictions()
+    by_index = evaluation.StreamingEvaluator(7)
+    by_index.update(probs, labels)
+    by_one_hot = evaluation.StreamingEvaluator(7)
+    by_one_hot.update(probs, np.eye(7)[labels])
+    np.testing.assert_array_equal(by_index.confusion, by_one_hot.confusion)
+    assert by_index.top_k_correct == by_one_hot.top_k_correct
+
+
+def test_merged_shards_equal_one_pass():
+    probs, labels = random_predictions(n=301)
+    whole = evaluation.StreamingEvaluator(7)
+    whole.update(probs, labels)
+    shards = []
+    for i in range(3):
+        shard = evaluation.StreamingEvaluator(7)
+        shard.update(probs[i::3], labels[i::3])
+        # as sent back by a parallel_eval worker
+        shards.append(evaluation.StreamingEvaluator.from_state(shard.state()))
+    merged = shards[0].merge(shards[1]).merge(shards[2])
+    np.testing.assert_array_equal(merged.confusion, whole.confusion)
+    assert merged.top_k_correct == whole.top_k_correct
+    assert merged.loss == pytest.approx(whole.loss)
+
+
+def test_report_precision_and_recall():
+    evaluator = evaluation.StreamingEvaluator(2, k=1)
+    evaluator.update(np.array([[0.9, 0.1], [0.8, 0.2], [0.3, 0.7], [0.6, 0.4]]), np.array([0, 0, 1, 1]))
+    report = evaluator.report(['b_dish', 'a_dish'])
+    # class names are sorted, as in food_list
+    assert report['per_class']['a_dish'] == {'precision': pytest.approx(2 / 3.), 'recall': 1., 'support': 2}
+    assert report['per_class']['b_dish'] == {'precision': 1., 'recall': 0.5, 'support': 2}
+    assert report['top1_accuracy'] == 0.75
+    assert report['confusion_matrix'] == [[2, 0], [1, 1]]
+
+
+class ArraySequence(tf.keras.utils.Sequence):
+    def __init__(self, x, labels, batch_size):
+        self.x, self.labels, self.batch_size = x, labels, batch_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.x) / float(self.batch_size)))
+
+    def __getitem__(self, i):
+        s = slice(i * self.batch_size, (i + 1) * self.batch_size)
+        return self.x[s], np.eye(4)[self.labels[s]]
+
+
+def test_evaluate_stream_sources_agree(tmp_path):
+    rng = np.random.RandomState(3)
+    x = rng.rand(50, 6).astype(np.float32)
+    labels = rng.randint(4, size=50)
+    model = tf.keras.Sequential([tf.keras.Input((6,)), tf.keras.layers.Dense(4, activation='softmax')])
+    from_arrays = evaluation.evaluate_stream(model, (x, labels), batch_size=16, k=2,
+                                             report_file=str(tmp_path / 'report.json'))
+    from_sequence = evaluation.evaluate_stream(model, ArraySequence(x, labels, 16), k=2)
+    from_iterable = evaluation.evaluate_stream(model.predict_on_batch, iter(ArraySequence(x, labels, 7)), k=2)
+    for other in (from_sequence, from_iterable):
+        np.testing.assert_array_equal(other.confusion, from_arrays.confusion)
+        assert other.top_k_correct == from_arrays.top_k_correct
+    expected = model.predict(x, verbose=0).argmax(axis=1)
+    assert from_arrays.accuracy == pytest.approx((expected == labels).mean())
+    assert (tmp_path / 'report.json').exists()
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import hard_examples
+
+
+@pytest.mark.parametrize('n', [1, 5, 8, 13])
+def test_sum_tree_sums_after_set_and_update(n):
+    rng = np.random.RandomState(n)
+    priorities = rng.rand(n)
+    tree = hard_examples.SumTree(n)
+    tree.set_all(priorities)
+    assert tree.total == pytest.approx(priorities.sum())
+    indices = np.unique(rng.randint(n, size=3))
+    priorities[indices] = rng.rand(len(indices))
+    tree.update(indices, priorities[indices])
+    assert tree.total == pytest.approx(priorities.sum())
+    for node in range(1, tree.capacity):
+        assert tree.tree[node] == pytest.approx(tree.tree[2 * node] + tree.tree[2 * node + 1])
+
+
+def test_sum_tree_samples_in_proportion_to_priority():
+    priorities = np.array([1., 0., 3., 6., 0.])
+    tree = hard_examples.SumTree(5)
+    tree.set_all(priorities)
+    counts = np.bincount(tree.sample(20000, np.random.RandomState(0)), minlength=5)
+    np.testing.assert_allclose(counts / 20000., priorities / priorities.sum(), atol=0.015)
+
+
+def test_sampler_matches_losses_to_drawn_batches_in_order():
+    sampler = hard_examples.HardExampleSampler(10, floor=0., momentum=0., init_loss=1., seed=0)
+    first = sampler.draw(4)
+    second = sampler.draw(4)
+    sampler.update(np.full(4, 5.))
+    sampler.update(np.full(4, 0.5))
+    assert not sampler.pending
+    # a sample in both batches keeps the loss of the later one
+    assert np.all(sampler.losses[np.setdiff1d(first, second)] == 5.)
+    assert np.all(sampler.losses[second] == 0.5)
+    np.testing.assert_allclose(sampler.probabilities().sum(), 1.)
+
+
+def test_sampler_matches_tagged_losses_past_dropped_batches():
+    tags = np.array([0, 1, 2, 0, 1, 2])
+    sampler = hard_examples.HardExampleSampler(6, floor=0., momentum=0., init_loss=1., tags=tags)
+    sampler.pending.extend([np.array([0, 1]), np.array([2, 5]), np.array([4, 3])])
+    # padded to batch_size 3 like SampleLoss
+    sampler.update(np.array([5., 6., 0.]), np.array([2, 2, -1]))
+    # the batch drawn before it never reached the model and is dropped
+    assert len(sampler.pending) == 1
+    np.testing.assert_array_equal(sampler.pending[0], [4, 3])
+    np.testing.assert_array_equal(sampler.losses, [1., 1., 5., 1., 1., 6.])
+
+
+def test_sampler_ignores_losses_of_unknown_batches():
+    sampler = hard_examples.HardExampleSampler(10, floor=0., momentum=0., init_loss=1., seed=0, tags=np.zeros(10))
+    sampler.draw(4)
+    sampler.update(np.full(4, 5.), np.ones(4))
+    assert len(sampler.pending) == 1
+    assert np.all(sampler.losses == 1.)
+
+
+def test_floor_keeps_every_sample_reachable():
+    sampler = hard_examples.HardExampleSampler(4, floor=0.2, momentum=0., init_loss=1.)
+    sampler.pending.append(np.arange(4))
+    sampler.update(np.array([10., 0., 0., 0.]))
+    np.testing.assert_allclose(sampler.probabilities(), [0.85, 0.05, 0.05, 0.05])
+
+
+def test_hard_example_fit_feeds_losses_back():
+    from utils import build_tiny_model
+
+    rng = np.random.RandomState(0)
+    x = rng.rand(64, 16, 16, 3).astype(np.float32) * 255
+    y = np.eye(3, dtype=np.float32)[rng.randint(3, size=64)]
+    generator, metric, callback = hard_examples.hard_example_generator(x, y, 8, init_loss=np.log(3), seed=0)
+    model = build_tiny_model(3)
+    model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.01), loss='categorical_crossentropy',
+                  metrics=['accuracy', metric])
+    model.fit(generator, steps_per_epoch=4, epochs=2, callbacks=[callback], verbose=0, workers=1)
+    assert not np.allclose(callback.sampler.losses, np.log(3))
+    # only the batches still in the input queue when fit stopped are left
+    assert len(callback.sampler.pending) < 8
+    assert metric.values.shape == (8,)
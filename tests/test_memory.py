@@ -0,0 +1,51 @@
+import time
+import numpy as np
+import pytest
+
+import memory
+
+
+@pytest.fixture
+def enabled():
+    memory.RECORDS.clear()
+    memory.enable(fail=False, rss_interval=0.002)
+    yield memory.RECORDS
+    memory.disable()
+    memory.RECORDS.clear()
+
+
+def line_of(text):
+    with open(__file__) as f:
+        return 'tests/test_memory.py:{}'.format(next(i for i, line in enumerate(f, 1) if text in line))
+
+
+@memory.track
+def transient_then_held():
+    transient = np.stack([np.ones(1024 * 1024), np.ones(1024 * 1024)])  # transient
+    time.sleep(0.1)
+    total = float(transient.sum())
+    del transient
+    held = np.concatenate([np.zeros(256 * 1024), np.zeros(256 * 1024)])  # held
+    return held, total
+
+
+def test_stage_reports_transient_peak_and_held_allocations_at_repo_lines(enabled):
+    held, _ = transient_then_held()
+    record = enabled['transient_then_held']
+    assert record['peak_mb'] >= 16
+    peak = record['largest_at_peak'][0]
+    assert peak['where'] == line_of('# transient')
+    # 16 MB once stacked, 32 MB if sampled while np.stack still holds its inputs
+    assert 15.9 < peak['mb'] < 32.1
+    assert record['largest_held'][0]['where'] == line_of('# held')
+    assert record['largest_held'][0]['mb'] == pytest.approx(4, rel=0.05)
+
+
+def test_budget_checks_the_peak(enabled):
+    memory.BUDGETS['transient_then_held'] = 8
+    memory.FAIL = True
+    try:
+        with pytest.raises(memory.MemoryBudgetExceeded):
+            transient_then_held()
+    finally:
+        memory.BUDGETS.clear()
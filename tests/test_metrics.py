@@ -0,0 +1,64 @@
+import itertools
+
+import pytest
+
+import metrics
+
+
+class CountingSequence(object):
+    def __init__(self, n):
+        self.n = n
+        self.epochs = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return (self.epochs, i)
+
+    def on_epoch_end(self):
+        self.epochs += 1
+
+
+def test_prefetch_cycles_a_sequence_across_epochs():
+    sequence = CountingSequence(3)
+    batches = list(itertools.islice(metrics.prefetch(sequence, max_queue_size=2), 8))
+    assert batches == [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2), (2, 0), (2, 1)]
+
+
+def test_prefetch_ends_with_a_finite_generator():
+    assert list(metrics.prefetch(iter(range(5)), source='test')) == [0, 1, 2, 3, 4]
+
+
+def test_counter_exposition():
+    registry = metrics.Registry()
+    requests = registry.get_or_create(metrics.Counter, 'test_requests_total', 'Requests', ['path'])
+    requests.inc(path='/predict')
+    requests.inc(2, path='/predict')
+    assert 'test_requests_total{path="/predict"} 3' in registry.exposition()
+
+
+class BrokenSequence(CountingSequence):
+    def __getitem__(self, i):
+        if i == 2:
+            raise OSError('image file is truncated')
+        return CountingSequence.__getitem__(self, i)
+
+
+def test_prefetch_reraises_source_errors_in_the_consumer():
+    batches = metrics.prefetch(BrokenSequence(5), max_queue_size=1)
+    assert next(batches) == (0, 0)
+    assert next(batches) == (0, 1)
+    with pytest.raises(OSError, match='truncated'):
+        next(batches)
+
+
+def test_prefetch_reraises_generator_errors():
+    def generator():
+        yield 1
+        raise ValueError('bad batch')
+
+    batches = metrics.prefetch(generator())
+    assert next(batches) == 1
+    with pytest.raises(ValueError):
+        next(batches)
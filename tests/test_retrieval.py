@@ -0,0 +1,89 @@
+import numpy as np
+
+import retrieval
+
+
+def brute_force_top_k(queries, vectors, k):
+    scores = retrieval.normalize(queries).dot(retrieval.normalize(vectors).T)
+    ids = np.argsort(-scores, axis=1)[:, :k]
+    return np.take_along_axis(scores, ids, axis=1), ids
+
+
+def test_normalize_gives_unit_rows_and_keeps_zero_rows():
+    x = retrieval.normalize([[3., 4.], [0., 0.]])
+    np.testing.assert_allclose(x, [[0.6, 0.8], [0., 0.]])
+
+
+def test_merge_top_k_keeps_best_sorted():
+    scores, ids = retrieval.merge_top_k(np.array([[0.9, 0.1]]), np.array([[0, 1]]),
+                                        np.array([[0.5, 0.95, 0.2]]), np.array([[10, 11, 12]]), 3)
+    np.testing.assert_allclose(scores, [[0.95, 0.9, 0.5]])
+    np.testing.assert_array_equal(ids, [[11, 0, 10]])
+
+
+def test_exact_search_matches_brute_force_across_blocks():
+    rng = np.random.RandomState(0)
+    vectors = rng.randn(1000, 32).astype(np.float32)
+    queries = rng.randn(7, 32).astype(np.float32)
+    index = retrieval.EmbeddingIndex(dim=32, block_size=96)
+    index.add(vectors, labels=np.arange(1000) % 10)
+    scores, ids = index.search(queries, k=5)
+    expected_scores, expected_ids = brute_force_top_k(queries, vectors, 5)
+    # the index stores float16 vectors
+    np.testing.assert_allclose(scores, expected_scores, atol=2e-3)
+    assert (ids == expected_ids).mean() > 0.95
+    assert np.all(np.diff(scores, axis=1) <= 0)
+
+
+def test_k_larger_than_index():
+    index = retrieval.EmbeddingIndex(dim=4)
+    index.add(np.eye(4)[:3])
+    scores, ids = index.search(np.eye(4)[:1], k=5)
+    assert ids.shape == (1, 3)
+    assert ids[0, 0] == 0
+
+
+def test_many_small_adds_match_one_add():
+    rng = np.random.RandomState(2)
+    vectors = rng.randn(100, 8)
+    whole = retrieval.EmbeddingIndex(dim=8)
+    whole.add(vectors, paths=['img{}.jpg'.format(i) for i in range(100)], labels=np.arange(100) % 7)
+    pieces = retrieval.EmbeddingIndex(dim=8, block_size=4)
+    for b in range(0, 100, 3):
+        pieces.add(vectors[b:b + 3], paths=['img{}.jpg'.format(i) for i in range(b, min(b + 3, 100))],
+                   labels=np.arange(b, min(b + 3, 100)) % 7)
+    assert len(pieces) == 100 and len(pieces.chunks) == 34
+    np.testing.assert_array_equal(pieces.vectors, whole.vectors)
+    assert not pieces.chunks
+    np.testing.assert_array_equal(pieces.labels, whole.labels)
+    assert list(pieces.paths) == list(whole.paths)
+    queries = rng.randn(3, 8)
+    np.testing.assert_array_equal(pieces.search(queries)[1], whole.search(queries)[1])
+
+
+def test_save_and_load_round_trip(tmp_path):
+    rng = np.random.RandomState(1)
+    index = retrieval.EmbeddingIndex(dim=16)
+    index.add(rng.randn(50, 16), paths=['img{}.jpg'.format(i) for i in range(50)], labels=np.arange(50) % 5)
+    prefix = str(tmp_path / 'train')
+    index.save(prefix)
+    loaded = retrieval.EmbeddingIndex.load(prefix)
+    assert len(loaded) == 50
+    np.testing.assert_array_equal(loaded.vectors, index.vectors)
+    np.testing.assert_array_equal(loaded.labels, index.labels)
+    assert loaded.paths[3] == 'img3.jpg'
+    queries = rng.randn(3, 16)
+    np.testing.assert_array_equal(loaded.search(queries)[1], index.search(queries)[1])
+
+
+def test_product_quantized_search_finds_near_duplicates():
+    rng = np.random.RandomState(2)
+    np.random.seed(2)
+    vectors = rng.randn(600, 16).astype(np.float32)
+    index = retrieval.EmbeddingIndex(dim=16, pq_subspaces=4)
+    index.train_pq(vectors, n_iter=5)
+    index.add(vectors)
+    assert index.codes.shape == (600, 4) and index.codes.dtype == np.uint8
+    queries = vectors[:50] + 0.01 * rng.randn(50, 16).astype(np.float32)
+    _, ids = index.search(queries, k=5)
+    assert (ids == np.arange(50)[:, None]).any(axis=1).mean() > 0.8
@@ -0,0 +1,112 @@
+# Batched test-time augmentation
+# Each image is expanded into several views (flip, crops, a few mild
+# Rand_Augment colour ops) that go through the model in one batched forward
+# pass; the view probabilities are averaged. With a confidence level, views
+# are scored chunk by chunk and images whose running prediction is already
+# confident skip the remaining chunks.
+import time
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+from rand_augmentation import Rand_Augment
+from utils import RESCALE
+
+DEFAULT_VIEWS = ['identity', 'flip', 'crop_center', 'crop_top_left', 'crop_bottom_right',
+                 'brightness', 'contrast', 'sharpness']
+CROP_FRACTION = 0.875
+MILD_MAGNITUDE = 2
+mild_augment = Rand_Augment(Numbers=1, max_Magnitude=MILD_MAGNITUDE + 1)
+
+
+def crop_view(x, position):
+    h, w = x.shape[1:3]
+    ch, cw = int(h * CROP_FRACTION), int(w * CROP_FRACTION)
+    top, left = {'center': ((h - ch) // 2, (w - cw) // 2),
+                 'top_left': (0, 0),
+                 'bottom_right': (h - ch, w - cw)}[position]
+    return tf.image.resize(x[:, top:top + ch, left:left + cw], (h, w)).numpy()
+
+
+def pil_view(x, op_name):
+    views = np.empty_like(x)
+    for i, image in enumerate(x):
+        image = Image.fromarray(np.clip(image / RESCALE, 0, 255).astype(np.uint8))
+        image = mild_augment.test_single_operation(image, op_name, MILD_MAGNITUDE)
+        views[i] = np.asarray(image, dtype=np.float32) * RESCALE
+    return views
+
+
+def make_views(x, views=DEFAULT_VIEWS):
+    '''Array (len(views), batch, h, w, 3) of the requested views of the batch x.'''
+    out = []
+    for view in views:
+        if view == 'identity':
+            out.append(x)
+        elif view == 'flip':
+            out.append(x[:, :, ::-1])
+        elif view.startswith('crop_'):
+            out.append(crop_view(x, view[len('crop_'):]))
+        else:
+            out.append(pil_view(x, view))
+    return np.stack(out)
+
+
+def tta_predict(model, x, views=DEFAULT_VIEWS, confidence=None, chunk_size=2):
+    '''
+    Mean probabilities over the views of each image of the batch x.
+    confidence=None: all views in a single forward pass of len(views) * len(x) images.
+    confidence=c: views are scored chunk_size at a time and an image stops
+    receiving views once its running mean probability reaches c.
+    Returns (probabilities, number of views used per image).
+    '''
+    if confidence is None:
+        v = make_views(x, views)
+        probs = np.asarray(model.predict_on_batch(v.reshape((-1,) + x.shape[1:])))
+        return probs.reshape(len(views), len(x), -1).mean(axis=0), np.full(len(x), len(views))
+
+    total = None
+    used = np.zeros(len(x), dtype=np.int32)
+    active = np.arange(len(x))
+    for c in range(0, len(views), chunk_size):
+        chunk = views[c:c + chunk_size]
+        v = make_views(x[active], chunk)
+        probs = np.asarray(model.predict_on_batch(v.reshape((-1,) + x.shape[1:])))
+        probs = probs.reshape(len(chunk), len(active), -1).sum(axis=0)
+        if total is None:
+            total = np.zeros((len(x), probs.shape[-1]), dtype=np.float32)
+        total[active] += probs
+        used[active] += len(chunk)
+        confident = (total[active] / used[active, None]).max(axis=1) >= confidence
+        active = active[~confident]
+        if len(active) == 0:
+            break
+    return total / used[:, None], used
+
+
+def benchmark_tta(model, x, batch_size=8, views=DEFAULT_VIEWS, confidence=0.9):
+    '''Images per second without TTA, with all views, and with early stopping.'''
+    def run(predict):
+        predict(x[:batch_size])
+        start = time.time()
+        for b in range(0, len(x), batch_size):
+            predict(x[b:b + batch_size])
+        return len(x) / (time.time() - start)
+
+    report = {'views': len(views),
+              'off': run(model.predict_on_batch),
+              'on': run(lambda batch: tta_predict(model, batch, views)),
+              'early_stop': run(lambda batch: tta_predict(model, batch, views, confidence))}
+    print("images/s: TTA off {off:.1f}, TTA on ({views} views) {on:.1f}, "
+          "early stop {early_stop:.1f}".format(**report))
+    return report
+
+
+if __name__ == "__main__":
+    from tensorflow.keras.models import load_model
+    from utils import apply_threading_config, load_image_batch
+
+    apply_threading_config()
+    model = load_model('best_model_101class.hdf5', compile=False)
+    x = load_image_batch(['data/frenchfries.jpg', 'data/chocolatecake.jpg',
+                          'data/applepie.jpg', 'data/waffles.jpg'] * 4)
+    benchmark_tta(model, x, batch_size=4)
@@ -1,18 +1,29 @@
 import os
+import json
+import time
 import random
 import numpy as np
 import tensorflow as tf
 import subprocess as sp
 import os
+import matplotlib.pyplot as plt
+from tensorflow.keras import regularizers
+from tensorflow.keras.applications.inception_v3 import InceptionV3
+from tensorflow.keras.layers import Input, Conv2D, Dense, Dropout, GlobalAveragePooling2D
+from tensorflow.keras.models import Model
 from tensorflow.keras.utils import to_categorical
 from sklearn.model_selection import train_test_split
 from rand_augmentation import Rand_Augment
+from evaluation import evaluate_stream
+import memory
+from metrics import BATCH_SECONDS, DECODE_SECONDS, IMAGES_DECODED, PREDICT_BATCH_SIZE, PREDICT_SECONDS
 img_augment = Rand_Augment(Numbers=2, max_Magnitude=10)
 
 
 """## Loading the Data
 Load images and labels.
 """
+@memory.track
 def load_data(xs='./xs.npy', ys='./ys.npy'):
     """
         Load the data:
@@ -55,6 +66,222 @@ def load_test_data(xt='./xt.npy'):
     return output
 
 
+"""## Preprocessing
+One spec shared by training and inference: images are resized to IMG_SIZE
+(nearest neighbour, as flow_from_directory does) and multiplied by RESCALE.
+"""
+IMG_SIZE = (300, 300)
+RESCALE = 1. / 255
+# the random transforms of the training ImageDataGenerator (on top of rescale=RESCALE)
+TRAIN_AUGMENTATION = dict(rotation_range=30, zoom_range=0.2, width_shift_range=0.2, height_shift_range=0.2,
+                          shear_range=0.2, horizontal_flip=True, fill_mode="nearest")
+
+
+"""## Manifest helpers
+Read the Food-101 meta/*.txt manifests and stream the listed images in batches.
+"""
+def load_manifest(meta_file='food-101/meta/train.txt', image_dir='food-101/images', food_list=None):
+  """
+      Read a Food-101 manifest (one "<class>/<image id>" per line):
+          - returns the image paths, their class indices and the sorted class list.
+          - food_list (e.g. from pick_n_random_classes) keeps only those classes.
+  """
+  with open(meta_file, 'r') as txt:
+    entries = [read.strip() for read in txt.readlines() if read.strip()]
+
+  if food_list is None:
+    food_list = sorted(set(e.split('/')[0] for e in entries))
+  else:
+    food_list = sorted(food_list)
+  class_index = {food: i for i, food in enumerate(food_list)}
+
+  paths = []
+  labels = []
+  for e in entries:
+    food = e.split('/')[0]
+    if food in class_index:
+      paths.append(os.path.join(image_dir, e + '.jpg'))
+      labels.append(class_index[food])
+
+  return np.array(paths), np.array(labels, dtype=np.int32), food_list
+
+
+def load_image_batch(paths, target_size=IMG_SIZE, data_aug=False):
+  """
+      Load images into one float32 batch following the preprocessing spec,
+      optionally passing each image through img_augment first.
+  """
+  batch = np.empty((len(paths),) + tuple(target_size) + (3,), dtype=np.float32)
+  for i, path in enumerate(paths):
+    start = time.perf_counter()
+    x = tf.keras.preprocessing.image.load_img(path, target_size=target_size)
+    DECODE_SECONDS.observe(time.perf_counter() - start)
+    IMAGES_DECODED.inc()
+    if data_aug:
+      x = img_augment(x)
+    batch[i] = tf.keras.preprocessing.image.img_to_array(x)
+  batch *= RESCALE
+  return batch
+
+
+class ManifestSequence(tf.keras.utils.Sequence):
+  """
+      Batches of (images, one-hot labels) for the paths of a manifest.
+      Works with model.fit / model.predict like flow_from_directory, but every
+      batch is addressable by position through batch_indices().
+  """
+  def __init__(self, paths, labels, batch_size, n_classes=None, target_size=IMG_SIZE,
+               shuffle=False, data_aug=False):
+    self.paths = np.asarray(paths)
+    self.labels = np.asarray(labels)
+    self.batch_size = batch_size
+    self.n_classes = n_classes if n_classes is not None else int(self.labels.max()) + 1
+    self.target_size = target_size
+    self.shuffle = shuffle
+    self.data_aug = data_aug
+    self.index_array = np.arange(len(self.paths))
+    if self.shuffle:
+      np.random.shuffle(self.index_array)
+
+  def __len__(self):
+    return int(np.ceil(len(self.paths) / float(self.batch_size)))
+
+  def batch_indices(self, idx):
+    return self.index_array[idx * self.batch_size:(idx + 1) * self.batch_size]
+
+  def __getitem__(self, idx):
+    start = time.perf_counter()
+    index = self.batch_indices(idx)
+    x = load_image_batch(self.paths[index], self.target_size, self.data_aug)
+    y = to_categorical(self.labels[index], self.n_classes)
+    BATCH_SECONDS.observe(time.perf_counter() - start, source='manifest')
+    return x, y
+
+  def on_epoch_end(self):
+    if self.shuffle:
+      np.random.shuffle(self.index_array)
+
+
+"""## Model
+InceptionV3 backbone, pooled, with the Dense/Dropout/Dense classifier head.
+"""
+def classifier_head(x, n, width=128, dropout=0.2, l2_reg=0.005):
+  """Dense(width) -> Dropout -> Dense(n) softmax, applied to the pooled backbone features x."""
+  x = Dense(width, activation='relu')(x)
+  x = Dropout(dropout)(x)
+  return Dense(n, kernel_regularizer=regularizers.l2(l2_reg), activation='softmax')(x)
+
+
+def build_model(n, backbone=None, **head_kwargs):
+  """
+      InceptionV3 -> GlobalAveragePooling2D -> classifier_head.
+      backbone defaults to an ImageNet InceptionV3 without its top.
+  """
+  if backbone is None:
+    backbone = InceptionV3(weights='imagenet', include_top=False)
+  x = GlobalAveragePooling2D()(backbone.output)
+  return Model(inputs=backbone.input, outputs=classifier_head(x, n, **head_kwargs))
+
+
+def build_tiny_model(n, input_shape=(None, None, 3)):
+  """
+      Two small convolutions -> GlobalAveragePooling2D -> classifier_head.
+      A stand-in with the same interface as build_model for benchmarks and
+      smoke runs that should not need the InceptionV3 weights.
+  """
+  inputs = Input(shape=input_shape)
+  x = Conv2D(16, 3, strides=2, activation='relu')(inputs)
+  x = Conv2D(32, 3, strides=2, activation='relu')(x)
+  x = GlobalAveragePooling2D()(x)
+  return Model(inputs=inputs, outputs=classifier_head(x, n, width=32))
+
+
+def with_embeddings(model):
+  """
+      Two-output model giving (class probabilities, pooled backbone features)
+      in the same forward pass, for classification plus similar-dish retrieval.
+  """
+  pooled = [layer for layer in model.layers if isinstance(layer, GlobalAveragePooling2D)][-1]
+  return Model(inputs=model.input, outputs=[model.output, pooled.output])
+
+
+"""## Prediction
+"""
+def predict_class(model, images, food_list, show=True, index=None, k=5, tta=None):
+  """
+      Predict the food class of each image path.
+      With a retrieval.EmbeddingIndex as index, the k most similar training
+      images are looked up from the same forward pass that gives the class.
+      tta: True or a list of tta.py view names averages the class over those views.
+      Returns a list of (class, neighbours) pairs, neighbours being None without an index.
+  """
+  if index is not None:
+    model = with_embeddings(model)
+  if tta:
+    import tta as tta_module
+    views = tta_module.DEFAULT_VIEWS if tta is True else tta
+  food_list = sorted(food_list)
+  results = []
+  for img in images:
+    img = load_image_batch([img], target_size=IMG_SIZE)
+    start = time.perf_counter()
+
+    if index is not None:
+      pred, embedding = model.predict(img)
+      scores, ids = index.search(embedding, k)
+      neighbours = [(index.paths[i], float(s)) for i, s in zip(ids[0], scores[0])]
+    elif tta:
+      pred, _ = tta_module.tta_predict(model, img, views)
+      neighbours = None
+    else:
+      pred = model.predict(img)
+      neighbours = None
+    PREDICT_SECONDS.observe(time.perf_counter() - start, path='predict_class')
+    PREDICT_BATCH_SIZE.observe(len(img), path='predict_class')
+    pred_value = food_list[np.argmax(pred)]
+    results.append((pred_value, neighbours))
+    if show:
+        plt.imshow(img[0])
+        plt.axis('off')
+        plt.title(pred_value)
+        plt.show()
+  return results
+
+
+def measure_throughput(model, input_shape=IMG_SIZE + (3,), batch_size=32, steps=10):
+  """Images per second of model.predict_on_batch on random inputs, after one warm-up batch."""
+  x = np.random.rand(batch_size, *input_shape).astype(np.float32)
+  model.predict_on_batch(x)
+  start = time.time()
+  for _ in range(steps):
+    model.predict_on_batch(x)
+  return batch_size * steps / (time.time() - start)
+
+
+def apply_threading_config(path='threading_config.json', session_config=None, replicas=None):
+  """
+      Set the intra-op/inter-op thread pools written by autotune.py, if path exists.
+      Call before TensorFlow runs its first op; session_config (a tf.compat.v1.ConfigProto)
+      gets the same thread counts. A process that is one of `replicas` concurrent
+      workers only takes a configuration tuned for that many replicas.
+      Returns the configuration or None.
+  """
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    config = json.load(f)
+  if replicas is not None and config['replicas'] != replicas:
+    return None
+  tf.config.threading.set_intra_op_parallelism_threads(config['intra_op_threads'])
+  tf.config.threading.set_inter_op_parallelism_threads(config['inter_op_threads'])
+  if session_config is not None:
+    session_config.intra_op_parallelism_threads = config['intra_op_threads']
+    session_config.inter_op_parallelism_threads = config['inter_op_threads']
+  print("Using {} intra-op and {} inter-op threads from {}".format(
+    config['intra_op_threads'], config['inter_op_threads'], path))
+  return config
+
+
 def mask_unused_gpus(leave_unmasked=1):
   ACCEPTABLE_AVAILABLE_MEMORY = 1024
   COMMAND = "nvidia-smi --query-gpu=memory.free --format=csv"
@@ -70,6 +297,7 @@ def mask_unused_gpus(leave_unmasked=1):
   except Exception as e:
     print('"nvidia-smi" is probably not installed. GPUs are not masked', e)
 
+@memory.track
 def pseudo_labelling(model, xs, ys, xt, threhold=0.9):
   """
   Pseudo-label unlabeled data in the teacher model
@@ -77,12 +305,14 @@ def pseudo_labelling(model, xs, ys, xt, threhold=0.9):
       into numpy arrays Add a pseudo label to an unlabeled image Leave only pseudo-label data above a certain 
       threshold Align the number of data for each label It will be. 
   """
+  memory.phase('split')
   x_train_9,x_test_9, y_train_9,y_test_9 = train_test_split(xs, ys, test_size=0.2)
 
   y_train_9 = to_categorical(y_train_9)
   y_test_9 = to_categorical(y_test_9)
 
   # ============Add a pseudo label to an unlabeled image============
+  memory.phase('predict')
 
   x_train_imgnet = xt[:-1]
   #Batch size setting
@@ -109,6 +339,7 @@ def pseudo_labelling(model, xs, ys, xt, threhold=0.9):
 
   # ============Leave only pseudo-label data above a certain threshold============
   #Thresholding
+  memory.phase('threshold')
   y_train_imgnet_dummy_th =  y_train_imgnet_dummy[np.max(y_train_imgnet_dummy, axis=1) > threhold]
   x_train_imgnet_th = x_train_imgnet[np.max(y_train_imgnet_dummy, axis=1) > threhold]
 
@@ -135,6 +366,7 @@ def pseudo_labelling(model, xs, ys, xt, threhold=0.9):
       y_student_per_img_path.append(temp_i)
 
   #Copy data for maximum count on each label
+  memory.phase('tile')
   y_student_per_label_add = []
   y_student_per_img_add = []
 
@@ -156,6 +388,7 @@ def pseudo_labelling(model, xs, ys, xt, threhold=0.9):
   print([len(i) for i in y_student_per_label_add])
 
   #Merge data for each label
+  memory.phase('concatenate')
   student_train_img = np.concatenate(y_student_per_img_add, axis=0)
   student_train_label = np.concatenate(y_student_per_label_add, axis=0)
 
@@ -165,17 +398,32 @@ def pseudo_labelling(model, xs, ys, xt, threhold=0.9):
 
   return x_train_student, y_train_student
 
-def my_eval(model,x,t):
+def my_eval(model,x,t=None,tta=None,batch_size=32,report_file=None):
     """
       model: Model to be evaluated,
       x: Image to be predicted
       shape = (batch, 32,32,3)
-      t: label of one-hot representation"""
-    ev = model.evaluate(x,t)
+      t: label of one-hot representation
+      x may also be any batched source of evaluation.iterate_batches
+      (memmap, ManifestSequence, flow_from_directory(shuffle=False)) with t=None.
+      tta: True or a list of tta.py view names to evaluate with test-time augmentation
+      report_file: JSON report with confusion matrix, top-5 and per-class precision/recall
+      The loss is the cross-entropy alone, without the L2 penalty of the head."""
+    predict = model.predict_on_batch
+    if tta:
+      import tta as tta_module
+      views = tta_module.DEFAULT_VIEWS if tta is True else tta
+      predict = lambda batch: tta_module.tta_predict(model, batch, views)[0]
+    source = (x, t) if t is not None else x
+    evaluator = evaluate_stream(predict, source, batch_size=batch_size, report_file=report_file)
+    ev = [evaluator.loss, evaluator.accuracy]
     print("loss:" ,end = " ")
     print(ev[0])
     print("acc: ", end = "")
     print(ev[1])
+    print("top-5 acc: ", end = "")
+    print(evaluator.top_k_accuracy)
+    return evaluator
 
 # Data generator definition
 def get_random_data(x_train_i, y_train_i, data_aug):
@@ -192,11 +440,21 @@ def get_random_data(x_train_i, y_train_i, data_aug):
 
   return seed_image, y_train_i
 
-def data_generator(x_train, y_train, batch_size, data_aug):
-  '''data generator for fit_generator'''
+@memory.track
+def data_generator(x_train, y_train, batch_size, data_aug, sampler=None):
+  '''
+  data generator for fit_generator
+  sampler: optional hard_examples.HardExampleSampler choosing the indices of every batch
+  '''
   n = len(x_train)
   i = 0
   while True:
+      start = time.perf_counter()
+      if sampler is not None:
+          batch = [get_random_data(x_train[j], y_train[j], data_aug) for j in sampler.draw(batch_size)]
+          BATCH_SECONDS.observe(time.perf_counter() - start, source='data_generator')
+          yield np.array([b[0] for b in batch]), np.array([b[1] for b in batch])
+          continue
       image_data = []
       label_data = []
       for b in range(batch_size):
@@ -210,4 +468,5 @@ def data_generator(x_train, y_train, batch_size, data_aug):
           i = (i+1) % n
       image_data = np.array(image_data)
       label_data = np.array(label_data)
+      BATCH_SECONDS.observe(time.perf_counter() - start, source='data_generator')
       yield image_data, label_data
\ No newline at end of file
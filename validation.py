@@ -0,0 +1,208 @@
+# Out-of-process and subsampled validation during training
+# Two ways to stop model.fit from stalling on the 25,250 test images:
+#   - stratified_subset: a fixed per-class subsample for per-epoch monitoring
+#   - sidecar: the trainer only writes one checkpoint per epoch and a separate
+#     process evaluates each new checkpoint on the full split with large
+#     batches, appending the metrics to a history log. Every run starts from
+#     an empty checkpoint directory and history, and the sidecar stops when the
+#     trainer writes its marker (also on failure) or its process is gone.
+#         python validation.py checkpoints food-101/test [trainer pid]
+import os
+import sys
+import csv
+import glob
+import time
+import shutil
+import subprocess
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.utils import to_categorical
+from utils import RESCALE
+
+DONE_MARKER = 'training_done'
+
+
+def stratified_indices(labels, per_class, seed=0):
+    '''The same per_class random samples of every class on every call.'''
+    rng = np.random.RandomState(seed)
+    indices = []
+    for c in np.unique(labels):
+        members = np.flatnonzero(labels == c)
+        indices.append(rng.choice(members, min(per_class, len(members)), replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+class SubsetSequence(tf.keras.utils.Sequence):
+    '''
+    Batches of a fixed subset of a flow_from_directory iterator, preprocessed by
+    the iterator's own ImageDataGenerator (rescale etc.) at its target size.
+    '''
+    def __init__(self, iterator, indices, batch_size=64):
+        self.iterator = iterator
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        index = self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
+        x = np.empty((len(index),) + self.iterator.image_shape, dtype=np.float32)
+        for i, j in enumerate(index):
+            img = tf.keras.preprocessing.image.load_img(self.iterator.filepaths[j],
+                                                        target_size=self.iterator.target_size,
+                                                        interpolation=self.iterator.interpolation)
+            x[i] = self.iterator.image_data_generator.standardize(tf.keras.preprocessing.image.img_to_array(img))
+        return x, to_categorical(self.iterator.classes[index], self.iterator.num_classes)
+
+
+def stratified_subset(iterator, per_class=20, batch_size=64, seed=0):
+    '''Fixed stratified subsample of a validation flow_from_directory iterator.'''
+    return SubsetSequence(iterator, stratified_indices(iterator.classes, per_class, seed), batch_size)
+
+
+def clear_run(directory='checkpoints', history_file='history_val.log'):
+    '''Remove the marker, the epoch checkpoints and the sidecar history of a previous run.'''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for path in glob.glob(os.path.join(directory, 'epoch-*.hdf5')) + [os.path.join(directory, DONE_MARKER),
+                                                                      history_file]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class SidecarCheckpoint(tf.keras.callbacks.Callback):
+    '''
+    Write the model to <directory>/epoch-NNN.hdf5 after every epoch (temporary
+    file + rename, so the sidecar never reads a partial file) and a marker when
+    training ends. fit does not end its callbacks when it raises, so call
+    finish() from a finally block as well.
+    '''
+    def __init__(self, directory='checkpoints'):
+        super().__init__()
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def on_train_begin(self, logs=None):
+        # the marker and checkpoints of a previous run would end or mislead the sidecar
+        for path in glob.glob(os.path.join(self.directory, 'epoch-*.hdf5')) + [
+                os.path.join(self.directory, DONE_MARKER)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def on_epoch_end(self, epoch, logs=None):
+        path = os.path.join(self.directory, 'epoch-{:03d}.hdf5'.format(epoch + 1))
+        self.model.save(path + '.tmp.hdf5')
+        os.replace(path + '.tmp.hdf5', path)
+
+    def on_train_end(self, logs=None):
+        self.finish()
+
+    def finish(self):
+        open(os.path.join(self.directory, DONE_MARKER), 'w').close()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def evaluated_epochs(history_file):
+    if not os.path.exists(history_file):
+        return {}
+    with open(history_file) as f:
+        return {int(row['epoch']): float(row['val_loss']) for row in csv.DictReader(f)}
+
+
+def sidecar_evaluate(directory='checkpoints', validation_data_dir='food-101/test', history_file='history_val.log',
+                     best_filepath='best_model_101class.hdf5', batch_size=128, target_size=None, rescale=RESCALE,
+                     poll=30, trainer_pid=None):
+    '''
+    Evaluate every new epoch-NNN.hdf5 of directory on the whole validation_data_dir,
+    append epoch,val_loss,val_accuracy to history_file and copy the best
+    checkpoint (lowest val_loss) to best_filepath. Returns once the trainer has
+    written its marker, or process trainer_pid has exited, and every checkpoint
+    is evaluated.
+    '''
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    from utils import IMG_SIZE
+
+    generator = ImageDataGenerator(rescale=rescale).flow_from_directory(
+        validation_data_dir,
+        target_size=target_size or IMG_SIZE,
+        batch_size=batch_size,
+        class_mode='categorical',
+        shuffle=False)
+    done = evaluated_epochs(history_file)
+    best = min(done.values()) if done else np.inf
+    while True:
+        finished = os.path.exists(os.path.join(directory, DONE_MARKER)) or (
+            trainer_pid is not None and not process_alive(trainer_pid))
+        pending = [f for f in sorted(glob.glob(os.path.join(directory, 'epoch-[0-9][0-9][0-9].hdf5')))
+                   if int(os.path.basename(f)[6:9]) not in done]
+        for path in pending:
+            epoch = int(os.path.basename(path)[6:9])
+            model = load_model(path, compile=False)
+            model.compile(loss='categorical_crossentropy', metrics=['accuracy'])
+            start = time.time()
+            val_loss, val_accuracy = model.evaluate(generator, verbose=0)
+            print("Epoch {}: val_loss {:.4f} val_accuracy {:.4f} ({:.0f}s)".format(
+                epoch, val_loss, val_accuracy, time.time() - start))
+            new_file = not os.path.exists(history_file)
+            with open(history_file, 'a') as f:
+                if new_file:
+                    f.write('epoch,val_loss,val_accuracy\n')
+                f.write('{},{},{}\n'.format(epoch, val_loss, val_accuracy))
+            done[epoch] = val_loss
+            if best_filepath and val_loss < best:
+                best = val_loss
+                shutil.copyfile(path, best_filepath + '.tmp')
+                os.replace(best_filepath + '.tmp', best_filepath)
+            tf.keras.backend.clear_session()
+        if finished and not pending:
+            return done
+        if not pending:
+            time.sleep(poll)
+
+
+def launch_sidecar(directory='checkpoints', validation_data_dir='food-101/test', history_file='history_val.log'):
+    '''
+    Clear the previous run's state and start sidecar_evaluate in its own
+    process; the trainer never waits for it, and it stops once the trainer is gone.
+    '''
+    clear_run(directory, history_file)
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), directory, validation_data_dir,
+                             str(os.getpid())])
+
+
+def merge_history(train_log='history.log', val_log='history_val.log', out_file='history_merged.log'):
+    '''
+    Join the trainer's CSVLogger history with the sidecar metrics on the epoch
+    column (1-based). Epochs the sidecar did not evaluate get empty values.
+    '''
+    with open(train_log) as f:
+        rows = list(csv.DictReader(f))
+    val = {}
+    if os.path.exists(val_log):
+        with open(val_log) as f:
+            val = {int(row['epoch']): row for row in csv.DictReader(f)}
+    for row in rows:
+        metrics = val.get(int(row['epoch']) + 1, {})
+        row['val_loss'] = metrics.get('val_loss', '')
+        row['val_accuracy'] = metrics.get('val_accuracy', '')
+    with open(out_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else ['epoch'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    sidecar_evaluate(*sys.argv[1:3], trainer_pid=int(sys.argv[3]) if len(sys.argv) > 3 else None)
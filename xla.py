@@ -0,0 +1,94 @@
+# XLA-compiled training and inference steps
+# Opt-in jit_compile for the train step (model.compile) and the predict step
+# (tf.function). Each is first tried on a sample batch; when XLA cannot
+# compile an op the model falls back to the default graph execution.
+import time
+import numpy as np
+import tensorflow as tf
+from utils import IMG_SIZE, build_model, build_tiny_model
+
+XLA_ERRORS = (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError,
+              tf.errors.NotFoundError, tf.errors.InternalError)
+
+
+def copy_optimizer(optimizer):
+    return optimizer.__class__.from_config(optimizer.get_config())
+
+
+def compile_with_xla(model, optimizer, loss='categorical_crossentropy', metrics=['accuracy'], sample=None):
+    '''
+    model.compile with jit_compile=True if the train step compiles, else without.
+    sample: an (x, y) batch used to try the XLA train step on a copy of model,
+    so the weights of model are not touched. Returns whether XLA is used.
+    '''
+    jit_compile = True
+    if sample is not None:
+        clone = tf.keras.models.clone_model(model)
+        clone.set_weights(model.get_weights())
+        clone.compile(optimizer=copy_optimizer(optimizer), loss=loss, metrics=metrics, jit_compile=True)
+        try:
+            clone.train_on_batch(*sample)
+        except XLA_ERRORS as e:
+            print("XLA cannot compile the train step, falling back to graph execution:", str(e).split('\n')[0])
+            jit_compile = False
+        del clone
+    model.compile(optimizer=optimizer, loss=loss, metrics=metrics, jit_compile=jit_compile)
+    return jit_compile
+
+
+def xla_predict_fn(model, sample=None):
+    '''
+    Predict step compiled with XLA, or a plain tf.function when compilation fails on sample.
+    Batches of a new shape trigger a recompilation, so keep the batch size fixed.
+    '''
+    predict = tf.function(lambda x: model(x, training=False), jit_compile=True)
+    if sample is not None:
+        try:
+            predict(sample)
+        except XLA_ERRORS as e:
+            print("XLA cannot compile the predict step, falling back to graph execution:", str(e).split('\n')[0])
+            predict = tf.function(lambda x: model(x, training=False))
+    return predict
+
+
+def benchmark_step(model, input_shape, batch_size, steps, jit_compile):
+    '''Train steps/s and predict images/s for one setting, after one warm-up step each.'''
+    n = model.output_shape[-1]
+    x = np.random.rand(batch_size, *input_shape).astype(np.float32)
+    y = tf.keras.utils.to_categorical(np.random.randint(0, n, batch_size), n)
+    clone = tf.keras.models.clone_model(model)
+    clone.compile(optimizer=tf.keras.optimizers.SGD(0.0001, momentum=0.9), loss='categorical_crossentropy',
+                  jit_compile=jit_compile)
+    clone.train_on_batch(x, y)
+    start = time.time()
+    for _ in range(steps):
+        clone.train_on_batch(x, y)
+    train_steps = steps / (time.time() - start)
+
+    predict = tf.function(lambda x: clone(x, training=False), jit_compile=jit_compile)
+    predict(x)
+    start = time.time()
+    for _ in range(steps):
+        predict(x).numpy()
+    predict_images = steps * batch_size / (time.time() - start)
+    return {'train_steps_per_s': train_steps, 'train_images_per_s': train_steps * batch_size,
+            'predict_images_per_s': predict_images}
+
+
+def benchmark_xla(batch_size=8, steps=20, n=101):
+    '''Compare default and XLA steps on the InceptionV3 model of run.py and on the tiny stand-in.'''
+    report = {}
+    for name, model, input_shape in [('tiny', build_tiny_model(n), (64, 64, 3)),
+                                     ('inception_v3', build_model(n), IMG_SIZE + (3,))]:
+        for jit_compile in [False, True]:
+            try:
+                result = benchmark_step(model, input_shape, batch_size, steps, jit_compile)
+            except XLA_ERRORS as e:
+                result = {'error': str(e).split('\n')[0]}
+            report['{}/{}'.format(name, 'xla' if jit_compile else 'default')] = result
+            print(name, 'xla' if jit_compile else 'default', result)
+    return report
+
+
+if __name__ == "__main__":
+    benchmark_xla()